@@ -0,0 +1,238 @@
+from __future__ import print_function
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+from SpermSegReg import Parser, Run
+
+'''
+Batch mode of SpermSegReg.py.
+
+A manifest lists the movies, one per row of a .csv file or one per object of a .json list.
+The fields are the long option names of SpermSegReg.py, e.g. input_file_name, output_path,
+starting_step, regions_of_stains, deltaT, scale; a field missing in a row is taken from the
+options given to Batch.py after "--". An optional field "name" names the movie in the summary,
+and a missing output_path becomes <output root>/<name>/.
+
+The movies are run by a pool of worker processes which live for the whole batch, so each
+worker imports SimpleITK, SciPy and matplotlib once. A movie that fails is reported in the
+summary table and the batch goes on with the next one; so is a row with invalid options, which is
+not run.
+
+Example:
+    python Batch.py -m ../Movies/manifest.csv -o ../Results/ -j 4 -- -mf 3 -tr 2 -tv 10 -dt 0.005 -sc 0.1625 -hbr 0.25 -n 1
+'''
+
+
+'''
+Input:
+    (1) filename = name of the manifest, .csv or .json
+Output:
+    (1) rows = list of dictionaries, one per movie
+'''
+
+def ReadManifest( filename ):
+    if filename.lower().endswith( ".json" ):
+        with open( filename ) as f:
+            rows = json.load( f )
+    else:
+        with open( filename ) as f:
+            rows = [ dict(row) for row in csv.DictReader( f ) ]
+    # Skip empty fields, so that they fall back to the common options.
+    return [ dict( [ (key.strip(), value) for key,value in row.items()
+                     if value is not None and value != "" ] ) for row in rows ]
+
+
+'''
+Inputs:
+    (1) row = dictionary, one movie of the manifest
+    (2) common = list of strings, options shared by all movies
+    (3) outputroot = output path of the movies without an output_path
+Outputs:
+    (1) name = name of the movie
+    (2) args = parsed arguments of SpermSegReg.py for the movie
+'''
+
+def MovieArguments( row, common, outputroot ):
+    row = dict( row )
+    name = MovieName( row )
+    row.pop( "name", None )
+    if "input_file_name" not in row:
+        raise ValueError( "the row has no input_file_name" )
+    if "output_path" not in row:
+        row["output_path"] = os.path.join( outputroot, name, "" )
+
+    argv = list( common )
+    for key,value in row.items():
+        if value is True or str(value).lower() == "true":
+            argv.append( "--"+key )
+        elif value is False or str(value).lower() == "false":
+            continue
+        elif isinstance( value, list ):
+            argv.append( "--"+key )
+            argv.extend( [ str(v) for v in value ] )
+        else:
+            # A list in a .csv field is separated by spaces, e.g. the regions of stains.
+            argv.append( "--"+key )
+            argv.extend( str(value).split() )
+    # A malformed row fails alone instead of exiting the whole batch.
+    parser = Parser()
+    def Error( message ):
+        raise ValueError( message )
+    parser.error = Error
+    args = parser.parse_args( argv )
+    return name, args
+
+
+'''
+Input:
+    (1) row = dictionary, one movie of the manifest
+Output:
+    (1) name = name of the movie, None without a name and an input_file_name
+'''
+
+def MovieName( row ):
+    name = row.get( "name", None )
+    if name is None and "input_file_name" in row:
+        name = os.path.splitext( os.path.basename( str(row["input_file_name"]) ) )[0]
+    return name
+
+
+'''
+Inputs:
+    (1) row = dictionary, one movie of the manifest
+    (2) index = integer, position of the row in the manifest
+    (3) error = exception raised by MovieArguments for the row
+Output:
+    (1) result = dictionary, one row of the summary table, see RunMovie
+'''
+
+def FailedRow( row, index, error ):
+    name = MovieName( row )
+    return { "name": name if name is not None else "row %d" % (index+1),
+             "input_file_name": row.get( "input_file_name", "" ),
+             "output_path": row.get( "output_path", "" ), "status": "failed",
+             "frames": "", "good_frames": "", "good_frame_rate": "", "wall_time": "",
+             "error": " ".join( ( "%s: %s" % ( type(error).__name__, error ) ).split() ) }
+
+
+'''
+Input:
+    (1) job = (name, args), see MovieArguments
+Output:
+    (1) result = dictionary, one row of the summary table
+'''
+
+def RunMovie( job ):
+    name, args = job
+    result = { "name": name, "input_file_name": args.input_file_name,
+               "output_path": args.output_path, "status": "failed",
+               "frames": "", "good_frames": "", "good_frame_rate": "", "error": "" }
+    start = time.time()
+    try:
+        if not os.path.isdir( args.output_path ):
+            os.makedirs( args.output_path )
+        sperm = Run( args )
+        nframes = len( sperm["body"] )
+        result["status"] = "done"
+        result["frames"] = nframes
+        result["good_frames"] = len( sperm["frames"] )
+        result["good_frame_rate"] = "%.4f" % ( len(sperm["frames"]) / float( max(1,nframes) ) )
+    except Exception as e:
+        result["error"] = " ".join( ( "%s: %s" % ( type(e).__name__, e ) ).split() )
+        # Keep the full traceback next to the outputs of the movie.
+        try:
+            with open( os.path.join( args.output_path, "SpermBatchError.txt" ), "w" ) as f:
+                f.write( traceback.format_exc() )
+        except (IOError, OSError):
+            pass
+    result["wall_time"] = "%.3f" % ( time.time()-start )
+    return result
+
+
+'''
+Inputs:
+    (1) jobs = list of (name, args), see MovieArguments
+    (2) processes = integer, number of movies run at the same time
+Output:
+    (1) a generator of the results of RunMovie, in the order in which the movies finish
+'''
+
+def RunBatch( jobs, processes=1 ):
+    if processes == 1:
+        for job in jobs:
+            yield RunMovie( job )
+        return
+
+    # Each worker runs one movie at a time, so the frames of a movie are not shared further.
+    for job in jobs:
+        job[1].workers = 1
+    pool = multiprocessing.Pool( processes )
+    try:
+        for result in pool.imap_unordered( RunMovie, jobs ):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+SummaryColumns = [ "name", "status", "frames", "good_frames", "good_frame_rate", "wall_time",
+                   "input_file_name", "output_path", "error" ]
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Batch mode of SpermSegReg.py",
+                                      epilog = "Options after -- are passed to SpermSegReg.py"
+                                      " for every movie, unless the manifest sets them." )
+    parser.add_argument('-m', '--manifest', type=str, required=True,
+                        help='The manifest of the movies, .csv or .json.')
+    parser.add_argument('-o', '--output_path', type=str, required=True,
+                        help='The output path of the summary table and of the movies without'
+                        ' an output_path in the manifest.')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of movies processed at the same time.')
+    parser.add_argument('common', nargs=argparse.REMAINDER,
+                        help='Options of SpermSegReg.py shared by all movies.')
+    args = parser.parse_args()
+    common = args.common
+    if common and common[0] == "--":
+        common = common[1:]
+
+    # Check the arguments of every movie before anything runs. #
+    jobs, failures = [], []
+    for k,row in enumerate( ReadManifest( args.manifest ) ):
+        try:
+            jobs.append( MovieArguments( row, common, args.output_path ) )
+        except ValueError as e:
+            failures.append( FailedRow( row, k, e ) )
+    total = len(jobs) + len(failures)
+    if not os.path.isdir( args.output_path ):
+        os.makedirs( args.output_path )
+
+    # Run the movies and write the summary table as they finish. #
+    summary = os.path.join( args.output_path, "SpermBatchSummary.csv" )
+    with open( summary, "w" ) as f:
+        writer = csv.DictWriter( f, fieldnames=SummaryColumns )
+        writer.writeheader()
+        for result in failures:
+            writer.writerow( result )
+            print("  %s failed: %s  " % (result["name"], result["error"]))
+        f.flush()
+        failed = len( failures )
+        for k,result in enumerate( RunBatch( jobs, max(1,args.jobs) ) ):
+            writer.writerow( result )
+            f.flush()
+            if result["status"] != "done":
+                failed += 1
+            print("  [%d/%d] %s %s  " % (k+1, len(jobs), result["name"], result["status"]))
+
+    print("  %d of %d movies done, summary in %s  " % (total-failed, total, summary))
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+from __future__ import print_function
+import argparse
+import hashlib
+import json
+import numpy as np
+import os
+import subprocess
+import sys
+import time
+import SimpleITK as sitk
+
+from Step1 import *
+from Step2 import *
+from Step3 import *
+from Step4 import *
+from Step5 import *
+from Profiling import Report
+
+'''
+Benchmark of the pipeline on synthetic movies.
+
+A synthetic movie has a bright elliptic head with a sinusoidal flagellum, on top of a
+nonuniform illumination gradient, with noise and a few stains. For every combination of
+frame size, number of frames and threshold radius, Steps 1-5 are run and timed, and the
+segmentation is summarized by checksums of the Step 3 mask and of the Step 4 head and
+flagellum pixels. The results can be saved as a baseline; a later run compared with the
+baseline reports the steps that became slower and any change of the segmentation.
+With --startup, the time to start SpermSegReg.py and to import each step in a fresh
+interpreter is measured as well, so that slower imports show up as regressions too.
+
+Example:
+    python Benchmark.py -o ../Benchmark/ -s 160x120 640x480 -f 20 -tr 2 3 -sb baseline.json
+    python Benchmark.py -o ../Benchmark/ -s 160x120 640x480 -f 20 -tr 2 3 -cb baseline.json
+'''
+
+
+'''
+Inputs:
+    (1) n1, n2 = width and height of a frame
+    (2) n3 = number of frames
+    (3) seed = integer, seed of the random noise
+Outputs:
+    (1) movie = ITK image of type uint16
+    (2) truth = numpy array of shape (n3,n2,n1), 2 on the head, 1 on the flagellum, 0 elsewhere
+    (3) stain = numpy array with 4 columns, regions of stains, [xmin, xmax, ymin, ymax]
+'''
+
+def SyntheticMovie( n1, n2, n3, seed=0 ):
+    rng = np.random.RandomState( seed )
+    y,x = np.mgrid[0:n2,0:n1].astype(float)
+
+    # Nonuniform illumination.
+    background = 400 + 300*x/n1 + 200*y/n2 + 100*np.exp( -((x-0.7*n1)**2+(y-0.3*n2)**2)/(0.1*n1*n1) )
+
+    # Stains: small dark blobs away from the sperm.
+    stain = []
+    blobs = np.zeros( (n2,n1) )
+    for (sx,sy) in [ (0.1,0.15), (0.85,0.8), (0.9,0.2) ]:
+        cx, cy, r = int(sx*n1), int(sy*n2), max(2, n1//64)
+        blobs -= 150*( (x-cx)**2 + (y-cy)**2 <= r*r )
+        stain.append( [cx-2*r, cx+2*r+1, cy-2*r, cy+2*r+1] )
+    stain = np.clip( np.array(stain), 0, None )
+
+    # Size of the sperm.
+    a = n1/18.0
+    b = n1/32.0
+    length = 0.45*n1
+    amplitude = n2/20.0
+    width = max( 1, n1//160 )
+
+    movie = np.zeros( (n3,n2,n1), dtype=np.uint16 )
+    truth = np.zeros( (n3,n2,n1), dtype=np.uint8 )
+    for k in range(n3):
+        # The head moves to the right, the flagellum beats behind it.
+        cx = 0.25*n1 + 0.15*n1*k/max(1,n3-1)
+        cy = 0.5*n2 + 0.03*n2*np.sin( 2*np.pi*k/20.0 )
+        head = ((x-cx)/a)**2 + ((y-cy)/b)**2 <= 1
+        flagellum = np.zeros( (n2,n1), dtype=bool )
+        for t in np.arange( 0, length, 0.5 ):
+            fx = int( round( cx + a + t ) )
+            fy = int( round( cy + amplitude*np.sin( 2*np.pi*(t/(0.7*length) + k/12.0) ) ) )
+            if 0 <= fx < n1:
+                flagellum[ max(fy-width,0):fy+width, fx ] = True
+        flagellum &= ~head
+        truth[k][flagellum] = 1
+        truth[k][head] = 2
+
+        frame = background + blobs + 800*head + 600*flagellum + rng.normal( 0, 30, (n2,n1) )
+        movie[k,:,:] = np.clip( frame, 0, 65535 ).astype(np.uint16)
+
+    return sitk.GetImageFromArray( movie ), truth, stain
+
+
+'''
+Inputs:
+    (1) mask = numpy array
+    (2) sperm = dictionary returned by DetectingSpermBody
+Outputs:
+    (1) checksums of the Step 3 mask and of the Step 4 result
+'''
+
+def MaskChecksum( mask ):
+    return hashlib.sha1( np.ascontiguousarray( mask == 1 ).tobytes() ).hexdigest()
+
+def SpermChecksum( sperm ):
+    sha = hashlib.sha1()
+    sha.update( repr( list(sperm["frames"]) ).encode("utf-8") )
+    for k in sperm["frames"]:
+        sha.update( np.ascontiguousarray( sperm["head"][k], dtype=np.float64 ).tobytes() )
+        sha.update( np.ascontiguousarray( sperm["flagellum"][k], dtype=np.float64 ).tobytes() )
+    return sha.hexdigest()
+
+
+'''
+Inputs:
+    (1) outputpath = output path of the movies of the benchmark
+    (2) n1, n2, n3 = size of the synthetic movie
+    (3) radius = threshold radius
+    (4) args = parsed arguments of the benchmark
+Output:
+    (1) result = dictionary with the times of the steps and the checksums of the segmentation
+'''
+
+def RunCase( outputpath, n1, n2, n3, radius, args ):
+    if not os.path.isdir( outputpath ):
+        os.makedirs( outputpath )
+    movie, truth, stain = SyntheticMovie( n1, n2, n3, args.seed )
+    report = Report( outputpath )
+
+    movie = report.Run( "PreProcessing", PreProcessing,
+                        [ movie, outputpath, "volume", args.workers, None,
+                          args.background, args.background_factor ], n3 )
+    movie = report.Run( "Blurring", Blurring,
+                        [ movie, outputpath, args.median_filter_radius, "volume", args.workers ], n3 )
+    movie = report.Run( "Thresholding", Thresholding,
+                        [ movie, outputpath, radius, args.threshold_value, stain, "integral",
+                          args.workers ], n3 )
+    mask = sitk.GetArrayFromImage( movie )
+    movie, sperm = report.Run( "DetectingSpermBody", DetectingSpermBody,
+                               [ movie, outputpath, 0.005, 0.1625, 2.75, 80, 0.25, 135,
+                                 args.workers ], n3 )
+    report.Run( "Summary", Summary, [ movie, outputpath, sperm ], n3 )
+    report.Write()
+
+    # Fraction of the true sperm pixels which are found by Step 3.
+    recall = float( np.sum( (mask == 1) & (truth > 0) ) ) / max( 1, np.sum( truth > 0 ) )
+
+    result = {}
+    result["times"] = dict( [ (entry["step"], entry["wall_time"]) for entry in report.steps ] )
+    result["mask_checksum"] = MaskChecksum( mask )
+    result["sperm_checksum"] = SpermChecksum( sperm )
+    result["good_frames"] = len( sperm["frames"] )
+    result["recall"] = recall
+    return result
+
+
+'''
+Input:
+    (1) repeat = integer, number of fresh interpreters per measurement; the fastest one counts
+Output:
+    (1) times = dictionary, time (unit: second) to import each module, and to print the help
+        of SpermSegReg.py from the start of the interpreter
+'''
+
+def StartupTimes( repeat ):
+    code = os.path.dirname( os.path.abspath( __file__ ) )
+    times = {}
+    for module in [ "SpermSegReg", "Step1", "Step2", "Step3", "Step4", "Step5", "Streaming" ]:
+        script = ( "import time; t = time.time(); import %s; print(time.time() - t)" % module )
+        times[ "import "+module ] = min( [ float( subprocess.check_output(
+            [ sys.executable, "-c", script ], cwd=code ).decode().split()[-1] )
+            for r in range(repeat) ] )
+    elapsed = []
+    for r in range(repeat):
+        start = time.time()
+        subprocess.check_output( [ sys.executable, "SpermSegReg.py", "-h" ], cwd=code )
+        elapsed.append( time.time() - start )
+    times[ "SpermSegReg.py -h" ] = min( elapsed )
+    return times
+
+
+'''
+Inputs:
+    (1) results = output of the benchmark
+    (2) baseline = output of an earlier run of the benchmark
+    (3) tolerance = float, a step is slower if it takes more than (1+tolerance) times the baseline
+Output:
+    (1) problems = list of strings, empty if there is no regression
+'''
+
+def CompareWithBaseline( results, baseline, tolerance ):
+    problems = []
+    for case in sorted( results ):
+        if case not in baseline:
+            continue
+        new, old = results[case], baseline[case]
+        for key in [ "mask_checksum", "sperm_checksum" ]:
+            if key in new and new[key] != old.get(key):
+                problems.append( "%s: %s changed" % (case, key) )
+        for step in sorted( new["times"] ):
+            if step in old["times"] and new["times"][step] > (1+tolerance)*old["times"][step]:
+                problems.append( "%s: %s took %.3fs (baseline %.3fs)"
+                                 % (case, step, new["times"][step], old["times"][step]) )
+    return problems
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Benchmark of SpermSegReg on synthetic movies")
+    parser.add_argument('-o', '--output_path', type=str, required=True,
+                        help='The output path.')
+    parser.add_argument('-s', '--sizes', type=str, nargs='*', default=['160x120'],
+                        help='Frame sizes, in the format WIDTHxHEIGHT; none to measure the startup only.')
+    parser.add_argument('-f', '--frames', type=int, nargs='+', default=[20],
+                        help='Numbers of frames.')
+    parser.add_argument('-tr', '--threshold_radius', type=int, nargs='+', default=[2],
+                        help='Neighborhood radii of the threshold algorithm.')
+    parser.add_argument('-tv', '--threshold_value', type=int, default=10,
+                        help='Threshold value of the threshold algorithm.')
+    parser.add_argument('-mf', '--median_filter_radius', type=int, default=1,
+                        help='Neighborhood radius of the median filter.')
+    parser.add_argument('-bg', '--background', type=str, default='ball',
+                        choices=['ball','box','decimated'],
+                        help='Background estimator of step 1, see SpermSegReg.py.')
+    parser.add_argument('-bf', '--background_factor', type=int, default=4,
+                        help='Shrink factor of the decimated background.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes sharing the frames in steps 1-4.')
+    parser.add_argument('-su', '--startup', type=int, default=0,
+                        help='Also measure the startup and import times, taking the fastest of this'
+                        ' many fresh interpreters.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the noise of the synthetic movies.')
+    parser.add_argument('-sb', '--save_baseline', type=str, default=None,
+                        help='Save the results as a baseline in this file.')
+    parser.add_argument('-cb', '--compare_baseline', type=str, default=None,
+                        help='Compare the results with the baseline in this file.')
+    parser.add_argument('-tol', '--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown of a step compared with the baseline.')
+    args = parser.parse_args()
+
+    # Run every case. #
+    results = {}
+    for size in args.sizes:
+        n1,n2 = [ int(n) for n in size.lower().split("x") ]
+        for n3 in args.frames:
+            for radius in args.threshold_radius:
+                case = "%dx%dx%d_tr%d" % (n1,n2,n3,radius)
+                print("Case %s" % case)
+                results[case] = RunCase( os.path.join(args.output_path, case, ""),
+                                         n1, n2, n3, radius, args )
+                times = results[case]["times"]
+                print("  " + ", ".join( [ "%s %.3fs" % (step, times[step]) for step in sorted(times) ] ))
+                print("  good frames %d/%d, recall %.3f"
+                      % (results[case]["good_frames"], n3, results[case]["recall"]))
+
+    if args.startup > 0:
+        results["startup"] = { "times": StartupTimes( args.startup ) }
+        times = results["startup"]["times"]
+        print("Startup")
+        print("  " + ", ".join( [ "%s %.3fs" % (step, times[step]) for step in sorted(times) ] ))
+
+    if not os.path.isdir( args.output_path ):
+        os.makedirs( args.output_path )
+    with open( os.path.join(args.output_path, "BenchmarkResults.json"), "w" ) as f:
+        json.dump( results, f, indent=2, sort_keys=True )
+
+    # Save or compare the baseline. #
+    if args.save_baseline:
+        with open( args.save_baseline, "w" ) as f:
+            json.dump( results, f, indent=2, sort_keys=True )
+    if args.compare_baseline:
+        with open( args.compare_baseline ) as f:
+            baseline = json.load( f )
+        problems = CompareWithBaseline( results, baseline, args.tolerance )
+        for problem in problems:
+            print("REGRESSION " + problem)
+        if problems:
+            raise SystemExit(1)
+        print("No regression compared with %s" % args.compare_baseline)
+
+    return
+
+if __name__ == '__main__':
+    main()
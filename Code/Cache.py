@@ -0,0 +1,135 @@
+from __future__ import print_function
+import hashlib
+import os
+import shutil
+import time
+
+'''
+Content-addressed cache of the intermediate movies of Steps 1-3.
+
+The key of a step is the hash of the input movie together with the parameters of every
+step from the starting step up to this step. A rerun with the same input and parameters
+finds the deepest cached step and starts right after it, e.g. a sweep over the
+parameters of Step 4 runs Steps 1-3 only once. Entries are .mha files named by their key.
+'''
+
+StepFiles = { 1: "SpermStep1_CorrectingIllumination.mha",
+              2: "SpermStep2_Blurring.mha",
+              3: "SpermStep3_Thresholding.mha" }
+
+
+'''
+Input:
+    (1) filename = name of a file
+Output:
+    (1) h = string, SHA-1 hash of the content of the file
+'''
+
+def FileHash( filename ):
+    sha = hashlib.sha1()
+    with open( filename, "rb" ) as f:
+        block = f.read( 1 << 20 )
+        while block:
+            sha.update( block )
+            block = f.read( 1 << 20 )
+    return sha.hexdigest()
+
+
+'''
+Inputs:
+    (1) inputhash = string, hash of the input movie
+    (2) startingstep = integer, the step that the input movie is fed to
+    (3) params = dictionary, params[s] = tuple of the parameters of step s, s = 1,2,3
+Output:
+    (1) keys = dictionary, keys[s] = key of the output of step s, s = startingstep,...,3
+'''
+
+def StepKeys( inputhash, startingstep, params ):
+    keys = {}
+    key = inputhash
+    for s in range( startingstep, 4 ):
+        key = hashlib.sha1( repr( (key, s, params[s]) ).encode("utf-8") ).hexdigest()
+        keys[s] = key
+    return keys
+
+
+'''
+Inputs:
+    (1) cachedir = cache directory
+    (2) keys = output of StepKeys
+Output:
+    (1) (s, filename) of the deepest step whose output is in the cache, (None, None) if none
+'''
+
+def LookUp( cachedir, keys ):
+    for s in sorted( keys, reverse=True ):
+        filename = os.path.join( cachedir, keys[s]+".mha" )
+        if os.path.isfile( filename ):
+            # Mark the entry as recently used.
+            os.utime( filename, None )
+            return s, filename
+    return None, None
+
+
+'''
+Inputs:
+    (1) cachedir = cache directory
+    (2) key = key of the entry
+    (3) filename = the file to be stored
+'''
+
+def Store( cachedir, key, filename ):
+    if not os.path.isdir( cachedir ):
+        os.makedirs( cachedir )
+    entry = os.path.join( cachedir, key+".mha" )
+    # Copy to a temporary name first, so that an interrupted copy is never a valid entry.
+    shutil.copyfile( filename, entry+".part" )
+    os.rename( entry+".part", entry )
+
+
+'''
+Inputs:
+    (1) cachedir = cache directory
+    (2) maxsize = float, largest total size of the cache in MB; None for no limit
+    (3) maxage = float, entries not used for more than maxage days are removed; None for no limit
+
+Note: Entries are removed from the least recently used one until both limits hold.
+'''
+
+def Evict( cachedir, maxsize=None, maxage=None ):
+    if not os.path.isdir( cachedir ):
+        return
+    entries = []
+    for name in os.listdir( cachedir ):
+        if name.endswith( ".mha" ):
+            path = os.path.join( cachedir, name )
+            stat = os.stat( path )
+            entries.append( (stat.st_mtime, stat.st_size, path) )
+    entries.sort()
+
+    total = sum( [ e[1] for e in entries ] )
+    now = time.time()
+    for mtime, size, path in entries:
+        tooold = maxage is not None and now-mtime > maxage*86400
+        toobig = maxsize is not None and total > maxsize*(1 << 20)
+        if not ( tooold or toobig ):
+            break
+        os.remove( path )
+        total -= size
+
+
+'''
+Inputs:
+    (1) cachedir = cache directory
+    (2) keys = output of StepKeys
+    (3) laststep = integer, the deepest cached step found by LookUp
+    (4) outputpath = output path
+Output:
+    (1) the cached outputs of the skipped steps copied to the output path under their usual names
+'''
+
+def Restore( cachedir, keys, laststep, outputpath ):
+    for s in sorted( keys ):
+        entry = os.path.join( cachedir, keys[s]+".mha" )
+        if s <= laststep and os.path.isfile( entry ):
+            shutil.copyfile( entry, outputpath+StepFiles[s] )
@@ -0,0 +1,129 @@
+from __future__ import print_function
+import glob
+import json
+import os
+import numpy as np
+
+from SpermTable import ToColumns, SaveColumns, SpermTable
+from Step4 import SpermDictionary
+
+'''
+Progress journal of the streaming pipeline.
+
+The output files of the steps are written frame by frame (see MetaImageAppender). Every few
+frames the results of Step 4 since the last checkpoint are saved as
+SpermCheckpoint_<first frame>.npz, in the columnar layout of SpermTable.py, and
+SpermJournal.json records the number of frames done together with the settings of the run.
+A resumed run with the same settings keeps those frames of every output file and continues
+with the next frame; if frames were appended to the input movie since, only the new frames
+are processed.
+'''
+
+JournalName = "SpermJournal.json"
+
+
+'''
+Inputs:
+    (1) outputpath = output path
+    (2) settings = list of the parameters of the run, which have to match for a resume
+    (3) size = (n1,n2,n3), size of the input movie
+'''
+
+class Journal(object):
+
+    def __init__( self, outputpath, settings, size ):
+        self.outputpath = outputpath
+        # Compare the settings the way they are read back from the journal.
+        self.settings = json.loads( json.dumps( settings ) )
+        self.size = tuple(size)
+        self.done = 0
+        self.chunks = []
+        self.intensity = None
+
+    '''
+    Output:
+        (1) done = integer, number of frames done by an earlier run with the same settings,
+                0 if there is none
+    '''
+
+    def Resume( self ):
+        filename = self.outputpath+JournalName
+        if not os.path.isfile( filename ):
+            return self.Start()
+        with open( filename ) as f:
+            journal = json.load( f )
+        n1,n2,n3 = self.size
+        if ( journal["settings"] != self.settings or journal["size"][:2] != [n1,n2]
+             or journal["done"] > n3 ):
+            print("  The journal does not match the settings or the movie, starting over ...  ")
+            return self.Start()
+        self.done = journal["done"]
+        self.chunks = journal["chunks"]
+        self.intensity = journal["intensity"]
+        return self.done
+
+    '''
+    Output:
+        (1) done = 0, the checkpoints of an earlier run are removed
+    '''
+
+    def Start( self ):
+        for filename in glob.glob( self.outputpath+"SpermCheckpoint_*.npz" ):
+            os.remove( filename )
+        self.done = 0
+        self.chunks = []
+        return self.done
+
+    '''
+    Inputs:
+        (1) done = integer, number of frames done
+        (2) results = list, the output of AnalyzeFrame for the frames self.done,...,done-1
+        (3) dt, scale = see DetectingSpermBody
+    '''
+
+    def Checkpoint( self, done, results, dt, scale ):
+        n1,n2,n3 = self.size
+        name = "SpermCheckpoint_%06d.npz" % self.done
+        SaveColumns( self.outputpath+name,
+                     ToColumns( SpermDictionary( results, dt, scale, n1, n2 ) ) )
+        self.chunks.append( name )
+        self.done = done
+
+        journal = { "settings": self.settings,
+                    "size": list(self.size),
+                    "done": self.done,
+                    "chunks": self.chunks,
+                    "intensity": self.intensity }
+        # Replace the journal in one step, so that a crash leaves the old or the new one.
+        filename = self.outputpath+JournalName
+        with open( filename+".tmp", "w" ) as f:
+            json.dump( journal, f, indent=1 )
+        try:
+            os.replace( filename+".tmp", filename )
+        except AttributeError:
+            # Python 2
+            if os.path.exists( filename ):
+                os.remove( filename )
+            os.rename( filename+".tmp", filename )
+
+    '''
+    Output:
+        (1) results = list of length self.done, the output of AnalyzeFrame for each frame done
+    '''
+
+    def Results( self ):
+        results = []
+        for name in self.chunks:
+            table = SpermTable( self.outputpath+name )
+            good = table["good"]
+            for k in range( len(table) ):
+                if good[k]:
+                    results.append( ( table.Pixels( "body", k ).astype(np.float64),
+                                      table.Pixels( "flagellum", k ).astype(np.float64),
+                                      table.Pixels( "head", k ).astype(np.float64),
+                                      int( table["horizontality"][k] ),
+                                      int( table["orientation"][k] ) ) )
+                else:
+                    results.append( None )
+            ''' end of for loop on k '''
+        return results[:self.done]
@@ -0,0 +1,616 @@
+from __future__ import print_function
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+'''
+Engines of the image filters of Steps 1-3 and of the connected components of -mu.
+
+Each operation has an implementation with SimpleITK ("itk") and one with SciPy/NumPy ("scipy"),
+which give identical results:
+    - "rescale": the intensity windowing of Step 1 to [0,255], truncated as ITK does
+    - "opening": the grayscale opening of Step 1, with the ball of ITK (the pixels with
+                 (x/(r1+0.5))^2+(y/(r2+0.5))^2 <= 1) or a box; pixels outside the frame are
+                 ignored by the erosion and the dilation, as in ITK
+    - "median": the median filter of Step 2; the frame is extended by its border pixels
+    - "difference": the box means of Step 3, from a summed-area table with NumPy
+                    (NeighborDifference) or from BoxMean with ITK
+    - "components": the 8-connected components of a mask in MultiSperm.py, numbered by
+                    decreasing size as RelabelComponentImageFilter does
+An engines dictionary maps each operation to its engine; a missing operation takes the engine
+of Default, the one of the earlier versions. SimpleITK and SciPy are only imported by the
+operations which use them, so a worker with SciPy only can run the "scipy" engine.
+
+With "auto", each engine of each operation of Steps 1-3 is timed on a frame of the size of the movie and
+the faster one is taken. The timings can be kept in a table file, so that a frame size is
+only timed once.
+
+Example:
+    python Engines.py -c -s 160x120 640x480
+    python Engines.py -b -s 160x120 640x480 -mf 1 -tr 2 -et ../Movie/engines.json
+'''
+
+Operations = [ "rescale", "opening", "median", "difference", "components" ]
+EngineNames = [ "itk", "scipy" ]
+Default = { "rescale": "itk", "opening": "itk", "median": "itk", "difference": "scipy",
+            "components": "itk" }
+Steps = { "rescale": 1, "opening": 1, "median": 2, "difference": 3, "components": 4 }
+
+
+'''
+Inputs:
+    (1) engines = dictionary {operation: engine}, or None for Default
+    (2) operation = string, one of Operations
+Output:
+    (1) engine = string, the engine of the operation
+'''
+
+def Engine( engines, operation ):
+    if engines and operation in engines:
+        return engines[operation]
+    return Default[operation]
+
+
+'''
+Input:
+    (1) engine = string, "itk" or "scipy"
+Output:
+    (1) True if the library of the engine can be imported
+'''
+
+def Available( engine ):
+    try:
+        if engine == "itk":
+            import SimpleITK
+        else:
+            import scipy.ndimage
+    except ImportError:
+        return False
+    return True
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), frames of the movie
+    (2) intensity = (lo,hi), minimum and maximum of the whole movie
+    (3) engine = string, "itk" (default) or "scipy"
+Output:
+    (1) frames = numpy array of shape (m,n2,n1) and of the same type, rescaled so that lo
+            becomes 0 and hi becomes 255
+
+Note: IntensityWindowingImageFilter does not change pixel type, and with the minimum and
+      maximum of the movie it gives the same result as RescaleIntensityImageFilter on the
+      whole movie. It computes x*scale+shift in double and truncates.
+'''
+
+def Rescale( frames, intensity, engine="itk" ):
+    lo,hi = intensity
+    if engine == "itk":
+        import SimpleITK as sitk
+        imadjust = sitk.IntensityWindowingImageFilter()
+        imadjust.SetWindowMinimum( lo )
+        imadjust.SetWindowMaximum( hi )
+        imadjust.SetOutputMinimum( 0 )
+        imadjust.SetOutputMaximum( 255 )
+        return sitk.GetArrayFromImage( imadjust.Execute( sitk.GetImageFromArray( frames ) ) )
+    elif engine != "scipy":
+        raise ValueError("Unknown engine: %s" % engine)
+    if hi > lo:
+        scale = 255.0 / ( hi - lo )
+    else:
+        scale = 0.0
+    shift = 0.0 - lo * scale
+    A = np.clip( frames * scale + shift, 0, 255 )
+    A[ frames <= lo ] = 0
+    A[ frames >= hi ] = 255
+    return A.astype( frames.dtype )
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) radius = (r1,r2), radius of the structuring element along x and y
+    (3) kernel = string, "ball" (default) or "box"
+    (4) method = string, "volume" (default) or "frame", see PreProcessing; only used by "itk"
+    (5) engine = string, "itk" (default) or "scipy"
+Output:
+    (1) B = numpy array of shape (m,n2,n1) and of the same type, the grayscale opening of each
+            frame, the background
+'''
+
+def Opening( frames, radius, kernel="ball", method="volume", engine="itk" ):
+    if kernel not in ( "ball", "box" ):
+        raise ValueError("Unknown background estimator: %s" % kernel)
+    if method not in ( "volume", "frame" ):
+        raise ValueError("Unknown filtering method: %s" % method)
+    radius = tuple( [ int(r) for r in radius ] )
+
+    if engine == "scipy":
+        from scipy import ndimage
+        if kernel == "ball":
+            footprint = BallFootprint( radius )[np.newaxis,:,:]
+            size = None
+        else:
+            footprint = None
+            size = ( 1, 2*radius[1]+1, 2*radius[0]+1 )
+        if np.issubdtype( frames.dtype, np.integer ):
+            top = np.iinfo( frames.dtype ).max
+            bottom = np.iinfo( frames.dtype ).min
+        else:
+            top, bottom = np.inf, -np.inf
+        # Pixels outside the frame are the largest value for the erosion, the smallest
+        # one for the dilation, so that they never win.
+        A = ndimage.grey_erosion( frames, size=size, footprint=footprint, mode="constant",
+                                  cval=top )
+        return ndimage.grey_dilation( A, size=size, footprint=footprint, mode="constant",
+                                      cval=bottom )
+    elif engine != "itk":
+        raise ValueError("Unknown engine: %s" % engine)
+
+    import SimpleITK as sitk
+    if kernel == "box":
+        # ITK decomposes a box into lines, which fails on a volume of a single frame,
+        # so filter the frames one by one (same result as the 3D box of zero depth).
+        method = "frame"
+    movie = sitk.GetImageFromArray( frames )
+    m = frames.shape[0]
+    if method == "volume":
+        # A zero radius along the 3rd axis keeps the frames independent.
+        radius = radius + (0,)
+    # Define grayscale erosion.
+    imerode = sitk.GrayscaleErodeImageFilter()
+    imerode.SetKernelType( sitk.sitkBall if kernel == "ball" else sitk.sitkBox )
+    imerode.SetKernelRadius( radius )
+    # Define grayscale dilation.
+    imdilate = sitk.GrayscaleDilateImageFilter()
+    imdilate.SetKernelType( sitk.sitkBall if kernel == "ball" else sitk.sitkBox )
+    imdilate.SetKernelRadius( radius )
+
+    if method == "volume":
+        return sitk.GetArrayFromImage( imdilate.Execute( imerode.Execute( movie ) ) )
+    B = np.zeros( frames.shape, dtype=frames.dtype )
+    for ii in range(m):
+        B[ii,:,:] = sitk.GetArrayFromImage( imdilate.Execute( imerode.Execute( movie[:,:,ii] ) ) )
+    return B
+
+
+'''
+Input:
+    (1) radius = (r1,r2), radius along x and y
+Output:
+    (1) footprint = boolean array of shape (2*r2+1,2*r1+1), the ball of ITK
+'''
+
+def BallFootprint( radius ):
+    r1,r2 = radius
+    y,x = np.mgrid[ -r2:r2+1, -r1:r1+1 ]
+    return ( x/(r1+0.5) )**2 + ( y/(r2+0.5) )**2 <= 1
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) radius = integer, radius of the median filter
+    (3) method = string, "volume" (default) or "frame", see Blurring; only used by "itk"
+    (4) engine = string, "itk" (default) or "scipy"
+Output:
+    (1) newFrames = numpy array of shape (m,n2,n1) and type uint16, the filtered frames
+'''
+
+def Median( frames, radius, method="volume", engine="itk" ):
+    if method not in ( "volume", "frame" ):
+        raise ValueError("Unknown filtering method: %s" % method)
+    if engine == "scipy":
+        from scipy import ndimage
+        # ITK extends the frame by its border pixels.
+        return ndimage.median_filter( frames, size=(1,2*radius+1,2*radius+1),
+                                      mode="nearest" ).astype(np.uint16)
+    elif engine != "itk":
+        raise ValueError("Unknown engine: %s" % engine)
+
+    import SimpleITK as sitk
+    movie = sitk.GetImageFromArray( frames )
+    m = frames.shape[0]
+    medfilt2 = sitk.MedianImageFilter()
+    if method == "volume":
+        # A zero radius along the 3rd axis keeps the frames independent.
+        medfilt2.SetRadius( (radius,radius,0) )
+        return sitk.GetArrayFromImage( medfilt2.Execute( movie ) ).astype(np.uint16)
+    medfilt2.SetRadius( radius )
+    newFrames = np.zeros( frames.shape, dtype=np.uint16 )
+    for ii in range(m):
+        newFrames[ii,:,:] = sitk.GetArrayFromImage( medfilt2.Execute( movie[:,:,ii] ) )
+    return newFrames
+
+
+'''
+Inputs:
+    (1) A = 2D boolean numpy array, the mask of one frame
+    (2) minsize = integer, components with fewer pixels are dropped
+    (3) engine = string, "itk" (default) or "scipy"
+Outputs:
+    (1) label = 2D numpy array of type int64, 0 on the background and on the dropped
+            components, 1,2,... on the others by decreasing size; components of the same size
+            keep the order of their first pixel in row-major order
+    (2) sizes = integer array, sizes[c] = number of pixels of label c+1
+'''
+
+def Labels( A, minsize, engine="itk" ):
+    if engine == "scipy":
+        from scipy import ndimage
+        label, n = ndimage.label( A, structure=np.ones( (3,3), dtype=int ) )
+        sizes = np.bincount( label.ravel(), minlength=n+1 )[1:]
+        # A stable sort keeps the ties in the order of ndimage.label, which is the one of ITK.
+        order = np.argsort( -sizes, kind="mergesort" )
+        order = order[ sizes[order] >= minsize ]
+        relabel = np.zeros( n+1, dtype=np.int64 )
+        relabel[ order+1 ] = np.arange( 1, len(order)+1 )
+        return relabel[label], sizes[order].astype(np.int64)
+    elif engine != "itk":
+        raise ValueError("Unknown engine: %s" % engine)
+
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray( np.asarray(A).astype(np.uint8) )
+    connected = sitk.ConnectedComponentImageFilter()
+    connected.SetFullyConnected( True )
+    relabel = sitk.RelabelComponentImageFilter()
+    relabel.SetMinimumObjectSize( minsize )
+    label = sitk.GetArrayFromImage( relabel.Execute( connected.Execute( image ) ) )
+    return label.astype(np.int64), np.array( relabel.GetSizeOfObjectsInPixels(), dtype=np.int64 )
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the movie
+    (2) radius = integer, radius of the squares
+Output:
+    (1) M = 2D numpy array of type float64, M[i,j] = mean of the square of radius radius
+            centered at (i,j), cut off at the border of the frame
+
+Note: BoxMean computes the sums in double, which are exact for the pixel values of a movie,
+      so M is the same as the one of BoxMean in Step3.py. ITK only.
+'''
+
+def BoxMeans( A, radius ):
+    import SimpleITK as sitk
+    image = sitk.Cast( sitk.GetImageFromArray( np.ascontiguousarray(A) ), sitk.sitkFloat64 )
+    return sitk.GetArrayFromImage( sitk.BoxMean( image, (radius,radius) ) )
+
+
+'''
+Inputs:
+    (1) operation = string, one of Operations
+    (2) frames = numpy array of shape (m,n2,n1)
+    (3) params = tuple, the parameters of the operation
+            - "rescale": (lo,hi)
+            - "opening": (r1,r2,kernel)
+            - "median": (radius,)
+            - "difference": (radius,)
+            - "components": (minsize,), on the frames as masks
+    (4) engine = string, "itk" or "scipy"
+Output:
+    (1) the result of the operation, a list of one array per frame for "difference" and one
+        (label, sizes) pair per frame for "components", see Labels
+'''
+
+def RunOperation( operation, frames, params, engine ):
+    if operation == "rescale":
+        return Rescale( frames, params, engine )
+    elif operation == "opening":
+        return Opening( frames, params[:2], params[2], "volume", engine )
+    elif operation == "median":
+        return Median( frames, params[0], "volume", engine )
+    elif operation == "difference":
+        from Step3 import NeighborDifference
+        return [ NeighborDifference( frames[k,:,:], params[0], engine )[2]
+                 for k in range( frames.shape[0] ) ]
+    elif operation == "components":
+        return [ Labels( frames[k,:,:] > 0, params[0], engine )
+                 for k in range( frames.shape[0] ) ]
+    raise ValueError("Unknown operation: %s" % operation)
+
+
+'''
+Inputs:
+    (1) size = (n1,n2), size of the frame of each step
+    (2) medfiltRadius = integer, radius of the median filter of Step 2
+    (3) thresholdRadius = integer, radius of the squares of Step 3
+    (4) background = string, see PreProcessing
+    (5) factor = integer, see PreProcessing
+Output:
+    (1) cases = list of (operation, (n1,n2), params), the operations of a run, see RunOperation
+'''
+
+def RunCases( size, medfiltRadius, thresholdRadius, background="ball", factor=4 ):
+    n1,n2 = size
+    radius = (n1//16, n2//16)
+    if background == "decimated":
+        # The opening runs on the frames shrunk by factor.
+        f = max( 1, int(factor) )
+        opening = ( ((n1+f-1)//f, (n2+f-1)//f),
+                    ( max(1, radius[0]//f), max(1, radius[1]//f), "ball" ) )
+    elif background == "box":
+        opening = ( (n1,n2), radius + ("box",) )
+    else:
+        opening = ( (n1,n2), radius + ("ball",) )
+    cases = [ ( "rescale", (n1,n2), (0.0, 4095.0) ),
+              ( "opening", ) + opening ]
+    if medfiltRadius is not None:
+        cases.append( ( "median", (n1,n2), (medfiltRadius,) ) )
+    if thresholdRadius is not None:
+        cases.append( ( "difference", (n1,n2), (thresholdRadius,) ) )
+    return cases
+
+
+'''
+Inputs:
+    (1) size = (n1,n2), size of the frames
+    (2) m = integer, number of frames
+    (3) seed = integer, seed of the random values
+Output:
+    (1) frames = numpy array of shape (m,n2,n1) and type uint16, smooth random frames in
+            [0,255] with a few flat regions, where the filters meet ties
+'''
+
+def TestFrames( size, m=2, seed=0 ):
+    n1,n2 = size
+    rng = np.random.RandomState( seed )
+    A = rng.randint( 0, 256, (m,n2,n1) ).astype(np.float64)
+    # Smooth along y and x with a moving average of 3 pixels.
+    A = ( A + np.roll( A, 1, axis=1 ) + np.roll( A, -1, axis=1 ) ) / 3
+    A = ( A + np.roll( A, 1, axis=2 ) + np.roll( A, -1, axis=2 ) ) / 3
+    A[ :, :n2//4, :n1//4 ] = 100
+    return A.astype(np.uint16)
+
+
+'''
+Inputs:
+    (1) operation = string, one of Operations
+    (2) size = (n1,n2), size of the frames
+    (3) m = integer, number of frames
+Output:
+    (1) frames = TestFrames, scaled to 12 bits for "rescale" and made into masks with many
+            small components, some of the same size, for "components"
+'''
+
+def CaseFrames( operation, size, m ):
+    frames = TestFrames( size, m )
+    if operation == "rescale":
+        return frames * 16
+    if operation == "components":
+        return ( frames > 140 ).astype(np.uint16)
+    return frames
+
+
+'''
+Inputs:
+    (1) case = (operation, (n1,n2), params), see RunCases
+    (2) m = integer, number of frames timed
+Output:
+    (1) times = dictionary {engine: time per frame (unit: second)} of the available engines
+'''
+
+def TimeEngines( case, m=1 ):
+    operation, size, params = case
+    frames = CaseFrames( operation, size, m )
+    times = {}
+    for engine in EngineNames:
+        if not Available( engine ):
+            continue
+        best = np.inf
+        # Repeat the fast operations, whose times are noisy.
+        repeat = 0
+        while repeat < 3:
+            start = time.time()
+            RunOperation( operation, frames, params, engine )
+            best = min( best, ( time.time() - start ) / m )
+            repeat += 1
+            if best > 0.1:
+                break
+        times[engine] = best
+    return times
+
+
+'''
+Input:
+    (1) case = (operation, (n1,n2), params), see RunCases
+Output:
+    (1) key = string, the key of the case in the table of timings
+'''
+
+def CaseKey( case ):
+    operation, size, params = case
+    return "%s %dx%d %s" % ( operation, size[0], size[1],
+                             " ".join( [ str(p) for p in params ] ) )
+
+
+'''
+Inputs:
+    (1) cases = output of RunCases
+    (2) table = dictionary {CaseKey: output of TimeEngines}, the timings of earlier runs;
+            the missing cases are timed and added
+Output:
+    (1) changed = True if a case was added to table
+'''
+
+def TimeCases( cases, table ):
+    changed = False
+    for case in cases:
+        key = CaseKey( case )
+        if key not in table:
+            print("  Timing the engines of %s ...  " % key)
+            table[key] = TimeEngines( case )
+            changed = True
+    ''' end of for loop on case '''
+    return changed
+
+
+'''
+Inputs:
+    (1) name = string, "default", "itk", "scipy" or "auto"
+    (2) cases = output of RunCases, only used by "auto"
+    (3) tablefile = name of a .json file with the timings of earlier runs, which is updated;
+            None to time the engines every run
+Output:
+    (1) engines = dictionary {operation: engine}
+'''
+
+def ChooseEngines( name, cases=(), tablefile=None ):
+    if name == "default":
+        return dict( Default )
+    if name in EngineNames:
+        return dict( [ (operation, name) for operation in Operations ] )
+    if name != "auto":
+        raise ValueError("Unknown engine: %s" % name)
+
+    table = LoadTable( tablefile )
+    if TimeCases( cases, table ):
+        SaveTable( tablefile, table )
+    engines = dict( Default )
+    for case in cases:
+        engines[ case[0] ] = Faster( table[ CaseKey(case) ] )
+    return engines
+
+
+'''
+Input:
+    (1) tablefile = name of a .json file written by ChooseEngines, or None
+Output:
+    (1) table = dictionary {CaseKey: output of TimeEngines}, empty if there is no file
+'''
+
+def LoadTable( tablefile ):
+    if tablefile and os.path.isfile( tablefile ):
+        with open( tablefile ) as f:
+            return json.load( f )
+    return {}
+
+
+'''
+Inputs:
+    (1) tablefile = name of the .json file, or None to keep the table in memory only
+    (2) table = see LoadTable
+'''
+
+def SaveTable( tablefile, table ):
+    if tablefile:
+        with open( tablefile, "w" ) as f:
+            json.dump( table, f, indent=1, sort_keys=True )
+
+
+'''
+Input:
+    (1) times = output of TimeEngines
+Output:
+    (1) engine = string, the faster engine; the first one in alphabetical order on a tie
+'''
+
+def Faster( times ):
+    return min( sorted(times), key=lambda engine: times[engine] )
+
+
+'''
+Inputs:
+    (1) sizes = list of (n1,n2), sizes of the frames
+    (2) medfiltRadii, thresholdRadii = lists of integers, radii of Steps 2 and 3
+    (3) m = integer, number of frames
+Output:
+    (1) failures = integer, number of cases where the engines differ
+'''
+
+def CheckEngines( sizes, medfiltRadii=(1,2), thresholdRadii=(0,1,2,3), m=2 ):
+    failures = 0
+    for size in sizes:
+        n1,n2 = size
+        cases = [ ( "rescale", size, (0.0, 4095.0) ), ( "rescale", size, (250.0, 3000.0) ) ]
+        for background in [ "ball", "box", "decimated" ]:
+            cases.append( RunCases( size, None, None, background )[1] )
+        cases += [ ( "median", size, (r,) ) for r in medfiltRadii ]
+        cases += [ ( "difference", size, (r,) ) for r in thresholdRadii ]
+        cases += [ ( "components", size, (n,) ) for n in (0,1,5,20) ]
+        for case in cases:
+            operation, casesize, params = case
+            if operation == "opening" and ( min( params[:2] ) < 1 or
+                                            2*params[0]+1 > casesize[0] or
+                                            2*params[1]+1 > casesize[1] ):
+                # ITK gives undefined pixels with a zero radius and mixes the frames of a
+                # volume when the kernel is larger than the frame, which never happens
+                # with the radius of PreProcessing.
+                print("  %-36s skipped" % CaseKey(case))
+                continue
+            frames = CaseFrames( operation, casesize, m )
+            results = [ RunOperation( operation, frames, params, engine )
+                        for engine in EngineNames ]
+            same = all( [ SameResult( a, b ) for a,b in zip( results[0], results[1] ) ] )
+            print("  %-36s %s" % ( CaseKey(case), "same" if same else "DIFFERENT" ))
+            if not same:
+                failures += 1
+        ''' end of for loop on case '''
+    return failures
+
+
+'''
+Inputs:
+    (1) a, b = results of the two engines for one frame, see RunOperation
+Output:
+    (1) True if a and b are the same, array by array for the (label, sizes) pairs of
+        "components"
+'''
+
+def SameResult( a, b ):
+    if isinstance( a, tuple ) and isinstance( b, tuple ):
+        return len(a) == len(b) and all( [ SameResult( x, y ) for x,y in zip( a, b ) ] )
+    # A frame too small for the squares has no difference (None).
+    if a is None or b is None:
+        return a is None and b is None
+    return np.array_equal( a, b, equal_nan=True )
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Engines of the image filters of Steps 1-3"
+                                      " and of the components of -mu")
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='Check that the engines give the same results.')
+    parser.add_argument('-b', '--benchmark', action='store_true',
+                        help='Time the engines of each operation and show the faster one.')
+    parser.add_argument('-s', '--sizes', type=str, nargs='+', default=['160x120'],
+                        help='Frame sizes, e.g. 160x120 640x480.')
+    parser.add_argument('-mf', '--median_filter_radius', type=int, default=1,
+                        help='Radius of the median filter of step 2.')
+    parser.add_argument('-tr', '--threshold_radius', type=int, default=2,
+                        help='Radius of the squares of step 3.')
+    parser.add_argument('-bg', '--background', type=str, default='ball',
+                        choices=['ball','box','decimated'],
+                        help='Background of step 1, see SpermSegReg.py.')
+    parser.add_argument('-bf', '--background_factor', type=int, default=4,
+                        help='Shrink factor of the decimated background.')
+    parser.add_argument('-et', '--engine_table', type=str, default=None,
+                        help='Keep the timings in this .json file, see -eg auto of SpermSegReg.py.')
+    args = parser.parse_args()
+
+    sizes = [ tuple( [ int(n) for n in s.split("x") ] ) for s in args.sizes ]
+    if args.check:
+        failures = CheckEngines( sizes )
+        print("  %d case(s) differ  " % failures)
+        if failures:
+            raise SystemExit(1)
+    if args.benchmark:
+        table = LoadTable( args.engine_table )
+        for size in sizes:
+            cases = RunCases( size, args.median_filter_radius, args.threshold_radius,
+                              args.background, args.background_factor )
+            TimeCases( cases, table )
+            for case in cases:
+                times = table[ CaseKey(case) ]
+                print("  %-36s %s -> %s" % ( CaseKey(case),
+                      ", ".join( [ "%s %.4f s" % (e, times[e]) for e in sorted(times) ] ),
+                      Faster( times ) ))
+            ''' end of for loop on case '''
+        SaveTable( args.engine_table, table )
+    return
+
+if __name__ == '__main__':
+    main()
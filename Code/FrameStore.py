@@ -0,0 +1,201 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+'''
+Memory-mapped storage of the movies of Steps 1-5.
+
+An uncompressed .mha file is a text header followed by the pixels, frame after frame, so the
+pixels can be mapped into memory with numpy.memmap. With the storage "memmap", a step writes
+each chunk of frames into its mapped output file as soon as the chunk is done, instead of
+converting the whole volume to an ITK image and writing it at the end, and hands the mapped
+file to the next step, which only reads the frames it is working on. A restart with -n maps
+the input file the same way. The files keep their names and are ordinary .mha files, which
+ITK-SNAP opens as before; an .mhd header with a separate .raw file is mapped as well.
+SimpleITK is only imported for ITK images, so mapped files with the "scipy" engine (see
+Engines.py) do not need it.
+'''
+
+ElementTypes = { np.dtype(np.uint8): "MET_UCHAR",
+                 np.dtype(np.int8): "MET_CHAR",
+                 np.dtype(np.uint16): "MET_USHORT",
+                 np.dtype(np.int16): "MET_SHORT",
+                 np.dtype(np.uint32): "MET_UINT",
+                 np.dtype(np.int32): "MET_INT",
+                 np.dtype(np.float32): "MET_FLOAT",
+                 np.dtype(np.float64): "MET_DOUBLE" }
+
+
+'''
+Inputs:
+    (1) size = (n1,n2,n3), size of the movie
+    (2) dtype = numpy type of the pixels
+Output:
+    (1) header = bytes, the header of an uncompressed .mha file, followed by the pixels
+
+Note: The number of frames is padded, so that the header keeps its length when it grows.
+'''
+
+def MetaImageHeader( size, dtype ):
+    header = [ "ObjectType = Image",
+               "NDims = 3",
+               "BinaryData = True",
+               "BinaryDataByteOrderMSB = False",
+               "CompressedData = False",
+               "TransformMatrix = 1 0 0 0 1 0 0 0 1",
+               "Offset = 0 0 0",
+               "CenterOfRotation = 0 0 0",
+               "AnatomicalOrientation = RAI",
+               "ElementSpacing = 1 1 1",
+               "DimSize = %d %d %-12d" % tuple(size),
+               "ElementType = %s" % ElementTypes[np.dtype(dtype)],
+               "ElementDataFile = LOCAL" ]
+    return ("\n".join(header)+"\n").encode("ascii")
+
+
+'''
+Input:
+    (1) movie = ITK image, or numpy array of shape (n3,n2,n1)
+Output:
+    (1) size = (n1,n2,n3), size of the movie
+'''
+
+def MovieSize( movie ):
+    if isinstance( movie, np.ndarray ):
+        n3,n2,n1 = movie.shape
+        return (n1,n2,n3)
+    return movie.GetSize()
+
+
+'''
+Input:
+    (1) movie = ITK image, or numpy array of shape (n3,n2,n1)
+Output:
+    (1) movie = numpy array of shape (n3,n2,n1); a numpy array (or a mapped file) is returned
+            as it is, without copying the pixels
+'''
+
+def MovieArray( movie ):
+    if isinstance( movie, np.ndarray ):
+        return movie
+    import SimpleITK as sitk
+    return sitk.GetArrayFromImage( movie )
+
+
+'''
+Inputs:
+    (1) filename = name of the movie
+    (2) storage = string, "itk" (default) or "memmap"
+            - "itk": read the whole movie into an ITK image
+            - "memmap": map the pixels of an uncompressed file, see MapMovie; any other file
+                        is read with ITK
+Output:
+    (1) movie = ITK image, or read-only numpy array of shape (n3,n2,n1)
+'''
+
+def OpenMovie( filename, storage="itk" ):
+    if storage == "memmap":
+        movie = MapMovie( filename )
+        if movie is not None:
+            return movie
+    import SimpleITK as sitk
+    imread = sitk.ImageFileReader()
+    imread.SetFileName( filename )
+    return imread.Execute()
+
+
+'''
+Inputs:
+    (1) filename = name of an .mha or .mhd file
+    (2) mode = string, mode of numpy.memmap, "r" (default) or "r+"
+Output:
+    (1) movie = numpy array of shape (n3,n2,n1) mapped onto the pixels of the file; None if
+            the pixels cannot be mapped (compressed, several channels, unknown type, ...)
+'''
+
+def MapMovie( filename, mode="r" ):
+    fields = {}
+    with open( filename, "rb" ) as f:
+        while True:
+            line = f.readline()
+            if not line or b"=" not in line:
+                return None
+            key, value = [ s.strip() for s in line.decode("ascii", "replace").split("=", 1) ]
+            fields[key] = value
+            if key == "ElementDataFile":
+                offset = f.tell()
+                break
+    types = dict( [ (name, dtype) for dtype,name in ElementTypes.items() ] )
+    if ( fields.get("CompressedData", "False") != "False"
+         or fields.get("ElementNumberOfChannels", "1") != "1"
+         or fields.get("ElementType") not in types ):
+        return None
+
+    size = [ int(n) for n in fields["DimSize"].split() ]
+    if len(size) == 2:
+        size.append( 1 )
+    if len(size) != 3:
+        return None
+    n1,n2,n3 = size
+    dtype = types[ fields["ElementType"] ]
+    if fields.get("BinaryDataByteOrderMSB", "False") == "True":
+        dtype = dtype.newbyteorder(">")
+    else:
+        dtype = dtype.newbyteorder("<")
+    datafile = fields["ElementDataFile"]
+    if datafile != "LOCAL":
+        # Pixels in a separate .raw file, next to the header.
+        if " " in datafile or datafile.startswith("LIST"):
+            return None
+        filename = os.path.join( os.path.dirname(filename), datafile )
+        offset = 0
+    if n1*n2*n3 == 0:
+        return np.zeros( (n3,n2,n1), dtype=dtype )
+    return np.memmap( filename, dtype=dtype, mode=mode, offset=offset, shape=(n3,n2,n1) )
+
+
+'''
+Inputs:
+    (1) filename = name of the output .mha file
+    (2) size = (n1,n2,n3), size of the movie
+    (3) dtype = numpy type of the pixels
+    (4) storage = string, "itk" (default) or "memmap", see OpenMovie
+Output:
+    (1) newMovie = numpy array of shape (n3,n2,n1) filled with zeros; with "memmap" it is
+            mapped onto filename, which is created right away
+'''
+
+def CreateMovie( filename, size, dtype, storage="itk" ):
+    n1,n2,n3 = size
+    if storage != "memmap" or n1*n2*n3 == 0:
+        return np.zeros( (n3,n2,n1), dtype=dtype )
+    dtype = np.dtype(dtype)
+    header = MetaImageHeader( size, dtype )
+    with open( filename, "wb" ) as f:
+        f.write( header )
+        # The pixels are zeros until they are written.
+        f.truncate( len(header) + n1*n2*n3*dtype.itemsize )
+    return np.memmap( filename, dtype=dtype.newbyteorder("<"), mode="r+", offset=len(header),
+                      shape=(n3,n2,n1) )
+
+
+'''
+Inputs:
+    (1) newMovie = output of CreateMovie, filled by the step
+    (2) filename = name of the output .mha file
+    (3) compress = boolean, write a compressed .mha file; a mapped file stays uncompressed
+Output:
+    (1) newMovie = ITK image, or the mapped file, read-only, for the next step
+'''
+
+def SaveMovie( newMovie, filename, compress=False ):
+    if isinstance( newMovie, np.memmap ):
+        newMovie.flush()
+        return MapMovie( filename )
+    import SimpleITK as sitk
+    newMovie = sitk.GetImageFromArray( newMovie )
+    imwrite = sitk.ImageFileWriter()
+    imwrite.SetFileName( filename )
+    imwrite.SetUseCompression( compress )
+    imwrite.Execute( newMovie )
+    return newMovie
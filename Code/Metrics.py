@@ -0,0 +1,343 @@
+from __future__ import print_function
+import argparse
+import csv
+import numpy as np
+
+from SpermTable import SpermTable
+
+'''
+Motility metrics of the segmented sperm.
+
+All frames are processed at once on the columnar layout of SpermTable.py, where the pixels of
+all frames are concatenated and the pixels of frame k are rows offsets[k]:offsets[k+1].
+
+    - Centerline of the flagellum: for each column u (or row, if the sperm swims vertically)
+      of the body beyond the head, the middle v between the lower and the upper curve; a
+      polynomial v(u) of the given degree is fitted to these points by least squares, all
+      frames at once, which smooths out the pixel steps.
+    - Curvature of the centerline: kappa = v''/(1+v'^2)^(3/2) of the polynomial; the length
+      of the flagellum, the mean and largest |kappa|, and the bending, the integral of
+      kappa^2 along the centerline (the bending energy for a unit bending stiffness).
+    - Velocity of the head: displacement of the center of the head between two consecutive
+      good frames over the time between them.
+    - Head centerline deviation: distance between the center of the head and the average path,
+      the moving average of the centers over pathwindow good frames.
+
+Lengths are in the unit of scale (per pixel), times in the unit of deltaT. The results are
+saved as SpermMetrics.npz, one value per frame (NaN for bad frames) together with the
+centerlines, and as SpermMetrics.csv without the centerlines.
+'''
+
+Columns = [ "frame", "good", "time", "head_y", "head_x", "velocity_y", "velocity_x", "speed",
+            "deviation", "flagellum_length", "curvature_mean", "curvature_max", "bending" ]
+
+
+'''
+Inputs:
+    (1) table = SpermTable, the results of Step 4
+    (2) outputpath = output path
+    (3) degree = integer, degree of the polynomial of the centerlines
+    (4) pathwindow = integer, number of good frames of the average path
+    (5) name = string, name of the output files; None to return the metrics only
+Outputs:
+    (1) metrics = dictionary of numpy arrays, the columns of SpermMetrics.npz
+    (2) <name>.npz and <name>.csv saved in the output path
+'''
+
+def MotilityMetrics( table, outputpath, degree=5, pathwindow=5, name="SpermMetrics" ):
+
+    n3 = len( table )
+    dt = float( table["deltaT"] )
+    scale = float( table["scale"] )
+    good = np.asarray( table["good"], dtype=bool )
+
+    if name is not None:
+        print("  Computing motility metrics ...  ")
+
+    '''
+    Centers of the heads, velocity and deviation from the average path.
+    '''
+    head_yx = HeadCenters( table["head"], table["head_offsets"] )
+    frames = np.flatnonzero( good & ~np.isnan( head_yx[:,0] ) )
+    velocity = np.full( (n3,2), np.nan )
+    if len(frames) > 1:
+        velocity[frames[1:]] = ( np.diff( head_yx[frames], axis=0 ) * scale
+                                 / ( np.diff( frames )[:,np.newaxis] * dt ) )
+    deviation = np.full( n3, np.nan )
+    if len(frames) > 0:
+        path = MovingAverage( head_yx[frames], pathwindow//2 )
+        deviation[frames] = np.sqrt( np.sum( (head_yx[frames]-path)**2, axis=1 ) ) * scale
+
+    '''
+    Centerlines and curvature of the flagella.
+    '''
+    centerline, offsets, kappa, ds = Centerlines( table, degree )
+    k = np.repeat( np.arange(n3), np.diff(offsets) )
+    inside = ~np.isnan( kappa )
+    # Convert to the unit of scale.
+    kappa = kappa / scale
+    ds = ds * scale
+    # Without any point, bincount returns integers, which cannot hold NaN.
+    length = np.bincount( k[inside], weights=ds[inside], minlength=n3 ).astype(float)
+    absk = np.where( inside, np.absolute(kappa), 0 )
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        curvature_mean = ( np.bincount( k, weights=absk*np.where(inside,ds,0), minlength=n3 )
+                           / length ).astype(float)
+    curvature_max = ReduceSegments( np.maximum, absk, offsets, np.nan ).astype(float)
+    bending = np.bincount( k, weights=np.where( inside, kappa**2*ds, 0 ),
+                           minlength=n3 ).astype(float)
+    measured = np.bincount( k[inside], minlength=n3 ) > 0
+    for column in ( length, curvature_mean, curvature_max, bending ):
+        column[~measured] = np.nan
+
+    '''
+    Put the columns together and write them out.
+    '''
+    metrics = {}
+    metrics["frame"] = np.arange( n3 )
+    metrics["good"] = good
+    metrics["time"] = np.arange( n3 ) * dt
+    metrics["head_y"] = head_yx[:,0]
+    metrics["head_x"] = head_yx[:,1]
+    metrics["velocity_y"] = velocity[:,0]
+    metrics["velocity_x"] = velocity[:,1]
+    metrics["speed"] = np.sqrt( np.sum( velocity**2, axis=1 ) )
+    metrics["deviation"] = deviation
+    metrics["flagellum_length"] = length
+    metrics["curvature_mean"] = curvature_mean
+    metrics["curvature_max"] = curvature_max
+    metrics["bending"] = bending
+    metrics["centerline"] = centerline
+    metrics["centerline_offsets"] = offsets
+    metrics["curvature"] = kappa
+    metrics["deltaT"] = np.float64( dt )
+    metrics["scale"] = np.float64( scale )
+
+    if name is None:
+        return metrics
+    np.savez( outputpath+name+".npz", **metrics )
+    WriteCsv( outputpath+name+".csv", metrics, Columns )
+
+    speed = metrics["speed"][ ~np.isnan( metrics["speed"] ) ]
+    print("  %d good frames: mean speed %.4g, mean curvature %.4g  "
+          % (len(frames), np.mean(speed) if len(speed) > 0 else np.nan,
+             np.mean( curvature_mean[measured] ) if np.any(measured) else np.nan))
+
+    return metrics
+
+
+'''
+Inputs:
+    (1) filename = name of the .csv file
+    (2) metrics = dictionary of numpy arrays of the same length
+    (3) columns = list of the names of the columns written
+'''
+
+def WriteCsv( filename, metrics, columns ):
+    with open( filename, "w" ) as f:
+        writer = csv.writer( f )
+        writer.writerow( columns )
+        for row in zip( *[ metrics[name] for name in columns ] ):
+            writer.writerow( [ "%d" % v if isinstance( v, (np.integer, np.bool_) ) else "%.6g" % v
+                               for v in row ] )
+
+
+'''
+Inputs:
+    (1) head = integer array of shape (N,2), (y,x) pairs of the heads of all frames
+    (2) offsets = integer array of length n3+1, see SpermTable.py
+Output:
+    (1) centers = numpy array of shape (n3,2), (y,x) center of the head of each frame,
+            NaN without a head
+'''
+
+def HeadCenters( head, offsets ):
+    n3 = len(offsets) - 1
+    k = np.repeat( np.arange(n3), np.diff(offsets) )
+    count = np.bincount( k, minlength=n3 ).astype(float)
+    centers = np.full( (n3,2), np.nan )
+    some = count > 0
+    for ii in range(2):
+        centers[some,ii] = np.bincount( k, weights=head[:,ii], minlength=n3 )[some] / count[some]
+    return centers
+
+
+'''
+Inputs:
+    (1) table = SpermTable, the results of Step 4
+    (2) degree = integer, see MotilityMetrics
+Outputs:
+    (1) centerline = numpy array of shape (N,2), (y,x) points of the centerlines of all frames
+    (2) offsets = integer array of length n3+1, the points of frame k are rows
+            offsets[k]:offsets[k+1]
+    (3) kappa = numpy array of length N, curvature at each point (unit: 1/pixel), NaN in a
+            frame with at most degree+1 points
+    (4) ds = numpy array of length N, length of the centerline around each point (unit: pixel)
+'''
+
+def Centerlines( table, degree ):
+    n3 = len( table )
+    good = np.asarray( table["good"], dtype=bool )
+    body = np.asarray( table["body"], dtype=np.int64 )
+    head = np.asarray( table["head"], dtype=np.int64 )
+    kb = np.repeat( np.arange(n3), np.diff( table["body_offsets"] ) )
+    kh = np.repeat( np.arange(n3), np.diff( table["head_offsets"] ) )
+
+    '''
+    The independent variable u is x for a horizontal sperm and y for a vertical one.
+    '''
+    horizontal = np.asarray( table["horizontality"] ) == 1
+    ub = np.where( horizontal[kb], body[:,1], body[:,0] )
+    vb = np.where( horizontal[kb], body[:,0], body[:,1] )
+    uh = np.where( horizontal[kh], head[:,1], head[:,0] )
+
+    # Keep the body beyond the head, i.e. the flagellum.
+    hoffsets = np.asarray( table["head_offsets"] )
+    umin = ReduceSegments( np.minimum, uh, hoffsets, np.inf )
+    umax = ReduceSegments( np.maximum, uh, hoffsets, -np.inf )
+    keep = good[kb] & ( (ub < umin[kb]) | (ub > umax[kb]) )
+    kb, ub, vb = kb[keep], ub[keep], vb[keep]
+
+    '''
+    Middle of the lower and upper curves at each u, for all frames at once.
+    '''
+    U = int( np.max(ub) ) + 1 if len(ub) > 0 else 1
+    key = kb*U + ub
+    order = np.argsort( key, kind='mergesort' )
+    key, vb = key[order], vb[order]
+    starts = np.flatnonzero( np.diff( np.concatenate( ( [-1], key ) ) ) != 0 )
+    k = key[starts] // U
+    u = ( key[starts] % U ).astype(float)
+    v = np.zeros( len(starts) )
+    if len(starts) > 0:
+        v = ( np.minimum.reduceat( vb, starts ) + np.maximum.reduceat( vb, starts ) ) / 2.0
+    offsets = np.concatenate( ( [0], np.cumsum( np.bincount( k, minlength=n3 ) ) ) ).astype(np.int64)
+
+    '''
+    Fit v(u) in every frame. The points of frame k are rows offsets[k]:offsets[k+1], so the
+    normal equations of all frames are sums over segments; u is mapped to [-1,1] in each
+    frame to keep them well conditioned.
+    '''
+    N = len(v)
+    count = np.diff( offsets )
+    lo = ReduceSegments( np.minimum, u, offsets, 0 )
+    hi = ReduceSegments( np.maximum, u, offsets, 0 )
+    center = ( lo+hi ) / 2.0
+    half = np.maximum( ( hi-lo ) / 2.0, 1 )
+    t = ( u - center[k] ) / half[k]
+    T = t[:,np.newaxis] ** np.arange( degree+1 )
+    fitted = count > degree+1
+    nonempty = count > 0
+    G = np.zeros( (len(count),degree+1,degree+1) )
+    b = np.zeros( (len(count),degree+1) )
+    if np.any( nonempty ):
+        starts = offsets[:-1][nonempty]
+        G[nonempty] = np.add.reduceat( T[:,:,np.newaxis]*T[:,np.newaxis,:], starts, axis=0 )
+        b[nonempty] = np.add.reduceat( T*v[:,np.newaxis], starts, axis=0 )
+    a = np.zeros( (len(count),degree+1) )
+    if np.any( fitted ):
+        a[fitted] = np.linalg.solve( G[fitted], b[fitted][:,:,np.newaxis] )[:,:,0]
+
+    '''
+    Derivatives of the polynomial at the points, and the length of the centerline around each
+    point (half the distance to its neighbors in u).
+    '''
+    j = np.arange( degree+1 )
+    A = a[k]
+    # Frames with too few points keep the middle of the curves.
+    v = np.where( fitted[k], np.sum( A*T, axis=1 ), v )
+    tp = t[:,np.newaxis] ** np.maximum( j-1, 0 )
+    tpp = t[:,np.newaxis] ** np.maximum( j-2, 0 )
+    d1 = np.sum( A*j*tp, axis=1 ) / half[k]
+    d2 = np.sum( A*j*(j-1)*tpp, axis=1 ) / half[k]**2
+    kappa = d2 / ( 1+d1**2 )**1.5
+    ii = np.arange(N)
+    prev = np.maximum( ii-1, offsets[k] )
+    nxt = np.minimum( ii+1, offsets[k+1]-1 )
+    ds = np.sqrt( 1+d1**2 ) * ( u[nxt]-u[prev] ) / 2.0
+    kappa[ ~fitted[k] ] = np.nan
+    ds[ ~fitted[k] ] = 0
+
+    # Back to (y,x) pairs.
+    centerline = np.zeros( (N,2) )
+    hk = horizontal[k]
+    centerline[:,0] = np.where( hk, v, u )
+    centerline[:,1] = np.where( hk, u, v )
+
+    return centerline, offsets, kappa, ds
+
+
+'''
+Inputs:
+    (1) ufunc = numpy.minimum or numpy.maximum
+    (2) values = 1D numpy array, values of all segments
+    (3) offsets = integer array, segment k is values[offsets[k]:offsets[k+1]]
+    (4) fill = value of an empty segment
+Output:
+    (1) result = numpy array with one value per segment
+'''
+
+def ReduceSegments( ufunc, values, offsets, fill ):
+    offsets = np.asarray( offsets )
+    result = np.full( len(offsets)-1, fill, dtype=float )
+    nonempty = offsets[1:] > offsets[:-1]
+    if np.any( nonempty ):
+        # An empty segment ends where the next one starts, so it can be skipped.
+        result[nonempty] = ufunc.reduceat( values, offsets[:-1][nonempty] )
+    return result
+
+
+'''
+Inputs:
+    (1) v = 1D numpy array, values of all segments
+    (2) offsets = see ReduceSegments
+    (3) k = integer array of the length of v, segment of each value
+    (4) w = integer, half width of the window
+Output:
+    (1) average = 1D numpy array, mean of the values at most w places away in the same segment
+'''
+
+def SegmentMovingAverage( v, offsets, k, w ):
+    if w <= 0 or len(v) == 0:
+        return v
+    ii = np.arange( len(v) )
+    lo = np.maximum( ii-w, offsets[k] )
+    hi = np.minimum( ii+w+1, offsets[k+1] )
+    cs = np.concatenate( ( [0], np.cumsum(v) ) )
+    return ( cs[hi] - cs[lo] ) / ( hi - lo )
+
+
+'''
+Inputs:
+    (1) A = numpy array of shape (m,2)
+    (2) w = integer, half width of the window
+Output:
+    (1) average = numpy array of shape (m,2), mean of the rows at most w places away
+'''
+
+def MovingAverage( A, w ):
+    m = A.shape[0]
+    return np.stack( [ SegmentMovingAverage( A[:,ii], np.array([0,m]), np.zeros(m,dtype=int), w )
+                       for ii in range(2) ], axis=1 )
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Motility metrics of SpermInfo.npz")
+    parser.add_argument('-i', '--input_file_name', type=str, required=True,
+                        help='SpermInfo.npz.')
+    parser.add_argument('-o', '--output_path', type=str, required=True,
+                        help='The output path of SpermMetrics.npz and SpermMetrics.csv.')
+    parser.add_argument('-md', '--metrics_degree', type=int, default=5,
+                        help='Degree of the polynomial fitted to the centerline of the flagellum.')
+    parser.add_argument('-mw', '--metrics_window', type=int, default=5,
+                        help='Number of good frames of the average path of the head.')
+    args = parser.parse_args()
+
+    MotilityMetrics( SpermTable( args.input_file_name ), args.output_path,
+                     args.metrics_degree, args.metrics_window )
+
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+import time
+
+from Engines import Labels
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Metrics import Columns, MotilityMetrics, HeadCenters, WriteCsv
+from Parallel import MapFrames
+from SpermTable import Fields, ToColumns, SaveColumns, SpermTable
+from Step4 import AnalyzePixels, SpermDictionary
+
+'''
+Several sperms in one movie.
+
+In each frame, the mask of Step 3 is split into its connected components (8-connected), and
+the components with fewer than minsize or more than maxsize pixels are dropped. Each
+component is analyzed on its own, the way Step 4 analyzes the mask of a single sperm; the
+components of a frame are labeled and grouped in one pass over the frame, and their centroids
+and the pixels painted in the output movies are computed for all of them at once. Only the
+head/flagellum split runs once per component: each of its steps (outliers, curves, good frame
+test, head) works on the sorted pixels and curves of one sperm, of different lengths, so it
+calls AnalyzePixels of Step 4 on each slice of pixels, and gives the same result as Step 4 on
+the same component alone. The frames are shared by the workers with -w. The components are
+linked from frame to frame into tracks by their centroids: the closest pairs of an open track
+and a component are linked first, as long as they are at most maxdistance pixels apart, and a
+track which finds no component stays open for maxgap frames.
+
+The detections are saved as SpermTracks.npz, one row per component, in the columnar layout of
+SpermTable.py, with the columns track, frame, pixels (size of the component), centroid_y and
+centroid_x added. TrackColumns gives the columns of one track, one row per frame, the same as
+SpermInfo.npz of a single sperm.
+'''
+
+
+'''
+Inputs:
+    (1) movie = input ITK image or numpy array, the result of Step 3, see FrameStore.py
+    (2) outputpath = output path
+    (3) dt, scale, threshold1, maxheadwidth, headbodyratio, threshold2 = see DetectingSpermBody
+    (4) minsize = integer, smallest number of pixels of a sperm
+    (5) maxsize = integer, largest number of pixels of a sperm; None for no limit
+    (6) maxdistance = float, largest distance (in pixels) between the centroids of a sperm in
+            two frames
+    (7) maxgap = integer, number of frames a sperm may be missing from its track
+    (8) workers, chunksize, compress, method, report, storage = see DetectingSpermBody
+    (9) engine = string, "itk" (default) or "scipy", engine of the connected components, see
+            Labels in Engines.py
+
+Outputs:
+    (1) newMovie = ITK image, or the mapped output file with "memmap", the components which
+            are good frames of their sperm
+    (2) table = the columns of SpermTracks.npz
+    (3) SpermStep4_GoodFramesOnly.mha, SpermStep4_Tracks.mha (uint16, track+1 on the pixels
+        of each component, 0 elsewhere) and SpermTracks.npz saved in the output path
+'''
+
+def DetectingSperms( movie, outputpath, dt, scale,
+                     threshold1, maxheadwidth, headbodyratio, threshold2,
+                     minsize, maxsize, maxdistance, maxgap, workers=1, chunksize=None,
+                     compress=False, method="vectorized", report=None, storage="itk",
+                     engine="itk" ):
+
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
+    timed = report is not None
+    newMovie = CreateMovie( outputpath+"SpermStep4_GoodFramesOnly.mha", (n1,n2,n3),
+                            movie.dtype, storage )
+    labels = CreateMovie( outputpath+"SpermStep4_Tracks.mha", (n1,n2,n3), np.uint16, storage )
+
+    print("  Labeling the sperms and sperating head and flagellum ...  ")
+
+    '''
+    Analyze the components frame by frame and link them to the tracks in frame order.
+    '''
+    linker = Linker( maxdistance, maxgap )
+    Track = []
+    Frame = []
+    Size = []
+    Centroid = []
+    Results = []
+    for k0,k1,output in MapFrames( AnalyzeComponents, movie,
+                                   (minsize, maxsize, threshold1, maxheadwidth, headbodyratio,
+                                    threshold2, method, timed, engine),
+                                   workers, chunksize ):
+        if timed:
+            output, times = output
+            report.AddFrameTimes( "DetectingSperms", k0, times )
+        for k,(pixels, offsets, centroids, results) in zip( range(k0,k1), output ):
+            tracks = linker.Link( k, centroids )
+            component = np.repeat( np.arange( len(results) ), np.diff(offsets) )
+            labels[ k, pixels[:,0], pixels[:,1] ] = tracks[component] + 1
+            good = np.array( [ result is not None for result in results ], dtype=bool )
+            newMovie[ k, pixels[good[component],0], pixels[good[component],1] ] = 1
+            Track.extend( tracks )
+            Frame.extend( [k] * len(results) )
+            Size.extend( np.diff(offsets) )
+            Centroid.extend( centroids )
+            Results.extend( results )
+        ''' end of for loop on k '''
+    print("  %d components in %d tracks, %d good  "
+          % (len(Results), linker.count, sum( [ r is not None for r in Results ] )))
+
+    '''
+    Put the detections together and write out the results.
+    '''
+    table = ToColumns( SpermDictionary( Results, dt, scale, n1, n2 ) )
+    table["track"] = np.array( Track, dtype=np.int32 )
+    table["frame"] = np.array( Frame, dtype=np.int32 )
+    table["pixels"] = np.array( Size, dtype=np.int64 )
+    Centroid = np.array( Centroid, dtype=np.float64 ).reshape(-1,2)
+    table["centroid_y"] = Centroid[:,0]
+    table["centroid_x"] = Centroid[:,1]
+    table["nframes"] = np.int64( n3 )
+    SaveColumns( outputpath+"SpermTracks.npz", table )
+
+    SaveMovie( labels, outputpath+"SpermStep4_Tracks.mha", compress )
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep4_GoodFramesOnly.mha", compress )
+
+    return newMovie, table
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) minsize, maxsize, threshold1, maxheadwidth, headbodyratio, threshold2, method
+        = see DetectingSperms
+    (3) timed = boolean, also return the time spent on each frame
+    (4) engine = see DetectingSperms
+Outputs:
+    (1) output = list of length m, for each frame a tuple (pixels, offsets, centroids, results)
+            - pixels = integer array of shape (N,2), (y,x) pairs of the pixels of all
+                       components, those of component c are rows offsets[c]:offsets[c+1]
+            - centroids = numpy array of shape (c,2), (y,x) centroid of each component
+            - results = list, the output of AnalyzePixels for each component
+    (2) times = list of length m (unit: second), only if timed
+'''
+
+def AnalyzeComponents( frames, minsize, maxsize, threshold1, maxheadwidth, headbodyratio,
+                       threshold2, method="vectorized", timed=False, engine="itk" ):
+    output = []
+    times = []
+    for k in range( frames.shape[0] ):
+        start = time.time()
+        pixels, offsets, centroids = Components( frames[k,:,:], minsize, maxsize, engine )
+        # One call per component, see the head/flagellum split above.
+        results = [ AnalyzePixels( pixels[offsets[c]:offsets[c+1]], threshold1, maxheadwidth,
+                                   headbodyratio, threshold2, method )
+                    for c in range( len(centroids) ) ]
+        output.append( (pixels, offsets, centroids, results) )
+        times.append( time.time() - start )
+    if timed:
+        return output, times
+    return output
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the thresholding result
+    (2) minsize, maxsize, engine = see DetectingSperms
+Outputs:
+    (1) pixels = integer array of shape (N,2), (y,x) pairs of the marked pixels of all
+            components, grouped by component and in row-major order within a component
+    (2) offsets = integer array, the pixels of component c are rows offsets[c]:offsets[c+1]
+    (3) centroids = numpy array of shape (c,2), (y,x) centroid of each component
+'''
+
+def Components( A, minsize, maxsize=None, engine="itk" ):
+    n2,n1 = A.shape
+    label, sizes = Labels( np.asarray(A) == 1, minsize, engine )
+    label = label.ravel()
+    # The labels are sorted by decreasing size, so the components too large come first.
+    drop = 0 if maxsize is None else int( np.sum( sizes > maxsize ) )
+
+    index = np.flatnonzero( label > drop )
+    label = label[index].astype(np.int64) - drop - 1
+    # Group the pixels by component; the stable sort keeps them in row-major order.
+    order = np.argsort( label, kind="mergesort" )
+    index = index[order]
+    label = label[order]
+    counts = np.bincount( label, minlength=len(sizes)-drop )
+    offsets = np.concatenate( ( [0], np.cumsum(counts) ) ).astype(np.int64)
+    row, col = np.unravel_index( index, (n2,n1) )
+    pixels = np.array( [row,col] ).transpose()
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        centroids = np.array( [ np.bincount( label, weights=row, minlength=len(counts) ),
+                                np.bincount( label, weights=col, minlength=len(counts) ) ]
+                            ).transpose() / counts[:,np.newaxis]
+    return pixels, offsets, centroids
+
+
+'''
+Inputs:
+    (1) maxdistance, maxgap = see DetectingSperms
+'''
+
+class Linker(object):
+
+    def __init__( self, maxdistance, maxgap ):
+        self.maxdistance = maxdistance
+        self.maxgap = maxgap
+        # The open tracks: their number, last centroid and last frame.
+        self.tracks = np.zeros( 0, dtype=np.int64 )
+        self.centroids = np.zeros( (0,2) )
+        self.last = np.zeros( 0, dtype=np.int64 )
+        self.count = 0
+
+    '''
+    Inputs:
+        (1) k = integer, index of the frame, called in increasing order of k
+        (2) centroids = numpy array of shape (c,2), the centroids of the components of frame k
+    Output:
+        (1) tracks = integer array of length c, the track of each component; a component
+                which is not linked to an open track starts a new one
+    '''
+
+    def Link( self, k, centroids ):
+        # Close the tracks missing for more than maxgap frames.
+        keep = k - self.last <= self.maxgap + 1
+        self.tracks = self.tracks[keep]
+        self.centroids = self.centroids[keep]
+        self.last = self.last[keep]
+
+        c = len(centroids)
+        tracks = np.full( c, -1, dtype=np.int64 )
+        if c > 0 and len(self.tracks) > 0:
+            # Distances between all open tracks and all components, closest pairs first.
+            D = np.sqrt( np.sum( ( self.centroids[:,np.newaxis,:]
+                                   - centroids[np.newaxis,:,:] )**2, axis=2 ) ).ravel()
+            pairs = np.flatnonzero( D <= self.maxdistance )
+            pairs = pairs[ np.argsort( D[pairs], kind="mergesort" ) ]
+            linked = np.zeros( len(self.tracks), dtype=bool )
+            for p in pairs:
+                i, j = divmod( p, c )
+                if linked[i] or tracks[j] >= 0:
+                    continue
+                linked[i] = True
+                tracks[j] = self.tracks[i]
+                self.centroids[i] = centroids[j]
+                self.last[i] = k
+            ''' end of for loop on p '''
+
+        new = np.flatnonzero( tracks < 0 )
+        tracks[new] = np.arange( self.count, self.count+len(new) )
+        self.count += len(new)
+        self.tracks = np.concatenate( ( self.tracks, tracks[new] ) )
+        self.centroids = np.concatenate( ( self.centroids, np.reshape( centroids, (-1,2) )[new] ) )
+        self.last = np.concatenate( ( self.last, np.full( len(new), k, dtype=np.int64 ) ) )
+        return tracks
+
+
+'''
+Inputs:
+    (1) table = SpermTable of SpermTracks.npz, or the columns returned by DetectingSperms
+    (2) track = integer, number of the track
+Output:
+    (1) columns = the columns of SpermInfo.npz for the sperm of the track, see ToColumns;
+            the frames without a good component of the track are bad frames
+'''
+
+def TrackColumns( table, track ):
+    if isinstance( table, dict ):
+        table = SpermTable( table )
+    n3 = int( table["nframes"] )
+    rows = np.flatnonzero( table["track"] == track )
+    frames = table["frame"][rows]
+
+    columns = {}
+    good = np.zeros( n3, dtype=bool )
+    good[frames] = table["good"][rows]
+    columns["good"] = good
+    for field in Fields:
+        offsets = table[field+"_offsets"]
+        counts = np.zeros( n3, dtype=np.int64 )
+        counts[frames] = offsets[rows+1] - offsets[rows]
+        columns[field+"_offsets"] = np.concatenate( ( [0], np.cumsum(counts) ) ).astype(np.int64)
+        columns[field] = np.concatenate( [ table[field][0:0] ] +
+                                         [ table[field][offsets[r]:offsets[r+1]] for r in rows ],
+                                         axis=0 )
+    for name in [ "horizontality", "orientation" ]:
+        columns[name] = np.zeros( n3, dtype=np.int8 )
+        columns[name][frames] = table[name][rows]
+    columns["deltaT"] = table["deltaT"]
+    columns["scale"] = table["scale"]
+    columns["size"] = table["size"]
+    return columns
+
+
+'''
+Input:
+    (1) table = SpermTable of SpermTracks.npz, or the columns returned by DetectingSperms
+Output:
+    (1) track = integer, the track with the most good frames; -1 if there is no track
+'''
+
+def LongestTrack( table ):
+    if isinstance( table, dict ):
+        table = SpermTable( table )
+    track = table["track"][ table["good"] ]
+    if len(track) == 0:
+        return -1
+    return int( np.argmax( np.bincount( track ) ) )
+
+
+'''
+Inputs:
+    (1) table = SpermTable of SpermTracks.npz, or the columns returned by DetectingSperms
+    (2) outputpath = output path
+    (3) degree, pathwindow = see MotilityMetrics
+Outputs:
+    (1) metrics = dictionary of numpy arrays, the columns of SpermTrackMetrics.npz, one row
+            per detection in the order of SpermTracks.npz
+    (2) SpermTrackMetrics.npz and SpermTrackMetrics.csv saved in the output path
+'''
+
+def TrackMetrics( table, outputpath, degree=5, pathwindow=5 ):
+    if isinstance( table, dict ):
+        table = SpermTable( table )
+    print("  Computing motility metrics of each track ...  ")
+
+    track = table["track"]
+    frame = table["frame"]
+    metrics = {}
+    metrics["track"] = np.array( track, dtype=np.int64 )
+    for name in Columns:
+        metrics[name] = np.zeros( len(track), dtype=np.float64 )
+    metrics["frame"] = np.array( frame, dtype=np.int64 )
+    metrics["good"] = np.array( table["good"], dtype=bool )
+    for t in np.unique( track ):
+        rows = np.flatnonzero( track == t )
+        columns = MotilityMetrics( SpermTable( TrackColumns( table, t ) ), outputpath,
+                                   degree, pathwindow, None )
+        for name in Columns[2:]:
+            metrics[name][rows] = columns[name][ frame[rows] ]
+    ''' end of for loop on t '''
+    metrics["deltaT"] = np.float64( table["deltaT"] )
+    metrics["scale"] = np.float64( table["scale"] )
+
+    np.savez( outputpath+"SpermTrackMetrics.npz", **metrics )
+    WriteCsv( outputpath+"SpermTrackMetrics.csv", metrics, [ "track" ] + Columns )
+    return metrics
+
+
+'''
+Inputs:
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
+    (2) outputpath = output path
+    (3) table = SpermTable of SpermTracks.npz, or the columns returned by DetectingSperms
+    (4) compact, compress, plots, storage = see Summary
+
+Outputs:
+    (1) SpermStep5_HeadFlagellum.mha saved in the output path, the heads and flagella of all
+        sperms
+    (2) SpermStep5_HeadTrajectory.png saved in the output path, one trajectory per track,
+        if plots
+'''
+
+def SummaryTracks( movie, outputpath, table, compact=False, compress=False, plots=True,
+                   storage="itk" ):
+    if isinstance( table, dict ):
+        table = SpermTable( table )
+    (n1,n2,n3) = MovieSize( movie )
+    frame = table["frame"]
+
+    print("  Summarizing ...  ")
+
+    '''
+    Paint all heads, then all flagella, into one uint8 label volume (head=2, flagellum=1).
+    '''
+    labels = np.zeros( (n3,n2,n1), dtype=np.uint8 )
+    for field,label in [ ("head",2), ("flagellum",1) ]:
+        k = np.repeat( frame, np.diff( table[field+"_offsets"] ) )
+        yx = np.asarray( table[field], dtype=int )
+        labels[ k, yx[:,0], yx[:,1] ] = label
+    if compact:
+        palette = np.array( [0, 1, 2], dtype=np.uint8 )
+    else:
+        palette = np.array( [0, 0.5, 1] )
+    newMovie = CreateMovie( outputpath+"SpermStep5_HeadFlagellum.mha", (n1,n2,n3),
+                            palette.dtype, storage )
+    for k in range(n3):
+        newMovie[k,:,:] = palette[ labels[k,:,:] ]
+    SaveMovie( newMovie, outputpath+"SpermStep5_HeadFlagellum.mha", compress )
+
+    '''
+    Plot the center of the head of each track into one figure.
+    '''
+    if not plots:
+        return
+    centers = HeadCenters( table["head"], table["head_offsets"] )
+    good = np.asarray( table["good"], dtype=bool ) & ~np.isnan( centers[:,0] )
+    PlotTracks( table["track"][good], centers[good], n1, n2, outputpath )
+
+    return
+
+
+'''
+Inputs:
+    (1) track = integer array, the track of each center, in frame order within a track
+    (2) centers = numpy array of shape (N,2), (y,x) center of the head
+    (3) n1, n2 = size of the frame
+    (4) outputpath = output path
+Output:
+    (1) SpermStep5_HeadTrajectory.png saved in the output path
+'''
+
+def PlotTracks( track, centers, n1, n2, outputpath ):
+    import matplotlib
+    matplotlib.use( "Agg" )
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    for t in np.unique( track ):
+        y = centers[ track == t, 0 ]
+        x = centers[ track == t, 1 ]
+        line, = plt.plot( x, y, "-" )
+        plt.plot( x[0], y[0], "*", color=line.get_color() )
+        plt.text( x[0], y[0], " %d" % t, color=line.get_color() )
+    ''' end of for loop on t '''
+    plt.axis((0,n1,n2,0))
+    plt.title("Head Trajectories")
+    plt.savefig( outputpath+"SpermStep5_HeadTrajectory.png" )
+    plt.close()
+    return
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Export one track of SpermTracks.npz")
+    parser.add_argument('-i', '--input_file_name', type=str, required=True,
+                        help='SpermTracks.npz.')
+    parser.add_argument('-t', '--track', type=int, default=None,
+                        help='Number of the track (default: the one with the most good frames).')
+    parser.add_argument('-o', '--output_file_name', type=str, required=True,
+                        help='The .npz file, in the layout of SpermInfo.npz, or a .mat file.')
+    args = parser.parse_args()
+
+    table = SpermTable( args.input_file_name )
+    track = LongestTrack( table ) if args.track is None else args.track
+    columns = TrackColumns( table, track )
+    if args.output_file_name.endswith( ".mat" ):
+        SpermTable( columns ).ExportMat( args.output_file_name )
+    else:
+        SaveColumns( args.output_file_name, columns )
+
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from __future__ import print_function
+import collections
+import multiprocessing
+import numpy as np
+
+'''
+Inputs:
+    (1) func = function of the form func( frames, *args ), defined at the top level of a module
+            so that it can be sent to the worker processes
+    (2) movie = numpy array, the 1st axis is the frame axis
+    (3) args = tuple, extra arguments passed to func after the chunk of frames
+    (4) workers = integer, number of worker processes; 1 runs everything in this process
+    (5) chunksize = integer, number of frames sent to a worker at a time;
+            None takes the whole movie if workers=1, and about 4 chunks per worker otherwise
+
+Outputs:
+    (1) a generator of (k0, k1, result) where result = func( movie[k0:k1], *args ),
+        in increasing order of k0
+'''
+
+def MapFrames( func, movie, args=(), workers=1, chunksize=None ):
+    n3 = movie.shape[0]
+    workers = max( 1, int(workers) )
+    if chunksize is None:
+        if workers == 1:
+            chunksize = max( 1, n3 )
+        else:
+            chunksize = max( 1, int( np.ceil( n3/(4.0*workers) ) ) )
+    chunksize = max( 1, int(chunksize) )
+    bounds = [ (k0, min(k0+chunksize, n3)) for k0 in range(0, n3, chunksize) ]
+
+    if workers == 1 or len(bounds) == 1:
+        for k0,k1 in bounds:
+            yield k0, k1, func( movie[k0:k1], *args )
+        return
+
+    # At most 2 chunks per worker are in flight, so memory is bounded by the chunk size.
+    workers = min( workers, len(bounds) )
+    pool = multiprocessing.Pool( workers )
+    try:
+        pending = collections.deque()
+        queue = iter( bounds )
+        for k0,k1 in queue:
+            pending.append( (k0, k1, pool.apply_async( func, (movie[k0:k1],)+tuple(args) )) )
+            if len(pending) >= 2*workers:
+                break
+        while pending:
+            k0,k1,result = pending.popleft()
+            yield k0, k1, result.get()
+            for k0,k1 in queue:
+                pending.append( (k0, k1, pool.apply_async( func, (movie[k0:k1],)+tuple(args) )) )
+                break
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,142 @@
+from __future__ import print_function
+import cProfile
+import json
+import os
+import pstats
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the peak memory is then not reported.
+    resource = None
+
+'''
+Timing and memory report of a run.
+
+Each step of the pipeline is run through Report.Run, which records its wall time, CPU time
+(including the worker processes), the peak resident memory of the run so far, the number of
+frames per second and the number of bytes written. Steps 3 and 4 also add the time spent on
+each frame. Report.Write saves everything as a JSON file.
+'''
+
+
+'''
+Inputs:
+    (1) outputpath = output path
+    (2) profilestep = string, name of the step to run under cProfile; None for no profiling
+'''
+
+class Report(object):
+
+    def __init__( self, outputpath, profilestep=None ):
+        self.outputpath = outputpath
+        self.profilestep = profilestep
+        self.steps = []
+        self.start = time.time()
+
+    '''
+    Inputs:
+        (1) name = string, name of the step
+        (2) func = the function of the step
+        (3) args = list, arguments of func
+        (4) nframes = integer, number of frames processed by the step
+        (5) outputs = list of the names of the files written by the step, relative to outputpath
+    Output:
+        (1) the return value of func( *args )
+    '''
+
+    def Run( self, name, func, args, nframes, outputs=() ):
+        entry = { "step": name, "frames": nframes, "outputs": list(outputs) }
+        self.steps.append( entry )
+
+        cpu0 = CPUTime()
+        wall0 = time.time()
+        if name == self.profilestep:
+            profiler = cProfile.Profile()
+            result = profiler.runcall( func, *args )
+            profiler.dump_stats( self.outputpath+"SpermProfile_%s.prof" % name )
+            pstats.Stats( profiler ).sort_stats( "cumulative" ).print_stats( 20 )
+        else:
+            result = func( *args )
+        entry["wall_time"] = time.time() - wall0
+        entry["cpu_time"] = CPUTime() - cpu0
+
+        entry["peak_rss_mb"] = PeakRSS()
+        if entry["wall_time"] > 0:
+            entry["frames_per_second"] = nframes / entry["wall_time"]
+        else:
+            entry["frames_per_second"] = None
+        entry["bytes_written"] = self.BytesWritten( entry["outputs"] )
+        return result
+
+    '''
+    Inputs:
+        (1) name = string, name of the step
+        (2) filename = name of a file written by the step, relative to outputpath
+    '''
+
+    def AddOutput( self, name, filename ):
+        for entry in self.steps:
+            if entry["step"] == name:
+                entry["outputs"].append( filename )
+                entry["bytes_written"] = self.BytesWritten( entry["outputs"] )
+
+    '''
+    Inputs:
+        (1) name = string, name of the step
+        (2) k0 = integer, index of the first frame
+        (3) times = list of the times (unit: second) spent on frames k0, k0+1, ...
+    '''
+
+    def AddFrameTimes( self, name, k0, times ):
+        for entry in self.steps:
+            if entry["step"] == name:
+                frametimes = entry.setdefault( "frame_times", [] )
+                frametimes.extend( [None] * ( k0+len(times)-len(frametimes) ) )
+                frametimes[k0:k0+len(times)] = list(times)
+
+    def BytesWritten( self, outputs ):
+        total = 0
+        for filename in outputs:
+            if os.path.isfile( self.outputpath+filename ):
+                total += os.path.getsize( self.outputpath+filename )
+        return total
+
+    '''
+    Input:
+        (1) filename = name of the report, relative to outputpath
+    '''
+
+    def Write( self, filename="SpermProfile.json" ):
+        report = { "wall_time": time.time() - self.start,
+                   "cpu_time": CPUTime(),
+                   "peak_rss_mb": PeakRSS(),
+                   "steps": self.steps }
+        with open( self.outputpath+filename, "w" ) as f:
+            json.dump( report, f, indent=2 )
+
+
+'''
+Output:
+    (1) CPU time (unit: second) of this process and of its finished child processes
+'''
+
+def CPUTime():
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+'''
+Output:
+    (1) peak resident memory (unit: MB) of this process so far, None if unknown
+'''
+
+def PeakRSS():
+    if resource is None:
+        return None
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    if os.uname()[0] == "Darwin":
+        return rss / 1048576.0
+    return rss / 1024.0
@@ -1,18 +1,24 @@
 from __future__ import print_function
 import argparse
+import importlib
 import numpy as np
 import os
-import scipy.io as sio
-import SimpleITK as sitk
 import sys
 
-from Step1 import * 
-from Step2 import *
-from Step3 import *
-from Step4 import *
-from Step5 import *
+# The steps, scipy.io and matplotlib are imported when they are used, so that the
+# program starts quickly and a run from step 4 does not load steps 1-3.
+from Cache import *
+from Engines import Engine
+from FrameStore import OpenMovie, MovieSize
+from Profiling import Report
+from SpermTable import ToColumns, SaveColumns, SpermTable
 
-def main():
+'''
+Output:
+    (1) parser = the argument parser of SpermSegReg.py, also used by Batch.py for the manifest
+'''
+
+def Parser():
     # Define arguments. #
     parser = argparse.ArgumentParser( description = "Sperm Segmentation and Registration")
         # step 1 -- correcting nonuniform illumination #
@@ -23,6 +29,87 @@ def main():
     parser.add_argument('-n', '--starting_step', type=int,
                         help='1-correcting nonuniform illumination, 2-blurring,'
                         '3-thresholding, 4-image analysis')
+    parser.add_argument('-fm', '--filter_method', type=str, default='volume',
+                        choices=['volume','frame'],
+                        help='volume-one 3D filter over all frames, frame-2D filters frame by frame.'
+                        'Used in steps 1 and 2.')
+    parser.add_argument('-bg', '--background', type=str, default='ball',
+                        choices=['ball','box','decimated','temporal'],
+                        help='ball-exact opening with a ball, box-opening with a box (fast),'
+                        ' decimated-opening with a ball on shrunk frames (fast),'
+                        ' temporal-opening of a percentile over time of a sliding window of frames (fast).')
+    parser.add_argument('-bf', '--background_factor', type=int, default=4,
+                        help='Shrink factor of the decimated background.')
+    parser.add_argument('-bw', '--background_window', type=int, default=100,
+                        help='Number of frames of the percentile of the temporal background, centered on'
+                        ' the frames it corrects. Use a smaller window when the illumination drifts, a'
+                        ' window longer than the movie for one background.')
+    parser.add_argument('-bs', '--background_stride', type=int, default=None,
+                        help='Number of frames sharing a temporal background, one opening each'
+                        ' (default: a quarter of -bw).')
+    parser.add_argument('-bp', '--background_percentile', type=float, default=50,
+                        help='Percentile over time of the temporal background.')
+    parser.add_argument('-be', '--background_error', type=int, default=0,
+                        help='Compare the box or decimated background with the exact one on this'
+                        ' many frames and save the error in SpermStep1_BackgroundError.json.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes sharing the frames in steps 1-4.')
+    parser.add_argument('-cs', '--chunk_size', type=int, default=None,
+                        help='Number of frames handed to a process at a time. Smaller chunks use less '
+                        'memory, larger chunks have less scheduling overhead.')
+    parser.add_argument('-st', '--streaming', action='store_true',
+                        help='Read and process the movie one frame at a time, so that the memory use'
+                        ' does not grow with the length of the movie.')
+    parser.add_argument('-sg', '--storage', type=str, default='itk', choices=['itk','memmap'],
+                        help='itk-each step writes its whole volume with ITK at the end,'
+                        ' memmap-each step writes its chunks of frames into a memory-mapped .mha'
+                        ' file and the next step reads the frames from it (not with -cz).')
+    parser.add_argument('-eg', '--engine', type=str, default='default',
+                        choices=['default','itk','scipy','auto'],
+                        help='Engine of the filters of steps 1-3 and of the components of -mu, which give'
+                        ' the same results: itk-SimpleITK, scipy-SciPy/NumPy, auto-the faster one of each'
+                        ' filter of steps 1-3 for the frame size, default-SimpleITK except NumPy for the'
+                        ' box means of step 3. See Engines.py.')
+    parser.add_argument('-et', '--engine_table', type=str, default=None,
+                        help='Keep the timings of -eg auto in this .json file, so that a frame size is'
+                        ' only timed once.')
+    parser.add_argument('-ck', '--checkpoint', type=int, default=100,
+                        help='Number of frames between two checkpoints of the streaming mode, see'
+                        ' SpermJournal.json in the output path.')
+    parser.add_argument('-re', '--resume', action='store_true',
+                        help='Continue after the last checkpoint of an earlier run with the same'
+                        ' settings, or process only the frames appended to the movie since'
+                        ' (implies -st).')
+    parser.add_argument('-cd', '--cache_dir', type=str, default=None,
+                        help='Cache directory of the results of steps 1-3. A rerun with the same input'
+                        ' and parameters starts after the deepest cached step.')
+    parser.add_argument('-cms', '--cache_max_size', type=float, default=None,
+                        help='Largest size of the cache (unit: MB).')
+    parser.add_argument('-cma', '--cache_max_age', type=float, default=None,
+                        help='Cache entries unused for longer than this are removed (unit: day).')
+    parser.add_argument('-cp', '--compact', action='store_true',
+                        help='Store the masks of steps 3-4 as uint8 and the labels of step 5 as uint8'
+                        ' (head=2, flagellum=1) instead of float64.')
+    parser.add_argument('-cz', '--compress', action='store_true',
+                        help='Write compressed .mha files in steps 3-5 (not in streaming mode).')
+    parser.add_argument('-pk', '--packed', action='store_true',
+                        help='Keep the masks packed 8 pixels per byte while step 4 analyses them.')
+    parser.add_argument('-if', '--info_format', type=str, default='both',
+                        choices=['mat','npz','both'],
+                        help='mat-SpermInfo.mat with one array per frame, npz-SpermInfo.npz with'
+                        ' concatenated coordinates and offsets per frame, both-both files.')
+    parser.add_argument('-np', '--no_plots', action='store_true',
+                        help='Do not draw SpermStep5_HeadTrajectory.png (matplotlib is then not loaded).')
+    parser.add_argument('-nm', '--no_metrics', action='store_true',
+                        help='Do not compute the motility metrics SpermMetrics.npz/.csv after step 4.')
+    parser.add_argument('-md', '--metrics_degree', type=int, default=5,
+                        help='Degree of the polynomial fitted to the centerline of the flagellum.')
+    parser.add_argument('-mw', '--metrics_window', type=int, default=5,
+                        help='Number of good frames of the average path of the head, which gives'
+                        ' the head centerline deviation.')
+    parser.add_argument('-pf', '--profile', type=int, default=None, choices=[1,2,3,4,5],
+                        help='Run this step under cProfile and save the statistics in the output path.'
+                        ' Only the main process is profiled, so use it with -w 1.')
         # step 2 -- blurring #
     parser.add_argument('-mf', '--median_filter_radius', type=int,
                         help='Neighborhood radius of the median filter.');
@@ -34,6 +121,9 @@ def main():
     parser.add_argument('-rs', '--regions_of_stains', type=int, nargs='+',
                         help='The regions of the stains.'
                         'Format: xmin1,xmax1,ymin1,ymax1,xmin2,xmax2,ymin2,ymax2,...')
+    parser.add_argument('-tm', '--threshold_method', type=str, default='integral',
+                        choices=['integral','loop'],
+                        help='integral-summed-area tables (fast), loop-pixel by pixel (reference).')
         # step 4 -- image analysis #
     parser.add_argument('-dt', '--deltaT', type=float,
                         help='Time elapsed between two consecutive frames (unit: second).')
@@ -42,49 +132,263 @@ def main():
     parser.add_argument('-hbr', '--headbodyratio', type=float,
                         help='If the ratio of head length to body length exceeds 2*hbr,'
                         'the frame is considered as a valid frame.')
-    args = parser.parse_args()
-    
+    parser.add_argument('-roi', '--roi_margin', type=int, default=None,
+                        help='Track the sperm and restrict steps 3-4 to a box around the body of the'
+                        ' previous frame, enlarged by this many pixels (not with -st).')
+    parser.add_argument('-tc', '--temporal_window', type=int, default=None,
+                        help='Seed the orientation and the head of each frame with those of the previous'
+                        ' good frame and search the head within this many pixels of the previous one'
+                        ' first; a frame failing the checks is searched anew (not with -st or -mu).')
+    parser.add_argument('-mu', '--multi', action='store_true',
+                        help='Several sperms: split the mask of each frame into connected components,'
+                        ' analyze each one and link them into tracks, see SpermTracks.npz'
+                        ' (not with -st or -roi).')
+    parser.add_argument('-cn', '--component_min_size', type=int, default=100,
+                        help='Smallest number of pixels of a sperm with -mu.')
+    parser.add_argument('-cx', '--component_max_size', type=int, default=None,
+                        help='Largest number of pixels of a sperm with -mu.')
+    parser.add_argument('-ld', '--link_distance', type=float, default=30,
+                        help='Largest distance (unit: pixel) between the centroids of a sperm in two'
+                        ' frames with -mu.')
+    parser.add_argument('-lg', '--link_gap', type=int, default=2,
+                        help='Number of frames a sperm may be missing from its track with -mu.')
+    parser.add_argument('-am', '--analysis_method', type=str, default='vectorized',
+                        choices=['vectorized','loop','pca'],
+                        help='vectorized-whole-array good frame test and head/flagellum split (fast),'
+                        ' loop-one value at a time (reference), pca-along the principal axis of the body,'
+                        ' for any direction of swimming.')
+    return parser
 
-    # Read the image. #
-    imread = sitk.ImageFileReader()
-    imread.SetFileName( args.input_file_name )
-    movie = imread.Execute()
-    
+
+'''
+Input:
+    (1) args = parsed arguments, see Parser
+Output:
+    (1) sperm = the dictionary saved in SpermInfo.mat; with -mu, the one of the track with the
+            most good frames
+'''
+
+def Run( args ):
 
     # Define the regions of stains. #
     stains = args.regions_of_stains
-    ns = len(stains)/4
+    ns = len(stains)//4
     stains = np.asarray(stains)
     stains = np.reshape(stains,(ns,4))
 
+    # Checkpoints are written in streaming mode only. #
+    if args.resume and not args.streaming:
+        print("  Resuming in streaming mode ...  ")
+        args.streaming = True
+    if args.multi and args.streaming:
+        raise ValueError("Several sperms (-mu) are not tracked in streaming mode (-st, -re).")
+    if args.multi and args.roi_margin is not None:
+        print("  Several sperms are tracked in the whole frame, ignoring -roi ...  ")
+        args.roi_margin = None
+    if args.temporal_window is not None and ( args.streaming or args.multi ):
+        print("  Every frame is searched anew in this mode, ignoring -tc ...  ")
+
+    # Define the parameters of step 4. #
+    threshold1 = 2.75
+    maxheadwidth = 80
+    threshold2 = 135
+
+
+    # Look for the results of steps 1-3 in the cache. #
+    inputfile = args.input_file_name
+    startingstep = args.starting_step
+    if args.cache_dir:
+        params = { 1: (args.background, args.background_factor, args.background_window,
+                       args.background_percentile, args.background_stride),
+                   2: (args.median_filter_radius,),
+                   3: (args.threshold_radius, args.threshold_value, stains.tolist(), args.compact,
+                       args.roi_margin) }
+        keys = StepKeys( FileHash(inputfile), startingstep, params )
+        laststep, cachedfile = LookUp( args.cache_dir, keys )
+        if laststep is not None:
+            print("  Reusing the cached result of step %d ...  " % laststep)
+            Restore( args.cache_dir, keys, laststep, args.output_path )
+            inputfile = cachedfile
+            startingstep = laststep + 1
+
+    def cache_store(steps):
+        if args.cache_dir:
+            for s in steps:
+                Store( args.cache_dir, keys[s], args.output_path+StepFiles[s] )
+            Evict( args.cache_dir, args.cache_max_size, args.cache_max_age )
+
+    def save_info(sperm, stepname):
+        if args.info_format in ('mat','both'):
+            import scipy.io as sio
+            sio.savemat(args.output_path+"SpermInfo.mat", sperm)
+            report.AddOutput( stepname, "SpermInfo.mat" )
+        if args.info_format in ('npz','both'):
+            SaveColumns(args.output_path+"SpermInfo.npz", ToColumns(sperm))
+            report.AddOutput( stepname, "SpermInfo.npz" )
+
+    def compute_metrics(sperm, n3):
+        if not args.no_metrics:
+            from Metrics import MotilityMetrics
+            report.Run( "MotilityMetrics", MotilityMetrics,
+                        [ SpermTable( ToColumns(sperm) ), args.output_path, args.metrics_degree,
+                          args.metrics_window ], n3, [ "SpermMetrics.npz", "SpermMetrics.csv" ] )
+
+
+    def choose_engines(n1, n2):
+        from Engines import ChooseEngines, RunCases, Steps
+        thresholdRadius = args.threshold_radius if args.threshold_method == "integral" else None
+        cases = [ case for case in RunCases( (n1,n2), args.median_filter_radius, thresholdRadius,
+                                             args.background, args.background_factor )
+                  if Steps[case[0]] >= startingstep ]
+        engines = ChooseEngines( args.engine, cases, args.engine_table )
+        if args.engine != "default":
+            print("  Engines: %s  " % ", ".join( [ "%s %s" % (case[0], engines[case[0]])
+                                                   for case in cases ] ))
+        return engines
+
+
+    # Record the time and memory used by each step. #
+    stepnames = { 1: "PreProcessing", 2: "Blurring", 3: "Thresholding",
+                  4: "DetectingSpermBody", 5: "Summary" }
+    if args.multi:
+        stepnames.update( { 4: "DetectingSperms", 5: "SummaryTracks" } )
+    if args.streaming and args.profile is not None:
+        report = Report( args.output_path, "StreamingPipeline" )
+    else:
+        report = Report( args.output_path, stepnames.get(args.profile) )
+
+
+    # Steps 1-5 frame by frame, without reading the whole movie. #
+    plots = [] if args.no_plots else [ "SpermStep5_HeadTrajectory.png" ]
+    if args.streaming:
+        from Streaming import StreamingPipeline, ReadFrames
+        (n1,n2,n3), frames = ReadFrames( inputfile )
+        engines = choose_engines( n1, n2 )
+        outputs = [ StepFiles[s] for s in range(startingstep, 4) ]
+        outputs += [ "SpermStep4_GoodFramesOnly.mha", "SpermStep5_HeadFlagellum.mha" ] + plots
+        sperm = report.Run( "StreamingPipeline", StreamingPipeline,
+                            [ inputfile, args.output_path, startingstep,
+                              args.median_filter_radius, args.threshold_radius,
+                              args.threshold_value, stains, args.threshold_method,
+                              args.deltaT, args.scale, threshold1, maxheadwidth,
+                              args.headbodyratio, threshold2, args.compact,
+                              args.analysis_method, args.background,
+                              args.background_factor, args.background_window,
+                              args.background_percentile, not args.no_plots, args.checkpoint,
+                              args.resume, engines, args.background_stride ], n3, outputs )
+        cache_store( range(startingstep, 4) )
+        save_info( sperm, "StreamingPipeline" )
+        compute_metrics( sperm, n3 )
+        report.Write()
+        print("  Program done!  ")
+        return sperm
+
+
+    # Read the image. #
+    movie = OpenMovie( inputfile, args.storage )
+    n1,n2,n3 = MovieSize( movie )
+    if args.storage == "memmap" and args.chunk_size is None:
+        # Read and write the mapped files a few frames at a time.
+        args.chunk_size = 32
+    engines = choose_engines( n1, n2 )
+
     
     # Define a loop for the job. #
     def func_wrapper(func, args):
         return func(*args)       
-    job_list = [ [PreProcessing, args.output_path],
-                 [Blurring, args.output_path, args.median_filter_radius],
-                 [Thresholding, args.output_path, args.threshold_radius, args.threshold_value, stains]]
+    job_list = [ ["Step1", "PreProcessing", args.output_path, args.filter_method],
+                 ["Step2", "Blurring", args.output_path, args.median_filter_radius, args.filter_method],
+                 ["Step3", "Thresholding", args.output_path, args.threshold_radius,
+                  args.threshold_value, stains, args.threshold_method]]
+    for job in job_list:
+        job.extend( [args.workers, args.chunk_size] )
+    job_list[0].extend( [args.background, args.background_factor, args.background_window,
+                         args.background_percentile, args.background_error] )
+    job_list[2].extend( [args.compact, args.compress, report] )
+    for job in job_list:
+        job.extend( [args.storage, engines] )
+    job_list[0].append( args.background_stride )
 
     # Steps 1-3. Perform image processing. #
-    for i in range(args.starting_step - 1, len(job_list)):
-        job = job_list[i][0]
-        job_args = job_list[i][1:]
+    # With a region of interest, step 3 is done together with step 4 below.
+    tracking = args.roi_margin is not None and startingstep <= 3
+    for i in range(startingstep - 1, 2 if tracking else len(job_list)):
+        job = getattr( importlib.import_module( job_list[i][0] ), job_list[i][1] )
+        job_args = job_list[i][2:]
         job_args.insert(0, movie)
-        movie = func_wrapper(job, job_args)
+        movie = report.Run( job.__name__, func_wrapper, [job, job_args], n3, [StepFiles[i+1]] )
+        cache_store( [i+1] )
+    cache_store( [] )
+
+    # Steps 4 and 5 for several sperms. #
+    if args.multi:
+        from MultiSperm import ( DetectingSperms, TrackMetrics, SummaryTracks, TrackColumns,
+                                 LongestTrack )
+        movie,tracks = report.Run( "DetectingSperms", DetectingSperms,
+                                   [ movie, args.output_path, args.deltaT, args.scale,
+                                     threshold1, maxheadwidth, args.headbodyratio, threshold2,
+                                     args.component_min_size, args.component_max_size,
+                                     args.link_distance, args.link_gap, args.workers,
+                                     args.chunk_size, args.compress, args.analysis_method, report,
+                                     args.storage, Engine( engines, "components" ) ], n3,
+                                   [ "SpermStep4_GoodFramesOnly.mha", "SpermStep4_Tracks.mha",
+                                     "SpermTracks.npz" ] )
+        if not args.no_metrics:
+            report.Run( "TrackMetrics", TrackMetrics,
+                        [ tracks, args.output_path, args.metrics_degree, args.metrics_window ], n3,
+                        [ "SpermTrackMetrics.npz", "SpermTrackMetrics.csv" ] )
+        report.Run( "SummaryTracks", SummaryTracks,
+                    [ movie, args.output_path, tracks, args.compact, args.compress,
+                      not args.no_plots, args.storage ],
+                    n3, [ "SpermStep5_HeadFlagellum.mha" ] + plots )
+        report.Write()
+        print("  Program done!  ")
+        return SpermTable( TrackColumns( tracks, LongestTrack( tracks ) ) ).ToDictionary()
 
     # Step 4. Do calculations. #
-    threshold1 = 2.75
-    maxheadwidth = 80
-    threshold2 = 135
-    movie,sperm = DetectingSpermBody( movie, args.output_path, args.deltaT, args.scale,
-                                threshold1, maxheadwidth, args.headbodyratio, threshold2 )
-    sio.savemat(args.output_path+"SpermInfo.mat", sperm)
+    if tracking:
+        from Tracking import TrackingSperm
+        movie,sperm = report.Run( "TrackingSperm", TrackingSperm,
+                                  [ movie, args.output_path, args.threshold_radius,
+                                    args.threshold_value, stains, args.threshold_method,
+                                    args.deltaT, args.scale, threshold1, maxheadwidth,
+                                    args.headbodyratio, threshold2, args.roi_margin,
+                                    args.workers, args.chunk_size, args.compact, args.compress,
+                                    args.analysis_method, report, args.storage,
+                                    args.temporal_window, engines ], n3,
+                                  [ StepFiles[3], "SpermStep4_GoodFramesOnly.mha" ] )
+        cache_store( [3] )
+        save_info( sperm, "TrackingSperm" )
+        compute_metrics( sperm, n3 )
+    else:
+        from Step4 import DetectingSpermBody
+        movie,sperm = report.Run( "DetectingSpermBody", DetectingSpermBody,
+                                  [ movie, args.output_path, args.deltaT, args.scale,
+                                    threshold1, maxheadwidth, args.headbodyratio, threshold2,
+                                    args.workers, args.chunk_size, args.compress, args.packed,
+                                    args.analysis_method, report, args.storage,
+                                    args.temporal_window ], n3,
+                                  [ "SpermStep4_GoodFramesOnly.mha" ] )
+        save_info( sperm, "DetectingSpermBody" )
+        compute_metrics( sperm, n3 )
 
     # Step 5. Make a summary. #
-    Summary( movie, args.output_path, sperm )
+    from Step5 import Summary
+    report.Run( "Summary", Summary,
+                [ movie, args.output_path, sperm, args.compact, args.compress, not args.no_plots,
+                  args.storage ],
+                n3, [ "SpermStep5_HeadFlagellum.mha" ] + plots )
+
+    # Write out the report. #
+    report.Write()
 
     print("  Program done!  ")
     
+    return sperm
+
+
+def main():
+    Run( Parser().parse_args() )
     return
 
 if __name__ == '__main__':
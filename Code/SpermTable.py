@@ -0,0 +1,163 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+
+'''
+Columnar layout of the sperm dictionary of DetectingSpermBody.
+
+Instead of one (y,x) array per frame, with the string 'empty' for bad frames, each of the
+fields body, flagellum and head is stored as one concatenated integer array of (y,x) pairs,
+together with offsets such that the pixels of frame k are rows offsets[k]:offsets[k+1].
+A boolean mask tells the good frames. The table is saved as SpermInfo.npz, whose arrays are
+only read when they are used, and can still be exported to the SpermInfo.mat of the
+dictionary layout.
+'''
+
+Fields = [ "body", "flagellum", "head" ]
+
+
+'''
+Input:
+    (1) sperm = dictionary returned by DetectingSpermBody
+Output:
+    (1) columns = dictionary of numpy arrays
+            - good = boolean array of length n3, True for good frames
+            - body, flagellum, head = integer arrays of shape (N,2), (y,x) pairs of all frames
+            - body_offsets, flagellum_offsets, head_offsets = integer arrays of length n3+1
+            - horizontality, orientation = integer arrays of length n3, 0 for bad frames
+            - deltaT, scale, size = as in sperm
+'''
+
+def ToColumns( sperm ):
+    n1,n2 = sperm["size"]
+    n3 = len( sperm["body"] )
+    good = np.zeros( n3, dtype=bool )
+    good[ np.asarray( sperm["frames"], dtype=int ) ] = True
+    # Coordinates are smaller than the size of the frame.
+    if max(n1,n2) < 32768:
+        dtype = np.int16
+    else:
+        dtype = np.int32
+
+    columns = {}
+    columns["good"] = good
+    for field in Fields:
+        arrays = [ np.asarray( sperm[field][k] ).reshape(-1,2) if good[k]
+                   else np.zeros( (0,2) ) for k in range(n3) ]
+        counts = np.array( [ len(A) for A in arrays ], dtype=np.int64 )
+        columns[field+"_offsets"] = np.concatenate( ( [0], np.cumsum(counts) ) ).astype(np.int64)
+        if n3 > 0:
+            columns[field] = np.concatenate( arrays, axis=0 ).astype(dtype)
+        else:
+            columns[field] = np.zeros( (0,2), dtype=dtype )
+    horizontality = np.zeros( n3, dtype=np.int8 )
+    orientation = np.zeros( n3, dtype=np.int8 )
+    for k in np.flatnonzero( good ):
+        horizontality[k], orientation[k] = sperm["horizontality"][k]
+    columns["horizontality"] = horizontality
+    columns["orientation"] = orientation
+    columns["deltaT"] = np.float64( sperm["deltaT"] )
+    columns["scale"] = np.float64( sperm["scale"] )
+    columns["size"] = np.array( (n1,n2), dtype=np.int64 )
+    return columns
+
+
+'''
+Inputs:
+    (1) filename = name of the .npz file
+    (2) columns = output of ToColumns
+'''
+
+def SaveColumns( filename, columns ):
+    np.savez( filename, **columns )
+
+
+'''
+Input:
+    (1) source = name of a .npz file written by SaveColumns, or the output of ToColumns
+
+Note: The arrays of a .npz file are read from the file the first time they are used.
+'''
+
+class SpermTable(object):
+
+    def __init__( self, source ):
+        if isinstance( source, dict ):
+            self.columns = source
+        else:
+            self.columns = np.load( source )
+        self.cache = {}
+
+    def __getitem__( self, name ):
+        if name not in self.cache:
+            self.cache[name] = self.columns[name]
+        return self.cache[name]
+
+    def __len__( self ):
+        return len( self["good"] )
+
+    '''
+    Output:
+        (1) integer array of the good frames
+    '''
+
+    def Frames( self ):
+        return np.flatnonzero( self["good"] )
+
+    '''
+    Inputs:
+        (1) field = "body", "flagellum" or "head"
+        (2) k = integer, index of a frame
+    Output:
+        (1) 2-column integer array in (y,x) pairs, empty for a bad frame
+    '''
+
+    def Pixels( self, field, k ):
+        offsets = self[field+"_offsets"]
+        return self[field][ offsets[k]:offsets[k+1] ]
+
+    '''
+    Output:
+        (1) sperm = the dictionary of DetectingSpermBody
+    '''
+
+    def ToDictionary( self ):
+        n3 = len( self )
+        good = self["good"]
+        sperm = {}
+        for field in Fields:
+            sperm[field] = [ self.Pixels( field, k ).astype(np.float64) if good[k] else 'empty'
+                             for k in range(n3) ]
+        sperm["deltaT"] = float( self["deltaT"] )
+        sperm["frames"] = [ int(k) for k in self.Frames() ]
+        sperm["horizontality"] = [ ( int(self["horizontality"][k]), int(self["orientation"][k]) )
+                                   if good[k] else 'empty' for k in range(n3) ]
+        sperm["scale"] = float( self["scale"] )
+        sperm["size"] = tuple( [ int(n) for n in self["size"] ] )
+        return sperm
+
+    '''
+    Input:
+        (1) filename = name of the .mat file, the same as SpermInfo.mat of the dictionary layout
+    '''
+
+    def ExportMat( self, filename ):
+        import scipy.io as sio
+        sio.savemat( filename, self.ToDictionary() )
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Export SpermInfo.npz to a .mat file")
+    parser.add_argument('-i', '--input_file_name', type=str, required=True,
+                        help='SpermInfo.npz.')
+    parser.add_argument('-o', '--output_file_name', type=str, required=True,
+                        help='The .mat file.')
+    args = parser.parse_args()
+
+    SpermTable( args.input_file_name ).ExportMat( args.output_file_name )
+
+    return
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,298 @@
 from __future__ import print_function
-import SimpleITK as sitk
+import json
+import numpy as np
+
+from Engines import Engine, Rescale, Opening
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Parallel import MapFrames
 
 '''
 Inputs:
-    (1) movie = input ITK image
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
     (2) outputpath = output path
+    (3) method = string, "volume" (default) or "frame"
+            - "volume": one 3D opening with a zero radius along the frame axis
+            - "frame": a 2D opening frame by frame, written into a preallocated array
+    (4) workers = integer, number of processes sharing the frames
+    (5) chunksize = integer, number of frames handed to a process at a time
+    (6) background = string, estimator of the background, "ball" (default), "box", "decimated"
+            or "temporal"
+            - "ball": grayscale opening with a ball, exact
+            - "box": grayscale opening with a box of the same radius, which ITK runs in a
+                     time independent of the radius (van Herk/Gil-Werman)
+            - "decimated": grayscale opening with a ball on frames shrunk by factor
+                     (minimum of each factor x factor block), then enlarged back
+            - "temporal": the grayscale opening with a ball of a percentile over time of a
+                     window of frames, which slides along the movie, see TemporalWindows
+    (7) factor = integer, shrink factor of "decimated"
+    (8) window = integer, number of frames of the window of "temporal"
+    (9) percentile = float, percentile over time of the temporal background, 50 for the median
+    (10) errorframes = integer, number of frames on which an approximate background is compared
+            with the exact one; 0 for no comparison
+    (11) storage = string, "itk" (default) or "memmap", see FrameStore.py
+    (12) engines = dictionary {operation: engine} of the filters, see Engines.py; None for
+            the default engines
+    (13) stride = integer, number of frames sharing a temporal background, see TemporalWindows
 
 Outputs:
-    (1) newMovie = ITK image
+    (1) newMovie = ITK image, or the mapped output file with "memmap"
     (2) SpermStep1_CorrectingIllumination.mha saved in the output path
+    (3) SpermStep1_BackgroundError.json saved in the output path, if errorframes > 0
 '''
 
-def PreProcessing( movie, outputpath ):
+def PreProcessing( movie, outputpath, method="volume", workers=1, chunksize=None,
+                   background="ball", factor=4, window=100, percentile=50, errorframes=0,
+                   storage="itk", engines=None, stride=None ):
 
     '''
     Get the size of the movie.
     '''
-    n1,n2,n3 = movie.GetSize()
+    n1,n2,n3 = MovieSize( movie )
+    movie = MovieArray( movie )
 
     '''
-    Rescale intensity values of the image.
-    Note: RescaleIntensityImageFilter does not change pixel type.
+    Find the range of intensity values of the movie. Each chunk of frames is rescaled to
+    [0,255] before its opening, see RescaleFrames.
     '''
-    imadjust = sitk.RescaleIntensityImageFilter()
-    imadjust.SetOutputMinimum( 0 )
-    imadjust.SetOutputMaximum( 255 )
-    movie = imadjust.Execute( movie )   
+    intensity = ( float( movie.min() ), float( movie.max() ) )
 
     '''
-    Define erosion and dilation filters.
+    Define the radius of erosion and dilation filters.
     '''
-    radius = (n1/16,n2/16)
-    # Define grayscale erosion.
-    imerode = sitk.GrayscaleErodeImageFilter()
-    imerode.SetKernelType( sitk.sitkBall )
-    imerode.SetKernelRadius( radius )
-    # Define grayscale dilation.
-    imdilate = sitk.GrayscaleDilateImageFilter()
-    imdilate.SetKernelType( sitk.sitkBall )
-    imdilate.SetKernelRadius( radius )
+    radius = (n1//16,n2//16)
 
     print("  Correcting nonuniform illumination ...  ")
 
     '''
-    Apply grayscale opening to correct nonuniform illumination frame by frame.
+    Apply grayscale opening to correct nonuniform illumination, one chunk of frames at a time.
+    '''
+    newMovie = CreateMovie( outputpath+"SpermStep1_CorrectingIllumination.mha", (n1,n2,n3),
+                            np.uint16, storage )
+    engines = ( Engine( engines, "rescale" ), Engine( engines, "opening" ) )
+    if background == "temporal":
+        # The windows overlap, so they are not split among the processes; there is only one
+        # opening per stride of frames.
+        corrected = TemporalCorrection( movie, intensity, radius, window, stride, percentile,
+                                        engines )
+    else:
+        corrected = MapFrames( PreProcessFrames, movie,
+                               (intensity, radius, method, background, factor, percentile,
+                                engines),
+                               workers, chunksize )
+    for k0,k1,frames in corrected:
+        newMovie[k0:k1,:,:] = frames
+
+    '''
+    Compare an approximate background with the exact one on a few frames.
     '''
-    newMovie = sitk.Image(n1,n2,n3, sitk.sitkUInt16)
-    for ii in range(n3):
-        newImage = movie[:,:,ii] - imdilate.Execute( imerode.Execute( movie[:,:,ii]) )
-        volume = sitk.JoinSeries(newImage)
-        newMovie = sitk.Paste(newMovie, volume, volume.GetSize(), destinationIndex=[0,0,ii])
+    if errorframes > 0 and background != "ball":
+        sample = np.unique( np.linspace( 0, n3-1, min(errorframes,n3) ).astype(int) )
+        error = BackgroundError( RescaleFrames( movie[sample], intensity, engines[0] ),
+                                 newMovie[sample], radius, engines[1] )
+        error["background"] = background
+        error["factor"] = factor
+        error["window"] = window
+        error["percentile"] = percentile
+        error["frames"] = sample.tolist()
+        print("  Background error (%s): mean %.3f, max %d, differing pixels %.2f%%  "
+              % (background, error["mean_abs_error"], error["max_abs_error"],
+                 100*error["differing_pixels"]))
+        with open( outputpath+"SpermStep1_BackgroundError.json", "w" ) as f:
+            json.dump( error, f, indent=2 )
 
     '''
     Write out the result.
     '''
-    imwrite = sitk.ImageFileWriter()
-    imwrite.SetFileName( outputpath+"SpermStep1_CorrectingIllumination.mha" )
-    imwrite.Execute( newMovie )
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep1_CorrectingIllumination.mha" )
 
     return newMovie
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), frames of the movie
+    (2) intensity = (lo,hi), minimum and maximum of the whole movie
+    (3) engine = string, "itk" (default) or "scipy", see Engines.py
+Output:
+    (1) frames = numpy array of shape (m,n2,n1), rescaled so that lo becomes 0 and hi becomes 255
+
+Note: IntensityWindowingImageFilter does not change pixel type, and with the minimum and
+      maximum of the movie it gives the same result as RescaleIntensityImageFilter on the
+      whole movie.
+'''
+
+def RescaleFrames( frames, intensity, engine="itk" ):
+    return Rescale( frames, intensity, engine )
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), frames of the movie
+    (2) intensity = see RescaleFrames
+    (3) radius, method, background, factor, percentile = see CorrectIllumination
+    (4) engines = (rescale engine, opening engine), see Engines.py
+Output:
+    (1) newFrames = see CorrectIllumination
+'''
+
+def PreProcessFrames( frames, intensity, radius, method="volume", background="ball", factor=4,
+                      percentile=50, engines=("itk","itk") ):
+    return CorrectIllumination( RescaleFrames( frames, intensity, engines[0] ), radius, method,
+                                background, factor, percentile, engines[1] )
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), rescaled frames of the movie
+    (2) radius = (r1,r2), radius of the ball used by the opening
+    (3) method = string, "volume" or "frame", see PreProcessing
+    (4) background, factor, percentile = see PreProcessing
+    (5) engine = string, engine of the opening, "itk" (default) or "scipy", see Engines.py
+Output:
+    (1) newFrames = numpy array of shape (m,n2,n1) and type uint16, frames minus their background
+
+Note: With "temporal", all frames share the background of their percentile, so the frames
+      are one window.
+'''
+
+def CorrectIllumination( frames, radius, method="volume", background="ball", factor=4,
+                         percentile=50, engine="itk" ):
+    if background == "decimated":
+        B = DecimatedOpening( frames, radius, factor, engine )
+    elif background == "temporal":
+        B = TemporalOpening( frames, radius, percentile, engine )[np.newaxis,:,:]
+    elif background in ( "ball", "box" ):
+        B = Opening( frames, radius, background, method, engine )
+    else:
+        raise ValueError("Unknown background estimator: %s" % background)
+    # An approximate background may exceed a pixel, so clip the difference at 0; the
+    # opening never does.
+    return ( frames - np.minimum( B, frames ) ).astype(np.uint16)
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), rescaled frames of the movie
+    (2) radius = (r1,r2), radius of the ball at full resolution
+    (3) factor = integer, shrink factor
+    (4) engine = string, engine of the opening, see CorrectIllumination
+Output:
+    (1) B = numpy array of shape (m,n2,n1), estimated background of the frames
+'''
+
+def DecimatedOpening( frames, radius, factor, engine="itk" ):
+    m,n2,n1 = frames.shape
+    f = max( 1, int(factor) )
+
+    # Shrink each frame by taking the minimum of f x f blocks, so that thin bright
+    # structures do not leak into the background.
+    p2 = -n2 % f
+    p1 = -n1 % f
+    A = np.pad( frames, ((0,0),(0,p2),(0,p1)), mode="edge" )
+    A = A.reshape( m, (n2+p2)//f, f, (n1+p1)//f, f ).min( axis=4 ).min( axis=2 )
+
+    # Grayscale opening with the shrunk ball, frame by frame.
+    radius = ( max(1, radius[0]//f), max(1, radius[1]//f) )
+    A = Opening( A, radius, "ball", "volume", engine )
+
+    # Enlarge back to the size of the frames.
+    B = np.repeat( np.repeat( A, f, axis=1 ), f, axis=2 )[:,:n2,:n1]
+    return B
+
+
+'''
+Inputs:
+    (1) n3 = integer, number of frames of the movie
+    (2) window = integer, number of frames of the percentile over time; a window longer than
+            the movie is the whole movie
+    (3) stride = integer, number of frames sharing a background; None for a quarter of window
+Output:
+    (1) windows = list of (s0,s1,w0,w1): frames [s0,s1) are corrected with the background of
+            frames [w0,w1), the window centered on them, moved inside the movie at its ends
+
+Note: The windows of consecutive strides share all but stride frames, so the background
+      follows a drift of the illumination in small steps, at the cost of one opening per
+      stride. The windows only depend on the number of frames, so a run that is resumed
+      in streaming mode gives the same backgrounds.
+'''
+
+def TemporalWindows( n3, window, stride=None ):
+    window = max( 1, min( int(window), n3 ) )
+    if stride is None:
+        stride = window//4
+    stride = max( 1, int(stride) )
+    windows = []
+    for s0 in range( 0, n3, stride ):
+        s1 = min( n3, s0+stride )
+        w0 = min( max( 0, (s0+s1)//2 - window//2 ), n3-window )
+        windows.append( (s0, s1, w0, w0+window) )
+    ''' end of for loop on s0 '''
+    return windows
+
+
+'''
+Inputs:
+    (1) movie = numpy array of shape (n3,n2,n1), frames of the movie
+    (2) intensity = see RescaleFrames
+    (3) radius = (r1,r2), radius of the ball
+    (4) window, stride = see TemporalWindows
+    (5) percentile = see TemporalOpening
+    (6) engines = see PreProcessFrames
+Output:
+    (1) a generator of (s0, s1, newFrames), the frames [s0,s1) minus their background, as
+        uint16, see CorrectIllumination
+'''
+
+def TemporalCorrection( movie, intensity, radius, window, stride=None, percentile=50,
+                        engines=("itk","itk") ):
+    last = None
+    for s0,s1,w0,w1 in TemporalWindows( movie.shape[0], window, stride ):
+        # Windows clipped at the ends of the movie repeat, so reuse their background.
+        if (w0,w1) != last:
+            B = TemporalOpening( RescaleFrames( movie[w0:w1], intensity, engines[0] ), radius,
+                                 percentile, engines[1] )
+            last = (w0,w1)
+        frames = RescaleFrames( movie[s0:s1], intensity, engines[0] )
+        yield s0, s1, ( frames - np.minimum( B, frames ) ).astype(np.uint16)
+    ''' end of for loop on s0 '''
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), rescaled frames of the movie
+    (2) radius = (r1,r2), radius of the ball
+    (3) percentile = float, percentile over time, 50 for the median
+    (4) engine = string, engine of the opening, see CorrectIllumination
+Output:
+    (1) B = 2D numpy array, background shared by the frames
+'''
+
+def TemporalOpening( frames, radius, percentile=50, engine="itk" ):
+    # The sperm moves, so a pixel shows the background in most frames.
+    A = np.percentile( frames, percentile, axis=0 ).astype( frames.dtype )
+
+    # One grayscale opening with the ball removes what is left of the sperm.
+    B = Opening( A[np.newaxis,:,:], radius, "ball", "frame", engine )[0,:,:]
+    return B
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1), rescaled frames of the movie
+    (2) corrected = numpy array of shape (m,n2,n1), the same frames corrected with an
+            approximate background
+    (3) radius = (r1,r2), radius of the ball
+    (4) engine = string, engine of the opening, see CorrectIllumination
+Output:
+    (1) error = dictionary, mean and largest absolute difference to the exact correction,
+            and the fraction of pixels which differ
+'''
+
+def BackgroundError( frames, corrected, radius, engine="itk" ):
+    exact = CorrectIllumination( frames, radius, "volume", "ball", engine=engine )
+    D = np.absolute( corrected.astype(np.int64) - exact.astype(np.int64) )
+    error = {}
+    error["mean_abs_error"] = float( np.mean(D) )
+    error["max_abs_error"] = int( np.max(D) ) if D.size else 0
+    error["differing_pixels"] = float( np.mean(D > 0) ) if D.size else 0.0
+    return error
@@ -1,46 +1,66 @@
 from __future__ import print_function
-import SimpleITK as sitk
+import numpy as np
+
+from Engines import Engine, Median
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Parallel import MapFrames
 
 '''
 Inputs:
-    (1) movie = input ITK image
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
     (2) outputpath = output path
     (3) medfiltRadius = integer, parameter for MedianImageFilter, which sets the radius of the neighborhood
+    (4) method = string, "volume" (default) or "frame"
+            - "volume": one 3D median filter with a zero radius along the frame axis
+            - "frame": a 2D median filter frame by frame, written into a preallocated array
+    (5) workers = integer, number of processes sharing the frames
+    (6) chunksize = integer, number of frames handed to a process at a time
+    (7) storage = string, "itk" (default) or "memmap", see FrameStore.py
+    (8) engines = dictionary {operation: engine} of the filters, see Engines.py; None for
+            the default engines
 
 Outputs:
-    (1) newMovie = ITK image
+    (1) newMovie = ITK image, or the mapped output file with "memmap"
     (2) SpermStep2_Blurring.mha saved in the output path
 '''
 
-def Blurring( movie, outputpath, medfiltRadius ):
+def Blurring( movie, outputpath, medfiltRadius, method="volume", workers=1, chunksize=None,
+              storage="itk", engines=None ):
     
     '''
     Get the size of the movie.
     '''
-    (n1,n2,n3) = movie.GetSize()
-
-    '''
-    Define a 2D blurring filter.
-    '''
-    medfilt2 = sitk.MedianImageFilter()
-    medfilt2.SetRadius( medfiltRadius )
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
 
     print("  Performing median filtering ...  ")
 
     '''
-    Apply median friltering frame by frame.
+    Apply median friltering, one chunk of frames at a time.
     '''
-    newMovie = sitk.Image(n1,n2,n3, sitk.sitkUInt16)
-    for ii in range(n3):
-        newImage = medfilt2.Execute( movie[:,:,ii] )
-        volume = sitk.JoinSeries(newImage)
-        newMovie = sitk.Paste(newMovie, volume, volume.GetSize(), destinationIndex=[0,0,ii])
+    newMovie = CreateMovie( outputpath+"SpermStep2_Blurring.mha", (n1,n2,n3), np.uint16, storage )
+    for k0,k1,frames in MapFrames( MedianFrames, movie,
+                                   (medfiltRadius, method, Engine( engines, "median" )),
+                                   workers, chunksize ):
+        newMovie[k0:k1,:,:] = frames
 
     '''
     Write out the result.
     '''
-    imwrite = sitk.ImageFileWriter()
-    imwrite.SetFileName( outputpath+"SpermStep2_Blurring.mha" )
-    imwrite.Execute( newMovie )
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep2_Blurring.mha" )
 
     return newMovie
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) medfiltRadius = integer, radius of the median filter
+    (3) method = string, "volume" or "frame", see Blurring
+    (4) engine = string, "itk" (default) or "scipy", see Engines.py
+Output:
+    (1) newFrames = numpy array of shape (m,n2,n1) and type uint16, the filtered frames
+'''
+
+def MedianFrames( frames, medfiltRadius, method="volume", engine="itk" ):
+    return Median( frames, medfiltRadius, method, engine )
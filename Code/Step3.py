@@ -1,78 +1,278 @@
 from __future__ import print_function
 import numpy as np
-import SimpleITK as sitk
+import time
+
+from Engines import Engine, BoxMeans
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Parallel import MapFrames
 
 '''
 Inputs:
-    (1) movie = input ITK image
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
     (2) outputpath = output path
     (3) radius = integer, parameter for Thresholding, which sets the radius of the neighborhood
     (4) threshold = integer, parameter for Thresholding
     (5) stain = numpy array with 4 columns, regions of stains, [xmin, xmax, ymin, ymax]
-    
+    (6) method = string, "integral" (default) or "loop"
+            - "integral": all box means of a frame are read from one summed-area table
+            - "loop": the original pixel-by-pixel implementation, kept as a reference
+    (7) workers = integer, number of processes sharing the frames
+    (8) chunksize = integer, number of frames handed to a process at a time
+    (9) compact = boolean, store the result as uint8 instead of float64
+    (10) compress = boolean, write a compressed .mha file
+    (11) report = Profiling.Report which receives the time spent on each frame; None for no timing
+    (12) storage = string, "itk" (default) or "memmap", see FrameStore.py
+    (13) engines = dictionary {operation: engine} of the filters, see Engines.py; None for
+            the default engines
+
 Outputs:
-    (1) newMovie = ITK image
+    (1) newMovie = ITK image, or the mapped output file with "memmap"
     (2) SpermStep3_Thresholding.mha saved in the output path
 '''
 
-def Thresholding( movie, outputpath, radius, threshold, stain ):    
+def Thresholding( movie, outputpath, radius, threshold, stain, method="integral",
+                  workers=1, chunksize=None, compact=False, compress=False, report=None,
+                  storage="itk", engines=None ):
 
     '''
     Initialize a zero-array, then convert the array to an ITK image later.
     '''
-    (n1,n2,n3) = movie.GetSize()
-    newMovie = np.zeros( (n3,n2,n1) )
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
+    newMovie = CreateMovie( outputpath+"SpermStep3_Thresholding.mha", (n1,n2,n3),
+                            np.uint8 if compact else np.float64, storage )
+
+    print("  Thresholding ...  ")
 
     '''
-    Get the number of stains, i.e. ns1.
+    Do the following thresholding method, one chunk of frames at a time.
     '''
-    ns1,ns2 = stain.shape
+    timed = report is not None
+    for k0,k1,frames in MapFrames( ThresholdingFrames, movie,
+                                   (radius, threshold, stain, method, timed,
+                                    Engine( engines, "difference" )),
+                                   workers, chunksize ):
+        if timed:
+            frames, times = frames
+            report.AddFrameTimes( "Thresholding", k0, times )
+        newMovie[k0:k1,:,:] = frames
 
-    print("  Thresholding ...  ")
+    '''
+    Write out the result.
+    '''
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep3_Thresholding.mha", compress )
+
+    return newMovie
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) radius, threshold, stain, method = see Thresholding
+    (3) timed = boolean, also return the time spent on each frame
+    (4) engine = string, engine of the box means of "integral", "scipy" (default) or "itk",
+            see NeighborDifference
+Outputs:
+    (1) newFrames = numpy array of shape (m,n2,n1), the thresholding result of the frames
+    (2) times = list of length m (unit: second), only if timed
+'''
+
+def ThresholdingFrames( frames, radius, threshold, stain, method="integral", timed=False,
+                        engine="scipy" ):
 
     '''
-    Do the following thresholding method frame by frame.
+    Choose the thresholding engine.
     '''
-    for k in range(n3):
-        A = np.array( sitk.GetArrayFromImage( movie[:,:,k] ) )
-        for i in range( 3*radius+1, n2-3*radius ):
-            for j in range(3*radius+1,n1-3*radius):
-                
-                # Compute the average intensity of a square centered at (i,j).
-                center = np.mean( A[ i-radius : i+radius+1 , j-radius : j+radius+1 ] )
-
-                # Compute the average intensity of its four neighboring squares.
-                neiU = np.mean( A[ i-radius : i+radius+1 , j-3*radius-1 : j-radius ] )
-                neiD = np.mean( A[ i-radius : i+radius+1 , j+radius+1 : j+3*radius+2 ] )
-                neiL = np.mean( A[ i-3*radius-1 : i-radius , j-radius : j+radius+1 ] )
-                neiR = np.mean( A[ i+radius+1 : i+3*radius+2 , j-radius : j+radius+1 ] )
-
-                # Compute the differences.
-                dU = np.absolute( neiU - center )
-                dD = np.absolute( neiD - center )
-                dL = np.absolute( neiL - center )
-                dR = np.absolute( neiR - center )
-                
-                # If at least one difference exceeds the threshold value,
-                # then mark the index (i,j).
-                if dU > threshold or dD > threshold or dL > threshold or dR > threshold:
-                    newMovie[k,i,j] = 1
-                ''' end of if loop '''
-            ''' end of for loop on j '''
-        ''' end of for loop on i '''
+    if method == "integral":
+        ThresholdFrame = ThresholdingIntegral
+        options = ( engine, )
+    elif method == "loop":
+        ThresholdFrame = ThresholdingLoop
+        options = ()
+    else:
+        raise ValueError("Unknown thresholding method: %s" % method)
+
+    m,n2,n1 = frames.shape
+    newFrames = np.zeros( (m,n2,n1) )
+    times = []
+    for k in range(m):
+        start = time.time()
+        newFrames[k,:,:] = ThresholdFrame( frames[k,:,:], radius, threshold, *options )
 
         # Remove stains from the thresholding result.
-        for i in range(ns1):
-            newMovie[k, stain[i,2]:stain[i,3], stain[i,0]:stain[i,1] ].fill(0)
-        ''' end of for loop on i '''
+        RemoveStains( newFrames[k,:,:], stain )
+        times.append( time.time() - start )
     ''' end of for loop on k '''
 
-    '''
-    Write out the result.
-    '''
-    newMovie = sitk.GetImageFromArray(newMovie)
-    imwrite = sitk.ImageFileWriter()
-    imwrite.SetFileName( outputpath+"SpermStep3_Thresholding.mha" )
-    imwrite.Execute( newMovie )
+    if timed:
+        return newFrames, times
+    return newFrames
 
-    return newMovie
+
+'''
+Inputs:
+    (1) B = 2D numpy array, thresholding result of a frame, changed in place
+    (2) stain = see Thresholding
+'''
+
+def RemoveStains( B, stain ):
+    # Get the number of stains, i.e. ns1.
+    ns1,ns2 = stain.shape
+    for i in range(ns1):
+        B[ stain[i,2]:stain[i,3], stain[i,0]:stain[i,1] ].fill(0)
+    ''' end of for loop on i '''
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the movie
+    (2) radius = integer, radius of the neighborhood
+    (3) threshold = integer, threshold value
+Output:
+    (1) B = 2D numpy array of the same shape as A, 1 at marked pixels and 0 elsewhere
+'''
+
+def ThresholdingLoop( A, radius, threshold ):
+    n2,n1 = A.shape
+    B = np.zeros( (n2,n1) )
+    for i in range( 3*radius+1, n2-3*radius ):
+        for j in range(3*radius+1,n1-3*radius):
+
+            # Compute the average intensity of a square centered at (i,j).
+            center = np.mean( A[ i-radius : i+radius+1 , j-radius : j+radius+1 ] )
+
+            # Compute the average intensity of its four neighboring squares.
+            neiU = np.mean( A[ i-radius : i+radius+1 , j-3*radius-1 : j-radius ] )
+            neiD = np.mean( A[ i-radius : i+radius+1 , j+radius+1 : j+3*radius+2 ] )
+            neiL = np.mean( A[ i-3*radius-1 : i-radius , j-radius : j+radius+1 ] )
+            neiR = np.mean( A[ i+radius+1 : i+3*radius+2 , j-radius : j+radius+1 ] )
+
+            # Compute the differences.
+            dU = np.absolute( neiU - center )
+            dD = np.absolute( neiD - center )
+            dL = np.absolute( neiL - center )
+            dR = np.absolute( neiR - center )
+
+            # If at least one difference exceeds the threshold value,
+            # then mark the index (i,j).
+            if dU > threshold or dD > threshold or dL > threshold or dR > threshold:
+                B[i,j] = 1
+            ''' end of if loop '''
+        ''' end of for loop on j '''
+    ''' end of for loop on i '''
+
+    return B
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the movie
+    (2) radius = integer, radius of the neighborhood
+    (3) threshold = integer, threshold value
+    (4) engine = string, "scipy" (default) or "itk", see NeighborDifference
+Output:
+    (1) B = 2D numpy array of the same shape as A, 1 at marked pixels and 0 elsewhere
+
+Note: For integer pixel types the box sums are exact, so B is identical to the
+      output of ThresholdingLoop, including the squares that are cut off by the
+      last row and column of the frame.
+'''
+
+def ThresholdingIntegral( A, radius, threshold, engine="scipy" ):
+    n2,n1 = A.shape
+    B = np.zeros( (n2,n1) )
+
+    I,J,D = NeighborDifference( A, radius, engine )
+    if D is None:
+        return B
+
+    # If at least one difference exceeds the threshold value, then mark the pixel.
+    B[ I[0]:I[-1]+1, J[0]:J[-1]+1 ] = D > threshold
+
+    return B
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the movie
+    (2) radius = integer, radius of the neighborhood
+    (3) engine = string, "scipy" (default) or "itk"
+            - "scipy": the box means are read from a summed-area table with NumPy
+            - "itk": the box means are computed by BoxMean of SimpleITK, see Engines.py
+Outputs:
+    (1) I, J = 1D integer arrays, rows and columns of the pixels that are tested
+    (2) D = 2D numpy array, D[a,b] = largest absolute difference between the mean of the square
+            centered at (I[a],J[b]) and the means of its four neighboring squares;
+            None if no pixel is tested
+
+Note: D does not depend on the threshold value, so the masks of several threshold values
+      can be derived from one D, see Sweep.py. Both engines give the same D for integer
+      pixel types.
+'''
+
+def NeighborDifference( A, radius, engine="scipy" ):
+    n2,n1 = A.shape
+
+    # Indices of the pixels that are tested.
+    I = np.arange( 3*radius+1, n2-3*radius )
+    J = np.arange( 3*radius+1, n1-3*radius )
+    if len(I) == 0 or len(J) == 0:
+        return I, J, None
+
+    if engine == "itk":
+        # The neighboring squares are centered 2*radius+1 pixels away. A square whose
+        # center is outside the frame is empty, so pad the means with nan.
+        s = 2*radius+1
+        M = np.pad( BoxMeans( A, radius ), s, mode="constant", constant_values=np.nan )
+        center = M[ np.ix_( I+s, J+s ) ]
+        D = np.absolute( M[ np.ix_( I+s, J ) ] - center )
+        D = np.fmax( D, np.absolute( M[ np.ix_( I+s, J+2*s ) ] - center ) )
+        D = np.fmax( D, np.absolute( M[ np.ix_( I, J+s ) ] - center ) )
+        D = np.fmax( D, np.absolute( M[ np.ix_( I+2*s, J+s ) ] - center ) )
+        return I, J, D
+    elif engine != "scipy":
+        raise ValueError("Unknown engine: %s" % engine)
+
+    # Compute the summed-area table, S[i,j] = sum of A[0:i,0:j].
+    if np.issubdtype( A.dtype, np.integer ) or A.dtype == np.bool_:
+        S = np.zeros( (n2+1,n1+1), dtype=np.int64 )
+    else:
+        S = np.zeros( (n2+1,n1+1), dtype=np.float64 )
+    S[1:,1:] = np.cumsum( np.cumsum( A, axis=0, dtype=S.dtype ), axis=1 )
+
+    # Compute the average intensity of a square centered at (i,j).
+    center = BoxMean( S, I-radius, I+radius+1, J-radius, J+radius+1 )
+
+    # Compute the differences to its four neighboring squares.
+    # Slices of the squares are clipped at the border just like numpy slicing.
+    # fmax skips the nan of empty squares, which never exceed the threshold.
+    D = np.absolute( BoxMean( S, I-radius, I+radius+1, J-3*radius-1, J-radius ) - center )
+    D = np.fmax( D, np.absolute( BoxMean( S, I-radius, I+radius+1,
+                                          J+radius+1, J+3*radius+2 ) - center ) )
+    D = np.fmax( D, np.absolute( BoxMean( S, I-3*radius-1, I-radius,
+                                          J-radius, J+radius+1 ) - center ) )
+    D = np.fmax( D, np.absolute( BoxMean( S, I+radius+1, I+3*radius+2,
+                                          J-radius, J+radius+1 ) - center ) )
+
+    return I, J, D
+
+
+'''
+Inputs:
+    (1) S = summed-area table of a frame, of shape (n2+1,n1+1)
+    (2) rlo, rhi = 1D integer arrays, row bounds [rlo,rhi) of the squares
+    (3) clo, chi = 1D integer arrays, column bounds [clo,chi) of the squares
+Output:
+    (1) M = 2D numpy array, M[a,b] = mean over rows [rlo[a],rhi[a]) and columns [clo[b],chi[b])
+'''
+
+def BoxMean( S, rlo, rhi, clo, chi ):
+    rhi = np.minimum( rhi, S.shape[0]-1 )
+    chi = np.minimum( chi, S.shape[1]-1 )
+    total = ( S[np.ix_(rhi,chi)] - S[np.ix_(rlo,chi)]
+              - S[np.ix_(rhi,clo)] + S[np.ix_(rlo,clo)] )
+    count = np.outer( rhi-rlo, chi-clo )
+    # An empty square gives nan, which never exceeds the threshold (same as np.mean).
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        M = total / count
+    return M
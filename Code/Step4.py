@@ -1,12 +1,14 @@
 from __future__ import print_function
 import numpy as np
-import SimpleITK as sitk
+import time
 
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Parallel import MapFrames
 from Step4Helpers import *
 
 ''' 
 Inputs:
-    (1) movie = input ITK image
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
     (2) outputpath = output path
     (3) dt = time elapsed between two consecutive frames
     (4) scale = nm/pixel
@@ -16,22 +18,92 @@ Inputs:
             2*headbodyratio, the frame is considered as a valid frame; if not, 
             no further calculations using the information of this frame.
     (8) threshold2 = integer, the threshold value which determines outliers in the head
+    (9) workers = integer, number of processes sharing the frames
+    (10) chunksize = integer, number of frames handed to a process at a time
+    (11) compress = boolean, write a compressed .mha file
+    (12) packed = boolean, keep the masks packed 8 pixels per byte during the analysis;
+            the output movie is then of type uint8
+    (13) method = string, "vectorized" (default), "loop" or "pca"
+            - "vectorized": GoodFrameTest and SeparateHeadTail
+            - "loop": GoodFrameTestLoop and SeparateHeadTailLoop, kept as a reference
+            - "pca": SeparateHeadTailPCA, along the principal axis of the body; the head
+                     and the flagellum hold all their pixels, and window is not used
+    (14) report = Profiling.Report which receives the time spent on each frame; None for no timing
+    (15) storage = string, "itk" (default) or "memmap", see FrameStore.py
+    (16) window = integer, seed the orientation and the head of each frame with those of the
+            previous good frame (of the same chunk of frames), searching the head within
+            window pixels of the previous one, see HeadSeed; None searches every frame anew
     
 Outputs:
-    (1) newMovie = ITK image
+    (1) newMovie = ITK image, or the mapped output file with "memmap"
     (2) sperm = a dictionary which contains some numerics regarding to the segmentation result
     (3) SpermStep4_GoodFramesOnly.mha saved in the output path
 '''
 
 def DetectingSpermBody( movie, outputpath, dt, scale,
-                        threshold1, maxheadwidth, headbodyratio, threshold2 ):
+                        threshold1, maxheadwidth, headbodyratio, threshold2,
+                        workers=1, chunksize=None, compress=False, packed=False,
+                        method="vectorized", report=None, storage="itk", window=None ):
 
     '''
     Convert the ITK image to a numpy array.
+    Note: uint8 masks are used as they are, without converting them to float.
     '''
-    (n1,n2,n3) = movie.GetSize()
-    movie = np.array( sitk.GetArrayFromImage( movie ) )
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
+    timed = report is not None
+    if packed:
+        movie = np.packbits( movie == 1, axis=2 )
+        args = (threshold1, maxheadwidth, headbodyratio, threshold2, n1, method, timed, window)
+    else:
+        args = (threshold1, maxheadwidth, headbodyratio, threshold2, None, method, timed, window)
+    newMovie = CreateMovie( outputpath+"SpermStep4_GoodFramesOnly.mha", (n1,n2,n3),
+                            np.uint8 if packed else movie.dtype, storage )
 
+    print("  Sperating head and flagellum ...  ")
+
+    '''
+    Analyze sperm motility frame by frame, then collect the results in frame order.
+    '''
+    Results = [ None ] * n3
+    for k0,k1,results in MapFrames( AnalyzeFrames, movie, args, workers, chunksize ):
+        if timed:
+            results, times = results
+            report.AddFrameTimes( "DetectingSpermBody", k0, times )
+        Results[k0:k1] = results
+        if packed:
+            newMovie[k0:k1,:,:] = np.unpackbits( movie[k0:k1,:,:], axis=2 )[:,:,:n1]
+        else:
+            newMovie[k0:k1,:,:] = movie[k0:k1,:,:]
+        for k,result in zip( range(k0,k1), results ):
+            if result is None:
+                # Erase the information about "bad" frames.
+                newMovie[k,:,:] = 0
+    ''' end of for loop on k '''
+
+    '''
+    Step 4.5 Put the results together.
+    '''
+    sperm = SpermDictionary( Results, dt, scale, n1, n2 )
+
+    '''
+    Step 4.6 Write out the result.
+    '''
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep4_GoodFramesOnly.mha", compress )
+
+    return newMovie, sperm
+
+
+'''
+Inputs:
+    (1) results = list of length n3, the output of AnalyzeFrame for each frame
+    (2) dt, scale = see DetectingSpermBody
+    (3) n1, n2 = size of the frames
+Output:
+    (1) sperm = a dictionary which contains some numerics regarding to the segmentation result
+'''
+
+def SpermDictionary( results, dt, scale, n1, n2 ):
     '''
     Initialize some features that characterize sperm motility.
     '''
@@ -41,115 +113,22 @@ def DetectingSpermBody( movie, outputpath, dt, scale,
     Head = []
     Horizontality = []
 
-    print("  Sperating head and flagellum ...  ")
-
-    '''
-    Analyze sperm motility frame by frame.
-    '''
-    for k in range(n3):
-        A = movie[k,:,:]
-
-        '''
-        Step 4.1 Remove outliers.
-            - pixels_raw = 2-column np.array in (y,x) pairs
-            - body = 2-column np.array in (y,x) pairs
-        '''
-        # Find the indicies (i,j) such that A[i,j] = 1.
-        row,col = np.where( A == 1 )
-        # pixels_raw = list of (i,j) such that A[i,j] = 1.
-        pixels_raw = np.array([row,col]).transpose()
-        # body = pixels_raw - outliers
-        body = RemoveOutliers2D( pixels_raw, threshold1 )
-        # Count the unique values in x-axis and y-axis, respectively.
-        xnum = len( np.unique( body[:,1] ) )
-        ynum = len( np.unique( body[:,0] ) )
-        
-        '''
-        Step 4.2 Determine horizontality.
-            - lowercurve = 2-column np.array in (y,x) pairs
-            - uppercurve = 2-column np.array in (y,x) pairs
-        '''
-        if xnum>=ynum:
-            # The sperm is swimming horizontally.
-            horizontality = 1
-            # Sort the array such that the 2nd column is ascending.
-            body = body[ np.argsort( body[:, 1] ) ]
-            # Compute the lower and upper curves.
-            lowercurve = SimplifyX(body,1)
-            uppercurve = SimplifyX(body,0)
-        else:
-            # The sperm is swimming vertically.
-            horizontality = 0
-            # Sort the array such that the 1st column is ascending.
-            body = body[ np.argsort( body[:, 0] ) ]
-            # Compute the lower and upper curves.
-            lowercurve = SimplifyY(body,1)
-            uppercurve = SimplifyY(body,0)
-        ''' end of if ( xnum >= ynum ) loop '''
-        
-        '''
-        Step 4.3 Determine whether this frame is a good frame.
-            - goodframe = boolean
-            - data, head = 2-column np.array in (x,y) pairs if xnum>=ynum,
-                            in (y,x) pairs if xnum<ynum
-        '''
-        # Check whether a decent portion of the flagellum has been segmented.
-        # That is, length(head)/length(body) can not exceed headbodyratio.
-        if xnum>=ynum:
-            # Make (x,y) pairs.
-            lowercurve1 = np.fliplr(lowercurve)
-            uppercurve1 = np.fliplr(uppercurve)
-            body1 = np.fliplr(body)
-            goodframe, data, head = GoodFrameTest(lowercurve1,uppercurve1,body1,
-                                                  maxheadwidth,headbodyratio)
-        else:
-            lowcurve = np.fliplr(lowercurve)
-            uppcurve = np.fliplr(uppercurve)
-            goodframe, data, head = GoodFrameTest(lowercurve,uppercurve,body,
-                                                  maxheadwidth,headbodyratio)
-        ''' end of if ( xnum >= ynum ) loop '''
-        
-        '''
-        Step 4.4 Separate body into head and flagellum.
-            - head = 2-column np.array in (y,x) pairs
-            - flagellum = 2-column np.array in (y,x) pairs
-        '''
-        # If length(head)/length(body) < headbodyratio, do further calculations.
-        # Otherwise, go to ii = ii+1.
-        if goodframe:
-            if xnum>=ynum:
-                head1, flagellum1, orientation = SeparateHeadTail(lowercurve1,uppercurve1,
-                                                     body1,data,head,threshold2)
-                # Make (y,x) pairs.
-                head = np.fliplr(head1)
-                flagellum = np.fliplr(flagellum1)
-            else:
-                head, flagellum, orientation = SeparateHeadTail(lowercurve,uppercurve,
-                                                   body,data,head,threshold2)
-            ''' end of if ( xnum >= ynum ) loop '''
-
-            '''
-            Step 4.5 Put the results together.
-            '''
+    for k,result in enumerate( results ):
+        if result is not None:
+            body, flagellum, head, horizontality, orientation = result
             Body.append( body )
             Flagellum.append( flagellum )
             Frame.append( k )
             Head.append( head )
             Horizontality.append( (horizontality,orientation) )
-
         else:
             Body.append( 'empty' )
             Flagellum.append( 'empty' )
             Head.append( 'empty' )
             Horizontality.append( 'empty' )
-            # Erase the information about "bad" frames.
-            movie[k,:,:] = np.zeros( (n2,n1) )
-        ''' end of if ( goodframe ) loop '''            
+        ''' end of if ( result is not None ) loop '''
     ''' end of for loop on k '''
 
-    '''
-    Step 4.5 Put the results together (continued).
-    '''
     sperm = {}
     sperm["body"] = Body
     sperm["deltaT"] = dt
@@ -159,13 +138,210 @@ def DetectingSpermBody( movie, outputpath, dt, scale,
     sperm["horizontality"] = Horizontality
     sperm["scale"] = scale
     sperm["size"] = (n1,n2)
+    return sperm
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) threshold1, maxheadwidth, headbodyratio, threshold2 = see DetectingSpermBody
+    (3) n1 = integer, width of the frames if they are packed 8 pixels per byte, None otherwise
+    (4) method = string, see DetectingSpermBody
+    (5) timed = boolean, also return the time spent on each frame
+    (6) window = integer, see DetectingSpermBody
+Outputs:
+    (1) results = list of length m, the output of AnalyzeFrame for each frame
+    (2) times = list of length m (unit: second), only if timed
+'''
+
+def AnalyzeFrames( frames, threshold1, maxheadwidth, headbodyratio, threshold2, n1=None,
+                   method="vectorized", timed=False, window=None ):
+    results = []
+    times = []
+    seed = None
+    for k in range( frames.shape[0] ):
+        start = time.time()
+        A = frames[k,:,:]
+        if n1 is not None:
+            A = np.unpackbits( A, axis=1 )[:,:n1]
+        result = AnalyzeFrame( A, threshold1, maxheadwidth, headbodyratio, threshold2, method,
+                               seed )
+        if window is not None and result is not None:
+            seed = HeadSeed( result, window )
+        results.append( result )
+        times.append( time.time() - start )
+    if timed:
+        return results, times
+    return results
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the thresholding result
+    (2) threshold1, maxheadwidth, headbodyratio, threshold2, method = see DetectingSpermBody
+    (3) seed = output of HeadSeed for the previous good frame; None for a full search
+Output:
+    (1) None if the frame is not a good frame, otherwise a tuple
+        (body, flagellum, head, horizontality, orientation)
+'''
+
+def AnalyzeFrame( A, threshold1, maxheadwidth, headbodyratio, threshold2, method="vectorized",
+                  seed=None ):
+    # Find the indicies (i,j) such that A[i,j] = 1.
+    row,col = np.where( A == 1 )
+    # pixels_raw = list of (i,j) such that A[i,j] = 1.
+    pixels_raw = np.array([row,col]).transpose()
+    return AnalyzePixels( pixels_raw, threshold1, maxheadwidth, headbodyratio, threshold2,
+                          method, seed )
+
+
+'''
+Inputs:
+    (1) pixels_raw = 2-column numpy array in (y,x) pairs, the marked pixels of one sperm in
+            row-major order, as np.where returns them
+    (2) threshold1, maxheadwidth, headbodyratio, threshold2, method = see DetectingSpermBody
+    (3) seed = see AnalyzeFrame
+Output:
+    (1) the same as AnalyzeFrame
+'''
+
+def AnalyzePixels( pixels_raw, threshold1, maxheadwidth, headbodyratio, threshold2,
+                   method="vectorized", seed=None ):
 
     '''
-    Step 4.6 Write out the result.
+    Choose the implementation of Steps 4.3 and 4.4.
     '''
-    newMovie = sitk.GetImageFromArray(movie)
-    imwrite = sitk.ImageFileWriter()
-    imwrite.SetFileName( outputpath+"SpermStep4_GoodFramesOnly.mha" )
-    imwrite.Execute( newMovie )
+    if method == "vectorized":
+        GoodFrame, Separate = GoodFrameTest, SeparateHeadTail
+    elif method == "loop":
+        GoodFrame, Separate = GoodFrameTestLoop, SeparateHeadTailLoop
+    elif method == "pca":
+        GoodFrame, Separate = None, SeparateHeadTailPCA
+    else:
+        raise ValueError("Unknown analysis method: %s" % method)
 
-    return newMovie, sperm
+    '''
+    Step 4.1 Remove outliers.
+        - pixels_raw = 2-column np.array in (y,x) pairs
+        - body = 2-column np.array in (y,x) pairs
+    '''
+    # An empty mask (e.g. after a high threshold) has no sperm.
+    if len( pixels_raw ) == 0:
+        return None
+    # body = pixels_raw - outliers
+    body = RemoveOutliers2D( pixels_raw, threshold1 )
+    if len( body ) == 0:
+        return None
+
+    '''
+    Steps 4.2-4.4 along the principal axis of the body, in one pass.
+    '''
+    if method == "pca":
+        goodframe, head, flagellum, horizontality, orientation = Separate( body, maxheadwidth,
+                                                                          headbodyratio,
+                                                                          threshold2 )
+        if goodframe:
+            return body, flagellum, head, horizontality, orientation
+        return None
+    
+    '''
+    Step 4.2 Determine horizontality.
+        - lowercurve = 2-column np.array in (y,x) pairs
+        - uppercurve = 2-column np.array in (y,x) pairs
+        - window = range of the independent variable where the head is searched, see HeadSeed
+    '''
+    if seed is None:
+        # Count the unique values in x-axis and y-axis, respectively.
+        xnum = len( np.unique( body[:,1] ) )
+        ynum = len( np.unique( body[:,0] ) )
+        horizontality = 1 if xnum>=ynum else 0
+        window = None
+    else:
+        # Keep the orientation of the previous good frame unless the body clearly turned.
+        horizontality = CoherentHorizontality( body, seed[0] )
+        window = seed[1] if horizontality == seed[0] else None
+    if horizontality == 1:
+        # The sperm is swimming horizontally.
+        # Sort the array such that the 2nd column is ascending.
+        body = body[ np.argsort( body[:, 1] ) ]
+        # Compute the lower and upper curves.
+        lowercurve = SimplifyX(body,1)
+        uppercurve = SimplifyX(body,0)
+    else:
+        # The sperm is swimming vertically.
+        # Sort the array such that the 1st column is ascending.
+        body = body[ np.argsort( body[:, 0] ) ]
+        # Compute the lower and upper curves.
+        lowercurve = SimplifyY(body,1)
+        uppercurve = SimplifyY(body,0)
+    ''' end of if ( horizontality == 1 ) loop '''
+    
+    '''
+    Step 4.3 Determine whether this frame is a good frame.
+        - goodframe = boolean
+        - data, head = 2-column np.array in (x,y) pairs if horizontality=1,
+                        in (y,x) pairs if horizontality=0
+    '''
+    # Check whether a decent portion of the flagellum has been segmented.
+    # That is, length(head)/length(body) can not exceed headbodyratio.
+    if horizontality == 1:
+        # Make (x,y) pairs.
+        lowercurve1 = np.fliplr(lowercurve)
+        uppercurve1 = np.fliplr(uppercurve)
+        body1 = np.fliplr(body)
+        goodframe, data, head = GoodFrame(lowercurve1,uppercurve1,body1,
+                                          maxheadwidth,headbodyratio,window)
+    else:
+        lowcurve = np.fliplr(lowercurve)
+        uppcurve = np.fliplr(uppercurve)
+        goodframe, data, head = GoodFrame(lowercurve,uppercurve,body,
+                                          maxheadwidth,headbodyratio,window)
+    ''' end of if ( horizontality == 1 ) loop '''
+    
+    '''
+    Step 4.4 Separate body into head and flagellum.
+        - head = 2-column np.array in (y,x) pairs
+        - flagellum = 2-column np.array in (y,x) pairs
+    '''
+    # If length(head)/length(body) < headbodyratio, do further calculations.
+    # Otherwise, go to ii = ii+1.
+    if goodframe:
+        if horizontality == 1:
+            head1, flagellum1, orientation = Separate(lowercurve1,uppercurve1,
+                                                      body1,data,head,threshold2,window)
+            # Make (y,x) pairs.
+            head = np.fliplr(head1)
+            flagellum = np.fliplr(flagellum1)
+        else:
+            head, flagellum, orientation = Separate(lowercurve,uppercurve,
+                                                    body,data,head,threshold2,window)
+        ''' end of if ( horizontality == 1 ) loop '''
+
+        return body, flagellum, head, horizontality, orientation
+
+    # The seeded search failed, search the whole body.
+    if seed is not None:
+        return AnalyzePixels( pixels_raw, threshold1, maxheadwidth, headbodyratio, threshold2,
+                              method )
+    return None
+
+
+'''
+Inputs:
+    (1) result = output of AnalyzeFrame for a good frame
+    (2) window = integer, number of pixels the head may move between two frames
+Output:
+    (1) seed = (horizontality, (lo,hi,width)), the orientation of the sperm, the range of
+            the independent variable (x if horizontal, y if vertical) around the center of the
+            head, where the head of the next frame is searched first, and the width of the
+            head across it; None without a head
+'''
+
+def HeadSeed( result, window ):
+    head, horizontality = result[2], result[3]
+    if len(head) == 0:
+        return None
+    # The independent variable is the 2nd column (x) if horizontal, the 1st one (y) if not.
+    center = np.mean( head[:,horizontality] )
+    width = np.ptp( head[:,1-horizontality] )
+    return ( horizontality, (center-window, center+window, width) )
@@ -1,3 +1,5 @@
+from __future__ import print_function
+import argparse
 import numpy as np
 
 
@@ -23,18 +25,8 @@ def RemoveOutliers2D(A,outliercriterion):
     ymax = ymu + ysd * outliercriterion
 
     # Remove outliers.
-    n1,n2 = A.shape
-    C = np.zeros( (n1,n2) ).astype('float')
-    for i in range(n1):
-        if A[i,0]>=xmin and A[i,0]<=xmax and A[i,1]>=ymin and A[i,1]<=ymax :
-            C[i,:] = A[i,:]
-        else:
-            C[i,0] = np.nan
-            C[i,1] = np.nan
-    ''' end of for loop '''
-
-    # Remove nan entries.
-    C = C[~np.isnan(C).any(axis=1)]
+    keep = (A[:,0]>=xmin) & (A[:,0]<=xmax) & (A[:,1]>=ymin) & (A[:,1]<=ymax)
+    C = A[keep,:].astype('float')
     
     return C
 
@@ -52,21 +44,15 @@ Output:
 '''
 
 def SimplifyX(A,b):
-    # Find the unique elements in the 2nd column.
-    xvalues = np.unique( A[:,1] )
+    # Find the unique elements in the 2nd column and the rows where they appear
+    # for the first time (b=1) or for the last time (b=0).
+    row = FirstOrLastRows( A[:,1], b )
     # Initialize C and set the 2nd column.
-    n = len( xvalues )
+    n = len( row )
     C = np.zeros((n,2))
-    C[:,1] = xvalues
-
-    for ii in range(n):
-        # Find indicies (r,1) such that M[r,1] = xvalues[ii].
-        row = np.where( A[:,1] == xvalues[ii] )
-        # Set the 1st column of C.
-        if b == 1:
-            C[ii,0] = A[np.amin(row),0]
-        elif b == 0:
-            C[ii,0] = A[np.amax(row),0]
+    C[:,1] = A[row,1]
+    # Set the 1st column of C.
+    C[:,0] = A[row,0]
     return C
 
 
@@ -83,24 +69,38 @@ Output:
 '''
 
 def SimplifyY(A,b):
-    # Find the unique elements in the 1st column.
-    yvalues = np.unique( A[:,0] )
+    # Find the unique elements in the 1st column and the rows where they appear
+    # for the first time (b=1) or for the last time (b=0).
+    row = FirstOrLastRows( A[:,0], b )
     # Initialize C and set the 1st column.
-    n = len( yvalues )
+    n = len( row )
     C = np.zeros((n,2))
-    C[:,0] = yvalues
-
-    for ii in range(n):
-        # Find indicies (r,0) such that M[r,0] = yvalues[ii].
-        row = np.where( A[:,0] == yvalues[ii] )
-        # Set the 2nd column of C.
-        if b == 1:
-            C[ii,1] = A[np.amin(row),1]
-        elif b == 0:
-            C[ii,1] = A[np.amax(row),1]
+    C[:,0] = A[row,0]
+    # Set the 2nd column of C.
+    C[:,1] = A[row,1]
     return C
 
 
+'''
+Inputs:
+    v = 1D numpy array
+    b = boolean
+        - b=1: the first row of each value
+        - b=0: the last row of each value
+Output:
+    row = 1D integer array, row[ii] is the first/last index r with v[r] = np.unique(v)[ii]
+'''
+
+def FirstOrLastRows(v,b):
+    if b == 1:
+        values, row = np.unique( v, return_index=True )
+    else:
+        # The first appearance in the reversed array is the last one in v.
+        values, row = np.unique( v[::-1], return_index=True )
+        row = len(v) - 1 - row
+    return row
+
+
 '''
 Input:
     lowercurve, uppercurve = two 2-column arrays with almost identical first columns
@@ -111,6 +111,8 @@ Input:
     headbodyratio = smallest (half head length)/(body length) of a segmentation result
         which is considered as a good segmentation
         Set headbodyratio = 1/4.
+    window = (lo,hi,width), the head of the previous good frame, see HeadPeak
+        Set window = None to search the whole body.
 
 Outputs:
     goodframe = boolean
@@ -119,7 +121,7 @@ Outputs:
         goodframe=0 : the segmentation of this frame is not acceptable,
                       to further computation
 '''
-def GoodFrameTest(lowercurve,uppercurve,body,maxheadwidth,headbodyratio):
+def GoodFrameTest(lowercurve,uppercurve,body,maxheadwidth,headbodyratio,window=None):
     # Put two curves together.
     head = np.concatenate( (lowercurve, uppercurve), axis=0 )
     # Rearange the rows so that the 1st column (i.e. x values) is increasing.
@@ -132,26 +134,19 @@ def GoodFrameTest(lowercurve,uppercurve,body,maxheadwidth,headbodyratio):
     data = np.zeros((n,2))
     data[:,0] = xvalues
 
-    # Determine the values in the 2nd column.
-    for ii in range(n):
-        xx = xvalues[ii]
-        if np.in1d( xx, lowercurve[:,0] ):
-            if np.in1d( xx, uppercurve[:,0] ):
-                # If xx is both in lowercurve and upper curve, then find the indices r1, r2 
-                # such that lowercurve[r1,0] = xx, uppercurve[r2,0] = xx.
-                r1 = np.amin( np.where( lowercurve[:,0]==xx ) )
-                r2 = np.amin( np.where( uppercurve[:,0]==xx ) )
-                # Compute the difference of the 2nd components.
-                d = np.absolute( lowercurve[r1,1] - uppercurve[r2,1] )
-                # If d does not exceed maximum head width, then set data[ii,1] equal to d.
-                if d <= maxheadwidth:
-                    data[ii,1] = d
-                ''' end of if ( d <= maxheadwidth ) loop '''
-        ''' end of if ( np.in1d( xx, lowercurve[:,0] ) ) loop '''
-    ''' end of for loop '''
+    # Align both curves with xvalues, i.e. find the indices r1, r2
+    # such that lowercurve[r1,0] = xx, uppercurve[r2,0] = xx.
+    inlower, r1 = MatchRows( lowercurve[:,0], xvalues )
+    inupper, r2 = MatchRows( uppercurve[:,0], xvalues )
+    # Compute the difference of the 2nd components.
+    d = np.absolute( lowercurve[r1,1] - uppercurve[r2,1] )
+    # If xx is both in lowercurve and upper curve, and d does not exceed
+    # maximum head width, then set data[ii,1] equal to d.
+    valid = inlower & inupper & ( d <= maxheadwidth )
+    data[valid,1] = d[valid]
 
     # Find the index where the maximum appears.
-    p = np.argmax( data[:,1] )
+    p = HeadPeak( data, window )
     if float(p-1)/n <= headbodyratio or float(n-p)/n <= headbodyratio:
         # If the segmentation result has a decent head/body ratio,
         # then the frame is considered as a good one.
@@ -162,6 +157,75 @@ def GoodFrameTest(lowercurve,uppercurve,body,maxheadwidth,headbodyratio):
     return goodframe, data, head
 
 
+'''
+Inputs:
+    data = the array of GoodFrameTest, the width of the body for each value of the 1st column
+    window = (lo,hi,width), range of the 1st column where the head of the previous good frame
+        was, and the width of its widest part; or None
+    tolerance = smallest ratio of the width of the head to the width in the previous frame
+Output:
+    p = index of the row of data at the widest part of the head
+        The widest part inside the window is taken if the head kept about its width;
+        otherwise, or without a window, the widest part of the whole body.
+'''
+
+def HeadPeak(data,window=None,tolerance=0.8):
+    p = np.argmax( data[:,1] )
+    if window is None:
+        return p
+    lo, hi, width = window
+    inside = np.flatnonzero( (data[:,0]>=lo) & (data[:,0]<=hi) )
+    if len(inside) == 0:
+        return p
+    q = inside[ np.argmax( data[inside,1] ) ]
+    if data[q,1] >= tolerance*width:
+        return q
+    return p
+
+
+'''
+Inputs:
+    body = 2-column array in (y,x) pairs
+    horizontality = the orientation of the previous good frame
+        horizontality=1 : swimming horizontally, horizontality=0 : vertically
+    margin = the extent of the body across the previous orientation has to exceed the one
+        along it by this fraction before the orientation changes
+Output:
+    horizontality = the orientation of the body
+'''
+
+def CoherentHorizontality(body,horizontality,margin=0.25):
+    # Extent of the body along y and along x.
+    extent = np.ptp( body, axis=0 ) + 1
+    if extent[1-horizontality] > (1+margin)*extent[horizontality]:
+        return 1-horizontality
+    return horizontality
+
+
+'''
+Inputs:
+    v = 1D numpy array
+    values = 1D numpy array
+Outputs:
+    found = boolean array, found[ii]=1 if values[ii] is in v
+    row = integer array, row[ii] = the first index r such that v[r] = values[ii]
+        (0 if values[ii] is not in v)
+'''
+
+def MatchRows(v,values):
+    found = np.zeros( len(values), dtype=bool )
+    row = np.zeros( len(values), dtype=int )
+    if len(v) == 0:
+        return found, row
+    # Find the unique elements in v and where they appear for the first time.
+    vvalues, first = np.unique( v, return_index=True )
+    # Merge the sorted arrays.
+    pos = np.minimum( np.searchsorted( vvalues, values ), len(vvalues)-1 )
+    found = vvalues[pos] == values
+    row[found] = first[pos[found]]
+    return found, row
+
+
 '''
 Input:
     lowercurve, uppercurve = two 2-column arrays with almost identical first columns
@@ -170,18 +234,194 @@ Input:
     data = an intermediate result from the previous step GoodFrameTest
     head = an intermediate result from the previous step GoodFrameTest
     outliercriterion = the threshold value which determines outliers
+    window = the same as in GoodFrameTest
 
 Outputs:
     head = array, pixels that form the head, (x,y) pairs
     tail = array, pixels that form the flagellum in full width, (x,y) pairs
+        The outliers of the head are appended at the end.
     ori = boolean
         ori=0 : the head points toward a smaller independent variable e.g. leftward or downward
         ori=1 : the head points toward a greater independent variable e.g. rightward or upward
 '''
 
-def SeparateHeadTail(lowercurve,uppercurve,body,data,head,outliercriterion):
+def SeparateHeadTail(lowercurve,uppercurve,body,data,head,outliercriterion,window=None):
     # Separate head and tail.
-    p = np.argmax(data[:,1])
+    p = HeadPeak(data,window)
+    n,n2 = data.shape
+    if n-p>=p-1:
+        # p is in the 1st half.
+        ori = 1
+        x = data[2*p-1,0]
+        # Remove the elements in head which is bigger than or equal to x.
+        head = head[0:FirstRow(head[:,0],x),:]
+        # Remove the elements in head which is less than x.
+        if np.any( lowercurve[:,0]==x ):
+            tail = lowercurve[FirstRow(lowercurve[:,0],x):,:]
+        else:
+            tail = uppercurve[FirstRow(uppercurve[:,0],x):,:]
+    else:
+        # p is in the 2nd half.
+        ori = 0
+        x = data[2*p-n,0]
+        # Remove the elements in head which is bigger than or equal to x
+        head = head[FirstRow(head[:,0],x):,:]
+        # Remove the elements in head which is less than x.
+        if np.any( lowercurve[:,0]==x ):
+            tail = lowercurve[0:FirstRow(lowercurve[:,0],x),:]
+        else:
+            tail = uppercurve[0:FirstRow(uppercurve[:,0],x),:]
+
+    # Determine the outliers in head and move them to the tail.
+    xmin = np.mean(head[:,0]) - outliercriterion
+    xmax = np.mean(head[:,0]) + outliercriterion
+    ymin = np.mean(head[:,1]) - outliercriterion
+    ymax = np.mean(head[:,1]) + outliercriterion
+    outlier = ( (head[:,0]<=xmin) | (head[:,0]>=xmax) |
+                (head[:,1]<=ymin) | (head[:,1]>=ymax) )
+    tail = np.concatenate( (tail, head[outlier,:]), axis=0 )
+    head = head[~outlier,:]
+
+    return head, tail, ori
+
+
+'''
+Inputs:
+    v = 1D numpy array
+    x = a value in v
+Output:
+    r = the first index such that v[r] = x
+'''
+
+def FirstRow(v,x):
+    return np.amin( np.flatnonzero( v==x ) )
+
+
+'''
+Input:
+    body = 2-column array in (y,x) pairs, the body without outliers
+    maxheadwidth = maximum head width
+    headbodyratio = the same as in GoodFrameTest
+    outliercriterion = the same as in SeparateHeadTail
+
+Outputs:
+    goodframe = boolean, the same test as GoodFrameTest, along the principal axis
+    head = array, pixels that form the head, (y,x) pairs
+    tail = array, pixels that form the flagellum, (y,x) pairs
+        The outliers of the head are appended at the end.
+    horizontality = 1 if the principal axis is closer to the x-axis than to the y-axis, else 0
+    ori = the same as in SeparateHeadTail, along x if horizontality=1 and along y if not
+
+Note: Instead of the lower and upper curves along x or y, the pixels are projected onto the
+    principal axis of the body, the direction of its largest extent, which one SVD of the 2x2
+    scatter matrix gives. The width of the body at each step of one pixel along the axis is
+    the number of pixels in that step, counted with np.bincount. The head is found and cut
+    off along the axis the same way as in GoodFrameTest and SeparateHeadTail, so a sperm
+    swimming diagonally is handled like one swimming along x or y. head and tail hold all
+    pixels of the body, not only those of the curves.
+'''
+
+def SeparateHeadTailPCA(body,maxheadwidth,headbodyratio,outliercriterion):
+    if len(body) < 2:
+        return 0, None, None, None, None
+    # Principal axis of the body.
+    center = np.mean( body, axis=0 )
+    centered = body - center
+    u, sv, vt = np.linalg.svd( np.dot( centered.T, centered ) )
+    axis = u[:,0]
+    # Coordinate of each pixel along the axis, in steps of one pixel.
+    s = np.dot( centered, axis )
+    step = np.floor( s - np.min(s) ).astype(int)
+    width = np.bincount( step ).astype(float)
+    width[ width > maxheadwidth ] = 0
+    n = len( width )
+
+    # Find the index where the maximum appears.
+    p = np.argmax( width )
+    if not ( float(p-1)/n <= headbodyratio or float(n-p)/n <= headbodyratio ):
+        return 0, None, None, None, None
+
+    # Cut off the head, twice as long as its widest part is far from the end.
+    if n-p>=p-1:
+        inhead = step < 2*p-1
+    else:
+        inhead = step >= 2*p-n
+    head = body[inhead,:]
+    tail = body[~inhead,:]
+
+    # Determine the outliers in head and move them to the tail.
+    ymin = np.mean(head[:,0]) - outliercriterion
+    ymax = np.mean(head[:,0]) + outliercriterion
+    xmin = np.mean(head[:,1]) - outliercriterion
+    xmax = np.mean(head[:,1]) + outliercriterion
+    outlier = ( (head[:,0]<=ymin) | (head[:,0]>=ymax) |
+                (head[:,1]<=xmin) | (head[:,1]>=xmax) )
+    tail = np.concatenate( (tail, head[outlier,:]), axis=0 )
+    head = head[~outlier,:]
+
+    # The independent variable is x if horizontal and y if not, as in the other methods.
+    horizontality = 1 if abs(axis[1]) >= abs(axis[0]) else 0
+    if len(head) > 0 and np.mean(head[:,horizontality]) <= center[horizontality]:
+        # The head is at the smaller end of the independent variable.
+        ori = 1
+    else:
+        ori = 0
+
+    return 1, head, tail, horizontality, ori
+
+
+'''
+Reference implementations of GoodFrameTest and SeparateHeadTail, which handle one x value
+or one head pixel at a time. They take the same inputs and give the same outputs, and are
+selected with method="loop" in DetectingSpermBody.
+'''
+
+def GoodFrameTestLoop(lowercurve,uppercurve,body,maxheadwidth,headbodyratio,window=None):
+    # Put two curves together.
+    head = np.concatenate( (lowercurve, uppercurve), axis=0 )
+    # Rearange the rows so that the 1st column (i.e. x values) is increasing.
+    head = head[ np.argsort( head[:,0] ) ]
+    # Find the unique elements in the 1st column., i.e. find unique x values
+    xvalues = np.unique( head[:,0] )
+    n = len( xvalues )
+    # data is a temporary array that can be used to determine whether a segementation result
+    # is good enough to be used in further calculations.
+    data = np.zeros((n,2))
+    data[:,0] = xvalues
+
+    # Determine the values in the 2nd column.
+    for ii in range(n):
+        xx = xvalues[ii]
+        if np.isin( xx, lowercurve[:,0] ):
+            if np.isin( xx, uppercurve[:,0] ):
+                # If xx is both in lowercurve and upper curve, then find the indices r1, r2 
+                # such that lowercurve[r1,0] = xx, uppercurve[r2,0] = xx.
+                r1 = np.amin( np.where( lowercurve[:,0]==xx ) )
+                r2 = np.amin( np.where( uppercurve[:,0]==xx ) )
+                # Compute the difference of the 2nd components.
+                d = np.absolute( lowercurve[r1,1] - uppercurve[r2,1] )
+                # If d does not exceed maximum head width, then set data[ii,1] equal to d.
+                if d <= maxheadwidth:
+                    data[ii,1] = d
+                ''' end of if ( d <= maxheadwidth ) loop '''
+        ''' end of if ( np.isin( xx, lowercurve[:,0] ) ) loop '''
+    ''' end of for loop '''
+
+    # Find the index where the maximum appears.
+    p = HeadPeak( data, window )
+    if float(p-1)/n <= headbodyratio or float(n-p)/n <= headbodyratio:
+        # If the segmentation result has a decent head/body ratio,
+        # then the frame is considered as a good one.
+        goodframe = 1
+    else:
+        goodframe = 0
+
+    return goodframe, data, head
+
+
+def SeparateHeadTailLoop(lowercurve,uppercurve,body,data,head,outliercriterion,window=None):
+    # Separate head and tail.
+    p = HeadPeak(data,window)
     n,n2 = data.shape
     if n-p>=p-1:
         # p is in the 1st half.
@@ -191,7 +431,7 @@ def SeparateHeadTail(lowercurve,uppercurve,body,data,head,outliercriterion):
         r = np.where( head[:,0]==x )
         head = head[0:np.amin(r),:]
         # Remove the elements in head which is less than x.
-        if np.in1d( x, lowercurve[:,0] ):
+        if np.isin( x, lowercurve[:,0] ):
             r = np.where( lowercurve[:,0]==x )
             tail = lowercurve[np.amin(r):,:] 
         else:
@@ -205,7 +445,7 @@ def SeparateHeadTail(lowercurve,uppercurve,body,data,head,outliercriterion):
         r = np.where( head[:,0]==x )
         head = head[np.amin(r):,:] 
         # Remove the elements in head which is less than x.
-        if np.in1d( x, lowercurve[:,0] ):
+        if np.isin( x, lowercurve[:,0] ):
             r = np.where( lowercurve[:,0]==x )
             tail = lowercurve[0:np.amin(r),:] 
         else:
@@ -220,9 +460,145 @@ def SeparateHeadTail(lowercurve,uppercurve,body,data,head,outliercriterion):
     ymax = np.mean(head[:,1]) + outliercriterion
     for ii in range(m1):
         if head[ii,0]<=xmin or head[ii,0]>=xmax or head[ii,1]<=ymin or head[ii,1]>=ymax:
-            tail = np.concatenate( (tail, head[ii,:]), axis=0 )
+            tail = np.concatenate( (tail, head[ii:ii+1,:]), axis=0 )
             head[ii,:] = np.array([0,0])
-    head[~np.all(head == 0, axis=1)]
+    head = head[~np.all(head == 0, axis=1)]
 
     return head, tail, ori
 
+
+'''
+Inputs:
+    rng = numpy RandomState
+    trial = integer, the kind of case: even trials take the curves of a random body made of
+        a blob, a wavy line and a few stray pixels, the way DetectingSpermBody does; odd
+        trials take two independent random curves, whose first columns only partly overlap
+Outputs:
+    lowercurve, uppercurve, body = inputs of GoodFrameTest, (x,y) pairs
+    window = None, or a random window of HeadPeak
+
+Note: All coordinates are at least 1, because the loop version drops the head pixels at
+    (0,0), which DetectingSpermBody never gives, see AnalyzeRegion in Tracking.py.
+'''
+
+def RandomCurves(rng,trial):
+    if trial % 2 == 0:
+        # A blob (head) and a wavy line (flagellum) along x, plus stray pixels.
+        nx = rng.randint( 5, 80 )
+        x = np.arange( 1, nx+1 )
+        y = 20 + np.round( rng.uniform(0,4)*np.sin( x*rng.uniform(0.05,0.5) ) ).astype(int)
+        pixels = [ np.stack( (y,x), axis=1 ) ]
+        for width in range( 1, rng.randint(1,4) ):
+            pixels.append( np.stack( (y+width,x), axis=1 ) )
+        cx = x[0] if rng.rand() < 0.5 else x[-1]
+        r = rng.randint( 1, 8 )
+        by,bx = np.mgrid[ 20-r:21+r, cx-r:cx+r+1 ]
+        inside = ( (by-20)**2 + (bx-cx)**2 <= r*r ) & ( bx >= 1 )
+        pixels.append( np.stack( (by[inside],bx[inside]), axis=1 ) )
+        pixels.append( rng.randint( 1, 45, (rng.randint(0,4),2) ) )
+        body = np.unique( np.concatenate( pixels, axis=0 ), axis=0 ).astype(float)
+        # The same steps as DetectingSpermBody for a horizontal sperm.
+        body = body[ np.argsort( body[:,1] ) ]
+        lowercurve = np.fliplr( SimplifyX(body,1) )
+        uppercurve = np.fliplr( SimplifyX(body,0) )
+        body = np.fliplr( body )
+    else:
+        curves = []
+        for b in range(2):
+            n = rng.randint( 1, 40 )
+            xs = np.sort( rng.choice( np.arange(1,60), n, replace=False ) )
+            curves.append( np.stack( (xs, rng.randint(1,30,n)), axis=1 ).astype(float) )
+        lowercurve, uppercurve = curves
+        body = np.concatenate( curves, axis=0 )
+    window = None
+    if rng.rand() < 0.5:
+        lo = rng.randint( 0, 60 )
+        window = ( lo, lo+rng.randint(0,20), rng.uniform(0,30) )
+    return lowercurve, uppercurve, body, window
+
+
+'''
+Input:
+    func = function
+    args = arguments of func
+Output:
+    result = the output of func, or the type of the exception it raises
+'''
+
+def Outcome(func,args):
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+'''
+Inputs:
+    a, b = outputs of Outcome
+Output:
+    True if both are the same exception, or the same arrays and values
+'''
+
+def SameOutcome(a,b):
+    if isinstance(a,type) or isinstance(b,type):
+        return a is b
+    return all( [ np.array_equal( np.asarray(u), np.asarray(v) ) for u,v in zip(a,b) ] )
+
+
+'''
+Inputs:
+    trials = number of random cases
+    seed = seed of the random cases
+    maxheadwidth, headbodyratio, outliercriterion = see GoodFrameTest and SeparateHeadTail;
+        every third case takes a random outliercriterion between 1 and 10
+Output:
+    failures = number of cases where GoodFrameTest or SeparateHeadTail differs from its loop
+        version, in its outputs or in the exception it raises
+'''
+
+def CheckHelpers(trials=2000,seed=0,maxheadwidth=80,headbodyratio=0.25,outliercriterion=135):
+    rng = np.random.RandomState( seed )
+    failures = 0
+    for trial in range(trials):
+        lowercurve, uppercurve, body, window = RandomCurves( rng, trial )
+        # The functions may change their inputs, so give each one its own copy.
+        args = lambda: ( lowercurve.copy(), uppercurve.copy(), body.copy(), maxheadwidth,
+                         headbodyratio, window )
+        good = Outcome( GoodFrameTest, args() )
+        same = SameOutcome( good, Outcome( GoodFrameTestLoop, args() ) )
+        if same and not isinstance(good,type):
+            goodframe, data, head = good
+            # A small criterion every third case moves some head pixels to the tail.
+            criterion = outliercriterion if trial % 3 else rng.uniform( 1, 10 )
+            args = lambda: ( lowercurve.copy(), uppercurve.copy(), body.copy(), data.copy(),
+                             head.copy(), criterion, window )
+            same = SameOutcome( Outcome( SeparateHeadTail, args() ),
+                                Outcome( SeparateHeadTailLoop, args() ) )
+        if not same:
+            failures += 1
+            print("  trial %d differs  " % trial)
+    ''' end of for loop on trial '''
+    return failures
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Checks of the helpers of step 4")
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='Check that GoodFrameTest and SeparateHeadTail give the same results as'
+                        ' their loop versions on random curves.')
+    parser.add_argument('-n', '--trials', type=int, default=2000,
+                        help='Number of random cases.')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed of the random cases.')
+    args = parser.parse_args()
+
+    if args.check:
+        failures = CheckHelpers( args.trials, args.seed )
+        print("  %d of %d case(s) differ  " % (failures, args.trials))
+        if failures:
+            raise SystemExit(1)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -1,63 +1,59 @@
 from __future__ import print_function
 import numpy as np
-import SimpleITK as sitk
-import matplotlib.pyplot as plt
+
+from FrameStore import MovieSize, CreateMovie, SaveMovie
 
 ''' 
 Inputs:
-    (1) movie = input ITK image
+    (1) movie = input ITK image, or numpy array of shape (n3,n2,n1), see FrameStore.py
     (2) outputpath = output path
     (3) sperm = a dictionary which contains some numerics regarding to the segmentation result
+    (4) compact = boolean, write uint8 labels (head=2, flagellum=1) instead of float64 (head=1, flagellum=0.5)
+    (5) compress = boolean, write a compressed .mha file
+    (6) plots = boolean, draw the head trajectory
+    (7) storage = string, "itk" (default) or "memmap", see FrameStore.py
     
 Outputs:
     (1) SpermStep5_HeadFlagellum.mha saved in the output path
-    (2) SpermStep5_HeadTrajectory.png saved in the output path
+    (2) SpermStep5_HeadTrajectory.png saved in the output path, if plots
 '''
 
-def Summary( movie, outputpath, sperm ):
+def Summary( movie, outputpath, sperm, compact=False, compress=False, plots=True, storage="itk" ):
 
     '''
-    Initialize two zero-arrays, then convert the array to an ITK image later.
-    '''
-    (n1,n2,n3) = movie.GetSize()
-    newMovie = np.zeros( (n3,n2,n1) )
-    headTrajectory = np.zeros( (n2,n1) )
-    
+    Get the size of the movie and the information in sperm.
     '''
-    Get information in sperm.
-    '''
-    Flagellum = sperm["flagellum"]
-    Frame = sperm["frames"]
-    Head = sperm["head"]
+    (n1,n2,n3) = MovieSize( movie )
+    Frame = np.asarray( sperm["frames"], dtype=int )
 
     print("  Summarizing ...  ")
 
     '''
-    For each frame, plot the head and the flagellum separately.
+    Collect the pixels of the head and the flagellum of all good frames,
+    together with the index of their frame.
     '''
-    newMovie = np.zeros( (n3,n2,n1) )
+    kh, head = FrameCoordinates( Frame, sperm["head"], n3 )
+    kf, flagellum = FrameCoordinates( Frame, sperm["flagellum"], n3 )
+
+    '''
+    Paint all heads, then all flagella, into one uint8 label volume (head=2, flagellum=1).
+    '''
+    labels = np.zeros( (n3,n2,n1), dtype=np.uint8 )
+    labels[ kh, head[:,0], head[:,1] ] = 2
+    labels[ kf, flagellum[:,0], flagellum[:,1] ] = 1
+    if compact:
+        palette = np.array( [0, 1, 2], dtype=np.uint8 )
+    else:
+        palette = np.array( [0, 0.5, 1] )
+    newMovie = CreateMovie( outputpath+"SpermStep5_HeadFlagellum.mha", (n1,n2,n3),
+                            palette.dtype, storage )
     for k in range(n3):
-        if k in Frame:
-            # Loop in head.
-            head = Head[k].astype(int)
-            nh1,nh2 = head.shape
-            for ii in range(nh1):
-                newMovie[k, head[ii,0], head[ii,1] ] = 1
-            # Loop in flagellum.
-            flagellum = Flagellum[k].astype(int)
-            nf1,nf2 = flagellum.shape
-            for jj in range(nf1):
-                newMovie[k, flagellum[jj,0], flagellum[jj,1] ] = 0.5
-        ''' end of if ( k in Frame ) loop on '''
-    ''' end of for loop on k '''
-    
+        newMovie[k,:,:] = palette[ labels[k,:,:] ]
+
     '''
     Write out the result.
     '''
-    newMovie = sitk.GetImageFromArray(newMovie)
-    imwrite = sitk.ImageFileWriter()
-    imwrite.SetFileName( outputpath+"SpermStep5_HeadFlagellum.mha" )
-    imwrite.Execute( newMovie )
+    SaveMovie( newMovie, outputpath+"SpermStep5_HeadFlagellum.mha", compress )
 
     # Note: Movie SpermStep5_HeadFlagellum.mha is not very clear to see.
     #       To know how accurate the separation result is,
@@ -66,23 +62,95 @@ def Summary( movie, outputpath, sperm ):
     '''
     Plot the center of the head in all frames into one figure.
     '''
-    # Initialize the center of the head.
-    x = []
-    y = []
-    for k in range(n3):
-        if k in Frame:
-            head = Head[k].astype(int)
-            # Compute the center of the head.
-            y.append( np.mean(head[:,0]) )
-            x.append( np.mean(head[:,1]) )
+    if not plots:
+        return
+    # Compute the center of the head of all good frames in one pass.
+    count = np.bincount( kh, minlength=n3 )[Frame]
+    with np.errstate( divide='ignore', invalid='ignore' ):
+        y = np.bincount( kh, weights=head[:,0], minlength=n3 )[Frame] / count
+        x = np.bincount( kh, weights=head[:,1], minlength=n3 )[Frame] / count
     # Write out the result.
+    PlotHeadTrajectory( list(x), list(y), n1, n2, outputpath )
+
+    return
+
+
+'''
+Inputs:
+    (1) Frame = integer array, the good frames
+    (2) Pixels = list of 2-column numpy arrays in (y,x) pairs, either one per frame of the movie
+            ('empty' for bad frames) or one per good frame in the order of Frame
+    (3) n3 = number of frames of the movie
+Outputs:
+    (1) k = integer array, the frame of each pixel
+    (2) yx = 2-column integer array, all pixels in (y,x) pairs
+'''
+
+def FrameCoordinates( Frame, Pixels, n3 ):
+    if len(Pixels) == n3:
+        arrays = [ Pixels[k] for k in Frame ]
+    else:
+        arrays = list( Pixels )
+    arrays = [ np.asarray( A ).astype(int).reshape(-1,2) for A in arrays ]
+    if len(arrays) == 0:
+        return np.zeros( 0, dtype=int ), np.zeros( (0,2), dtype=int )
+    k = np.repeat( Frame, [ len(A) for A in arrays ] )
+    yx = np.concatenate( arrays, axis=0 )
+    return k, yx
+
+
+'''
+Inputs:
+    (1) head = 2-column numpy array in (y,x) pairs, pixels of the head
+    (2) flagellum = 2-column numpy array in (y,x) pairs, pixels of the flagellum
+    (3) n2, n1 = size of the frame
+    (4) compact = boolean, see Summary
+Output:
+    (1) B = 2D numpy array, 1 on the head, 0.5 on the flagellum and 0 elsewhere;
+            uint8 with 2 on the head, 1 on the flagellum and 0 elsewhere if compact
+'''
+
+def PaintFrame( head, flagellum, n2, n1, compact=False ):
+    if compact:
+        B = np.zeros( (n2,n1), dtype=np.uint8 )
+        headlabel, flagellumlabel = 2, 1
+    else:
+        B = np.zeros( (n2,n1) )
+        headlabel, flagellumlabel = 1, 0.5
+    # Paint the head, then the flagellum.
+    head = head.astype(int)
+    B[ head[:,0], head[:,1] ] = headlabel
+    flagellum = flagellum.astype(int)
+    B[ flagellum[:,0], flagellum[:,1] ] = flagellumlabel
+    return B
+
+
+'''
+Inputs:
+    (1) x, y = lists, center of the head in the good frames
+    (2) n1, n2 = size of the frame
+    (3) outputpath = output path
+Output:
+    (1) SpermStep5_HeadTrajectory.png saved in the output path
+'''
+
+def PlotHeadTrajectory( x, y, n1, n2, outputpath ):
+    # Import matplotlib only when a plot is drawn, with the non-interactive backend,
+    # so that no display is probed.
+    import matplotlib
+    matplotlib.use( "Agg" )
+    import matplotlib.pyplot as plt
+
     plt.figure()
-    plt.plot(x[0], y[0], "r*", label="initial")
+    # There is no initial point if no frame is good.
+    if len(x) > 0:
+        plt.plot(x[0], y[0], "r*", label="initial")
     plt.plot(x, y, "b-", label="trajectory")
     x1,x2,y1,y2 = plt.axis()
     plt.axis((0,n2,0,n1))
     plt.legend(bbox_to_anchor=(1.05, 1), loc=1, borderaxespad=0.)
     plt.title("Head Trajectory")
     plt.savefig( outputpath+"SpermStep5_HeadTrajectory.png" )
-
+    # Free the figure, a batch draws one per movie in the same process.
+    plt.close()
     return
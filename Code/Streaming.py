@@ -0,0 +1,340 @@
+from __future__ import print_function
+import os
+import numpy as np
+
+from Checkpoint import Journal
+from Engines import Engine
+from FrameStore import MapMovie, MetaImageHeader
+from Step1 import CorrectIllumination, RescaleFrames, TemporalOpening, TemporalWindows
+from Step2 import MedianFrames
+from Step3 import ThresholdingFrames
+from Step4 import AnalyzeFrame, SpermDictionary
+from Step5 import PaintFrame, PlotHeadTrajectory
+
+'''
+Streaming version of the pipeline.
+
+Frames are read one at a time with the extraction region of ImageFileReader and pushed
+through PreProcessing -> Blurring -> Thresholding -> DetectingSpermBody -> Summary as a
+chain of generators. Each step appends its frame to its .mha file right away, so only a
+few frames are held in memory, no matter how long the movie is. The output files are the
+same as the ones of SpermSegReg.py without streaming.
+
+Every few frames the progress is recorded in a journal (see Checkpoint.py), so that a run
+which stops can be resumed from the last checkpoint.
+'''
+
+
+'''
+Inputs:
+    (1) filename = name of an .mha file
+    (2) size = (n1,n2,n3), size of the movie
+    (3) dtype = numpy type of the pixels
+    (4) start = integer, number of frames of an existing file to keep; new frames are
+            appended after them and the header is updated to the new size
+
+Note: The header is written first, then each call of Append writes the next frame.
+'''
+
+class MetaImageAppender(object):
+
+    def __init__( self, filename, size, dtype, start=0 ):
+        self.dtype = np.dtype(dtype)
+        self.size = tuple(size)
+        header = MetaImageHeader( self.size, self.dtype )
+        if start > 0:
+            self.file = open( filename, "r+b" )
+            offset = self.file.read( len(header)+1024 ).find( b"ElementDataFile = LOCAL\n" )
+            if offset+len(b"ElementDataFile = LOCAL\n") != len(header):
+                self.file.close()
+                raise IOError("%s: the header has a different length, the file cannot be"
+                              " resumed" % filename)
+            self.file.seek( 0 )
+            self.file.write( header )
+            self.file.truncate( len(header) + start*self.size[0]*self.size[1]*self.dtype.itemsize )
+            self.file.seek( 0, 2 )
+        else:
+            self.file = open( filename, "wb" )
+            self.file.write( header )
+        self.count = start
+
+    def Append( self, frame ):
+        frame = np.ascontiguousarray( frame, dtype=self.dtype.newbyteorder("<") )
+        self.file.write( frame.tobytes() )
+        # A frame is on disk once it is appended, so a checkpoint can refer to it.
+        self.file.flush()
+        self.count += 1
+
+    def Close( self ):
+        self.file.close()
+        if self.count != self.size[2]:
+            raise IOError("%s: %d of %d frames were written"
+                          % (self.file.name, self.count, self.size[2]))
+
+
+'''
+Inputs:
+    (1) filename = name of the input movie
+    (2) start = integer, index of the first frame to read
+Outputs:
+    (1) size = (n1,n2,n3), size of the movie
+    (2) frames = generator of (k, A), where A is the k-th frame as a 2D numpy array
+
+Note: the frames of an uncompressed .mha/.mhd file are read from the mapped file, without
+      SimpleITK; the other files are read one frame at a time with ITK.
+'''
+
+def ReadFrames( filename, start=0 ):
+    movie = MapMovie( filename )
+    if movie is not None:
+        n3,n2,n1 = movie.shape
+
+        def mapped():
+            for k in range(start, n3):
+                yield k, np.array( movie[k,:,:] )
+
+        return (n1,n2,n3), mapped()
+
+    import SimpleITK as sitk
+    imread = sitk.ImageFileReader()
+    imread.SetFileName( filename )
+    imread.ReadImageInformation()
+    n1,n2,n3 = imread.GetSize()
+
+    def frames():
+        for k in range(start, n3):
+            # A zero size along the 3rd axis extracts a 2D frame.
+            imread.SetExtractIndex( [0,0,k] )
+            imread.SetExtractSize( [n1,n2,0] )
+            yield k, sitk.GetArrayFromImage( imread.Execute() )
+
+    return (n1,n2,n3), frames()
+
+
+'''
+Input:
+    (1) filename = name of the input movie
+Output:
+    (1) intensity = (lo,hi), minimum and maximum of the movie
+'''
+
+def IntensityRange( filename ):
+    lo = np.inf
+    hi = -np.inf
+    for k,A in ReadFrames( filename )[1]:
+        lo = min( lo, A.min() )
+        hi = max( hi, A.max() )
+    return float(lo), float(hi)
+
+
+'''
+Steps 1-4 as generators. Each one takes a generator of (k, A), appends the result of
+each frame to the output file of the step and yields (k, result). The first start frames
+of the output file are kept, see MetaImageAppender. The filters run with the engines of
+engines, see Engines.py.
+'''
+
+def StreamPreProcessing( frames, intensity, outputpath, size, background="ball", factor=4,
+                         window=100, percentile=50, start=0, engines=None, stride=None ):
+    n1,n2,n3 = size
+
+    # The intensity rescaling uses the minimum and maximum of the whole movie, see
+    # IntensityRange.
+
+    radius = (n1//16,n2//16)
+    imwrite = MetaImageAppender( outputpath+"SpermStep1_CorrectingIllumination.mha",
+                                 size, np.uint16, start )
+    rescale = Engine( engines, "rescale" )
+    opening = Engine( engines, "opening" )
+    if background != "temporal":
+        for k,A in frames:
+            A = RescaleFrames( A[np.newaxis,:,:], intensity, rescale )
+            B = CorrectIllumination( A, radius, "volume", background, factor, percentile,
+                                     opening )[0,:,:]
+            imwrite.Append( B )
+            yield k, B
+        imwrite.Close()
+        return
+
+    # A temporal background needs the window around each stride of frames, so frames starts
+    # with the window of frame start, see FirstFrame; the frames before start are only read.
+    windows = [ w for w in TemporalWindows( n3, window, stride ) if w[1] > start ]
+    buffered = {}
+    last = None
+    for k,A in frames:
+        buffered[k] = RescaleFrames( A[np.newaxis,:,:], intensity, rescale )[0,:,:]
+        while windows and max( windows[0][1], windows[0][3] ) <= k+1:
+            s0,s1,w0,w1 = windows.pop(0)
+            if (w0,w1) != last:
+                B = TemporalOpening( np.array( [ buffered[j] for j in range(w0,w1) ] ), radius,
+                                     percentile, opening )
+                last = (w0,w1)
+            for j in range( max(s0,start), s1 ):
+                C = ( buffered[j] - np.minimum( B, buffered[j] ) ).astype(np.uint16)
+                imwrite.Append( C )
+                yield j, C
+            # Keep the frames of the next windows only.
+            if windows:
+                keep = min( windows[0][0], windows[0][2] )
+                for j in [ j for j in buffered if j < keep ]:
+                    del buffered[j]
+        ''' end of while loop on windows '''
+    imwrite.Close()
+
+
+'''
+Inputs:
+    (1) n3 = integer, number of frames of the movie
+    (2) start = integer, first frame to process
+    (3) background, window, stride = see StreamPreProcessing
+Output:
+    (1) first = integer, first frame to read, the first frame of the window of start with a
+            temporal background, start otherwise
+'''
+
+def FirstFrame( n3, start, background, window, stride ):
+    if background != "temporal":
+        return start
+    return min( [start] + [ min(s0,w0) for s0,s1,w0,w1 in TemporalWindows( n3, window, stride )
+                            if s1 > start ] )
+
+
+def StreamBlurring( frames, outputpath, size, medfiltRadius, start=0, engines=None ):
+    imwrite = MetaImageAppender( outputpath+"SpermStep2_Blurring.mha", size, np.uint16, start )
+    for k,A in frames:
+        B = MedianFrames( A[np.newaxis,:,:], medfiltRadius, "volume",
+                          Engine( engines, "median" ) )[0,:,:]
+        imwrite.Append( B )
+        yield k, B
+    imwrite.Close()
+
+
+def StreamThresholding( frames, outputpath, size, radius, threshold, stain, method, compact,
+                        start=0, engines=None ):
+    dtype = np.uint8 if compact else np.float64
+    imwrite = MetaImageAppender( outputpath+"SpermStep3_Thresholding.mha", size, dtype, start )
+    for k,A in frames:
+        B = ThresholdingFrames( A[np.newaxis,:,:], radius, threshold, stain, method,
+                                engine=Engine( engines, "difference" ) )[0,:,:]
+        imwrite.Append( B )
+        yield k, B
+    imwrite.Close()
+
+
+def StreamDetectingSpermBody( frames, outputpath, size,
+                              threshold1, maxheadwidth, headbodyratio, threshold2, compact,
+                              analysismethod, start=0 ):
+    n1,n2,n3 = size
+    dtype = np.uint8 if compact else np.float64
+    imwrite = MetaImageAppender( outputpath+"SpermStep4_GoodFramesOnly.mha", size, dtype, start )
+    for k,A in frames:
+        result = AnalyzeFrame( A, threshold1, maxheadwidth, headbodyratio, threshold2,
+                               analysismethod )
+        if result is None:
+            # Erase the information about "bad" frames.
+            A = np.zeros( (n2,n1) )
+        imwrite.Append( A )
+        yield k, result
+    imwrite.Close()
+
+
+'''
+Inputs:
+    (1) inputfile = name of the input movie
+    (2) outputpath = output path
+    (3) startingstep = integer, 1-correcting nonuniform illumination, 2-blurring,
+            3-thresholding, 4-image analysis
+    (4) medfiltRadius = see Blurring
+    (5) radius, threshold, stain, method = see Thresholding
+    (6) dt, scale, threshold1, maxheadwidth, headbodyratio, threshold2 = see DetectingSpermBody
+    (7) compact = boolean, write uint8 masks and labels, see Thresholding and Summary
+    (8) analysismethod = string, see the method of DetectingSpermBody
+    (9) background, factor, window, percentile, stride = see PreProcessing; a temporal
+            background keeps a window of frames in memory, 100 frames by default
+    (10) plots = boolean, see Summary
+    (11) checkpoint = integer, number of frames between two checkpoints
+    (12) resume = boolean, continue after the last checkpoint of an earlier run with the
+            same settings, see Checkpoint.py
+    (13) engines = dictionary {operation: engine} of the filters, see Engines.py; None for
+            the default engines
+
+Outputs:
+    (1) sperm = the same dictionary as the one returned by DetectingSpermBody
+    (2) the .mha and .png files of Steps 1-5 saved in the output path
+'''
+
+def StreamingPipeline( inputfile, outputpath, startingstep, medfiltRadius,
+                       radius, threshold, stain, method,
+                       dt, scale, threshold1, maxheadwidth, headbodyratio, threshold2,
+                       compact=False, analysismethod="vectorized", background="ball", factor=4,
+                       window=100, percentile=50, plots=True, checkpoint=100, resume=False,
+                       engines=None, stride=None ):
+
+    size = ReadFrames( inputfile )[0]
+    n1,n2,n3 = size
+
+    '''
+    Find the frames done by an earlier run.
+    '''
+    settings = [ os.path.abspath(inputfile), startingstep, medfiltRadius, radius, threshold,
+                 np.asarray(stain).tolist(), method, threshold1, maxheadwidth, headbodyratio,
+                 threshold2, compact, analysismethod, background, factor, window, percentile, stride ]
+    journal = Journal( outputpath, settings, size )
+    if resume:
+        start = journal.Resume()
+    else:
+        start = journal.Start()
+    if startingstep <= 1 and journal.intensity is None:
+        # Frames appended later are rescaled like the frames done before.
+        journal.intensity = IntensityRange( inputfile )
+    checkpoint = max( 1, int(checkpoint) )
+    results = journal.Results()
+    if startingstep <= 1:
+        frames = ReadFrames( inputfile, FirstFrame( n3, start, background, window, stride ) )[1]
+    else:
+        frames = ReadFrames( inputfile, start )[1]
+
+    if start > 0:
+        print("  Resuming after frame %d of %d ...  " % (start, n3))
+    print("  Streaming frames through steps %d-5 ...  " % startingstep)
+
+    '''
+    Chain the steps.
+    '''
+    if startingstep <= 1:
+        frames = StreamPreProcessing( frames, journal.intensity, outputpath, size, background,
+                                      factor, window, percentile, start, engines, stride )
+    if startingstep <= 2:
+        frames = StreamBlurring( frames, outputpath, size, medfiltRadius, start, engines )
+    if startingstep <= 3:
+        frames = StreamThresholding( frames, outputpath, size, radius, threshold, stain, method,
+                                     compact, start, engines )
+    frames = StreamDetectingSpermBody( frames, outputpath, size,
+                                       threshold1, maxheadwidth, headbodyratio, threshold2,
+                                       compact, analysismethod, start )
+
+    '''
+    Pull the frames through the chain, paint Step 5 on the way and record a checkpoint every
+    few frames. Then put the results together as in DetectingSpermBody.
+    '''
+    dtype = np.uint8 if compact else np.float64
+    imwrite = MetaImageAppender( outputpath+"SpermStep5_HeadFlagellum.mha", size, dtype, start )
+    for k,result in frames:
+        results.append( result )
+        if result is not None:
+            imwrite.Append( PaintFrame( result[2], result[1], n2, n1, compact ) )
+        else:
+            imwrite.Append( np.zeros( (n2,n1) ) )
+        if (k+1) % checkpoint == 0 or k == n3-1:
+            journal.Checkpoint( k+1, results[journal.done:k+1], dt, scale )
+    imwrite.Close()
+
+    sperm = SpermDictionary( results, dt, scale, n1, n2 )
+
+    if plots:
+        # Compute the centers of the heads.
+        y = [ np.mean( sperm["head"][k].astype(int)[:,0] ) for k in sperm["frames"] ]
+        x = [ np.mean( sperm["head"][k].astype(int)[:,1] ) for k in sperm["frames"] ]
+        PlotHeadTrajectory( x, y, n1, n2, outputpath )
+
+    return sperm
@@ -0,0 +1,174 @@
+from __future__ import print_function
+import argparse
+import csv
+import numpy as np
+
+from FrameStore import MovieArray, MovieSize, OpenMovie
+from Parallel import MapFrames
+from Step3 import NeighborDifference, RemoveStains
+from Step4 import AnalyzeFrame
+
+'''
+Parameter sweep of Step 3.
+
+For a fixed radius the differences between a square and its four neighboring squares do not
+depend on the threshold value, so they are computed once per radius and frame (see
+NeighborDifference) and the mask of every threshold value is derived from them. A sweep over
+5 radii and 10 threshold values costs about 5 thresholding passes instead of 50. For every
+combination the table gives the number of marked pixels and the rate of good frames of Step 4.
+
+Example:
+    python Sweep.py -i ../Movie/SpermStep2_Blurring.mha -o ../Movie/ -tr 1 2 3 4 5 -tv 4 6 8 10 12 14 16 18 20 22 -rs 1 61 221 271 -hbr 0.25
+'''
+
+
+'''
+Inputs:
+    (1) movie = input ITK image or numpy array, the result of Step 2
+    (2) outputpath = output path
+    (3) radii = list of integers, radii of the neighborhood, see Thresholding
+    (4) thresholds = list of threshold values, see Thresholding
+    (5) stain = numpy array with 4 columns, regions of stains, [xmin, xmax, ymin, ymax]
+    (6) threshold1, maxheadwidth, headbodyratio, threshold2 = see DetectingSpermBody
+    (7) method = string, see the method of DetectingSpermBody
+    (8) workers = integer, number of processes sharing the frames
+    (9) chunksize = integer, number of frames handed to a process at a time
+
+Outputs:
+    (1) table = list of dictionaries, one per (radius, threshold)
+    (2) SpermStep3_Sweep.csv saved in the output path
+'''
+
+def ThresholdingSweep( movie, outputpath, radii, thresholds, stain,
+                       threshold1, maxheadwidth, headbodyratio, threshold2,
+                       method="vectorized", workers=1, chunksize=None ):
+
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
+
+    print("  Sweeping %d radii and %d threshold values ...  " % (len(radii), len(thresholds)))
+
+    '''
+    Count the marked pixels and the good frames of every combination, one chunk of frames at a time.
+    '''
+    counts = np.zeros( (len(radii),len(thresholds)), dtype=np.int64 )
+    good = np.zeros( (len(radii),len(thresholds)), dtype=np.int64 )
+    for k0,k1,result in MapFrames( SweepFrames, movie,
+                                   (radii, thresholds, stain, threshold1, maxheadwidth,
+                                    headbodyratio, threshold2, method),
+                                   workers, chunksize ):
+        counts += result[0]
+        good += result[1]
+
+    '''
+    Write out the table.
+    '''
+    table = []
+    for a,radius in enumerate(radii):
+        for b,threshold in enumerate(thresholds):
+            table.append( { "threshold_radius": radius,
+                            "threshold_value": threshold,
+                            "foreground_pixels": int( counts[a,b] ),
+                            "foreground_pixels_per_frame": "%.1f" % ( counts[a,b] / float(n3) ),
+                            "good_frames": int( good[a,b] ),
+                            "good_frame_rate": "%.4f" % ( good[a,b] / float(n3) ) } )
+    columns = [ "threshold_radius", "threshold_value", "foreground_pixels",
+                "foreground_pixels_per_frame", "good_frames", "good_frame_rate" ]
+    with open( outputpath+"SpermStep3_Sweep.csv", "w" ) as f:
+        writer = csv.DictWriter( f, fieldnames=columns )
+        writer.writeheader()
+        writer.writerows( table )
+
+    return table
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) radii, thresholds, stain, threshold1, maxheadwidth, headbodyratio, threshold2, method
+            = see ThresholdingSweep
+Outputs:
+    (1) counts = integer array of shape (len(radii),len(thresholds)), number of marked pixels
+    (2) good = integer array of the same shape, number of good frames
+'''
+
+def SweepFrames( frames, radii, thresholds, stain,
+                 threshold1, maxheadwidth, headbodyratio, threshold2, method="vectorized" ):
+    m,n2,n1 = frames.shape
+    counts = np.zeros( (len(radii),len(thresholds)), dtype=np.int64 )
+    good = np.zeros( (len(radii),len(thresholds)), dtype=np.int64 )
+    for k in range(m):
+        for a,radius in enumerate(radii):
+            # One pass of box sums per radius ...
+            I,J,D = NeighborDifference( frames[k,:,:], radius )
+            for b,threshold in enumerate(thresholds):
+                # ... and one comparison per threshold value.
+                B = np.zeros( (n2,n1) )
+                if D is not None:
+                    B[ I[0]:I[-1]+1, J[0]:J[-1]+1 ] = D > threshold
+                RemoveStains( B, stain )
+                count = int( np.count_nonzero( B ) )
+                counts[a,b] += count
+                # A high threshold may leave no pixel, which is not a good frame.
+                if count == 0:
+                    continue
+                result = AnalyzeFrame( B, threshold1, maxheadwidth, headbodyratio, threshold2,
+                                       method )
+                if result is not None:
+                    good[a,b] += 1
+            ''' end of for loop on b '''
+        ''' end of for loop on a '''
+    ''' end of for loop on k '''
+    return counts, good
+
+
+def main():
+    # Define arguments. #
+    parser = argparse.ArgumentParser( description = "Parameter sweep of the thresholding step")
+    parser.add_argument('-i', '--input_file_name', type=str, required=True,
+                        help='The result of step 2, SpermStep2_Blurring.mha.')
+    parser.add_argument('-o', '--output_path', type=str, required=True,
+                        help='The output path.')
+    parser.add_argument('-tr', '--threshold_radius', type=int, nargs='+', required=True,
+                        help='Neighborhood radii of the threshold algorithm.')
+    parser.add_argument('-tv', '--threshold_value', type=float, nargs='+', required=True,
+                        help='Threshold values of the threshold algorithm.')
+    parser.add_argument('-rs', '--regions_of_stains', type=int, nargs='+', default=[],
+                        help='The regions of the stains.'
+                        'Format: xmin1,xmax1,ymin1,ymax1,xmin2,xmax2,ymin2,ymax2,...')
+    parser.add_argument('-hbr', '--headbodyratio', type=float, default=0.25,
+                        help='If the ratio of head length to body length exceeds 2*hbr,'
+                        'the frame is considered as a valid frame.')
+    parser.add_argument('-am', '--analysis_method', type=str, default='vectorized',
+                        choices=['vectorized','loop','pca'],
+                        help='See SpermSegReg.py.')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes sharing the frames.')
+    parser.add_argument('-cs', '--chunk_size', type=int, default=None,
+                        help='Number of frames handed to a process at a time.')
+    args = parser.parse_args()
+
+    # Define the regions of stains. #
+    stains = np.reshape( np.asarray( args.regions_of_stains, dtype=int ),
+                         (len(args.regions_of_stains)//4, 4) )
+
+    # Same parameters of step 4 as SpermSegReg.py. #
+    threshold1 = 2.75
+    maxheadwidth = 80
+    threshold2 = 135
+
+    # An uncompressed movie is mapped rather than read with ITK.
+    movie = OpenMovie( args.input_file_name, "memmap" )
+
+    table = ThresholdingSweep( movie, args.output_path, args.threshold_radius,
+                               args.threshold_value, stains,
+                               threshold1, maxheadwidth, args.headbodyratio, threshold2,
+                               args.analysis_method, args.workers, args.chunk_size )
+    for row in table:
+        print("  tr=%(threshold_radius)d tv=%(threshold_value)g  foreground/frame=%(foreground_pixels_per_frame)s"
+              "  good frame rate=%(good_frame_rate)s" % row)
+
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+from __future__ import print_function
+import numpy as np
+import time
+
+from Engines import Engine
+from FrameStore import MovieSize, MovieArray, CreateMovie, SaveMovie
+from Parallel import MapFrames
+from Step3 import ThresholdingFrames, RemoveStains
+from Step4 import AnalyzeFrame, HeadSeed, SpermDictionary
+
+'''
+Region-of-interest tracking for Steps 3 and 4.
+
+The first frame (of each chunk of frames) is thresholded and analyzed as a whole. For the
+next frame, a box is predicted from the extent of the body, moved by the last displacement
+of the center of the head, and enlarged by a margin. Only that box is thresholded and
+analyzed. If the body found inside the box reaches a side of the box, the sperm may continue
+outside of it, so the box is moved out once on those sides and the frame is analyzed again;
+marked pixels on a side which are not part of the body do not count. If the frame inside the
+box is not a good frame, or the body still reaches a side, the sperm is considered lost and
+the frame is processed as a whole again.
+
+Inside the box, the thresholding result is the same as the one of the whole frame, because
+the box is thresholded together with a border of 3*radius+1 pixels; outside the box the
+mask is 0, so marked pixels far from the sperm are not part of the body.
+'''
+
+
+'''
+Inputs:
+    (1) movie = input ITK image or numpy array, the result of Step 2, see FrameStore.py
+    (2) outputpath = output path
+    (3) radius, threshold, stain, method = see Thresholding
+    (4) dt, scale, threshold1, maxheadwidth, headbodyratio, threshold2 = see DetectingSpermBody
+    (5) margin = integer, number of pixels added around the predicted box
+    (6) workers = integer, number of processes sharing the frames; each chunk of frames
+            starts with a whole frame
+    (7) chunksize = integer, number of frames handed to a process at a time
+    (8) compact, compress = see Thresholding
+    (9) analysismethod = string, see the method of DetectingSpermBody
+    (10) report = Profiling.Report which receives the time spent on each frame; None for no timing
+    (11) storage = string, "itk" (default) or "memmap", see FrameStore.py
+    (12) window = integer, seed the analysis with the previous good frame, see DetectingSpermBody
+    (13) engines = dictionary {operation: engine} of the filters, see Engines.py; None for
+            the default engines
+
+Outputs:
+    (1) newMovie = ITK image, the same as the one returned by DetectingSpermBody
+    (2) sperm = the same dictionary as the one returned by DetectingSpermBody
+    (3) SpermStep3_Thresholding.mha and SpermStep4_GoodFramesOnly.mha saved in the output path
+'''
+
+def TrackingSperm( movie, outputpath, radius, threshold, stain, method,
+                   dt, scale, threshold1, maxheadwidth, headbodyratio, threshold2,
+                   margin, workers=1, chunksize=None, compact=False, compress=False,
+                   analysismethod="vectorized", report=None, storage="itk", window=None,
+                   engines=None ):
+
+    (n1,n2,n3) = MovieSize( movie )
+    movie = MovieArray( movie )
+    dtype = np.uint8 if compact else np.float64
+    masks = CreateMovie( outputpath+"SpermStep3_Thresholding.mha", (n1,n2,n3), dtype, storage )
+    newMovie = CreateMovie( outputpath+"SpermStep4_GoodFramesOnly.mha", (n1,n2,n3), dtype,
+                            storage )
+
+    print("  Thresholding and sperating head and flagellum in a tracked region ...  ")
+
+    '''
+    Track the sperm, one chunk of frames at a time.
+    '''
+    timed = report is not None
+    Results = [ None ] * n3
+    tracked = 0
+    work = 0
+    for k0,k1,output in MapFrames( TrackFrames, movie,
+                                   (radius, threshold, stain, method, threshold1, maxheadwidth,
+                                    headbodyratio, threshold2, analysismethod, margin, timed,
+                                    window, Engine( engines, "difference" )),
+                                   workers, chunksize ):
+        if timed:
+            report.AddFrameTimes( "TrackingSperm", k0, output[4] )
+        masks[k0:k1,:,:] = output[0]
+        newMovie[k0:k1,:,:] = output[0]
+        Results[k0:k1] = output[1]
+        tracked += output[2]
+        work += output[3]
+    print("  %d of %d frames found in the tracked region, %.1f%% of the pixels processed  "
+          % (tracked, n3, 100.0*work/max(1,n1*n2*n3)))
+
+    '''
+    Write out the results of Steps 3 and 4.
+    '''
+    SaveMovie( masks, outputpath+"SpermStep3_Thresholding.mha", compress )
+
+    for k in range(n3):
+        if Results[k] is None:
+            # Erase the information about "bad" frames.
+            newMovie[k,:,:] = 0
+    newMovie = SaveMovie( newMovie, outputpath+"SpermStep4_GoodFramesOnly.mha", compress )
+
+    sperm = SpermDictionary( Results, dt, scale, n1, n2 )
+
+    return newMovie, sperm
+
+
+'''
+Inputs:
+    (1) frames = numpy array of shape (m,n2,n1)
+    (2) radius, threshold, stain, method, threshold1, maxheadwidth, headbodyratio, threshold2,
+        analysismethod, margin = see TrackingSperm
+    (3) timed = boolean, also return the time spent on each frame
+    (4) window = integer, see DetectingSpermBody
+    (5) engine = string, engine of the box means, see ThresholdingFrames
+Outputs:
+    (1) masks = numpy array of shape (m,n2,n1), the thresholding result of the frames
+    (2) results = list of length m, the output of AnalyzeFrame for each frame
+    (3) tracked = integer, number of good frames found inside the predicted box
+    (4) work = integer, number of pixels thresholded
+    (5) times = list of length m (unit: second), only if timed
+'''
+
+def TrackFrames( frames, radius, threshold, stain, method,
+                 threshold1, maxheadwidth, headbodyratio, threshold2, analysismethod,
+                 margin, timed=False, window=None, engine="scipy" ):
+    m,n2,n1 = frames.shape
+    masks = np.zeros( (m,n2,n1) )
+    results = []
+    times = []
+    tracked = 0
+    work = 0
+    box = None
+    center = None
+    velocity = (0,0)
+    seed = None
+    for k in range(m):
+        start = time.time()
+        A = frames[k,:,:]
+        result = None
+
+        # Threshold and analyze the predicted box only.
+        if box is not None:
+            B, area = ThresholdingRegion( A, box, radius, threshold, method, engine )
+            RemoveStains( B, stain )
+            work += area
+            result = AnalyzeRegion( B, box, threshold1, maxheadwidth, headbodyratio,
+                                    threshold2, analysismethod, seed )
+            # If the body reaches a side of the box, part of the sperm may be outside: grow
+            # the box once on those sides, by the margin and the shift predicted from the
+            # head, which may be wrong, before processing the whole frame.
+            sides = TouchedSides( result[0], box, n2, n1 ) if result is not None else None
+            if sides is not None and any( sides ):
+                grow = ( margin + int( round( abs( velocity[0] ) ) ),
+                         margin + int( round( abs( velocity[1] ) ) ) )
+                box = GrowBox( box, sides, grow, n2, n1 )
+                B, area = ThresholdingRegion( A, box, radius, threshold, method, engine )
+                RemoveStains( B, stain )
+                work += area
+                result = AnalyzeRegion( B, box, threshold1, maxheadwidth, headbodyratio,
+                                        threshold2, analysismethod, seed )
+                if result is not None and any( TouchedSides( result[0], box, n2, n1 ) ):
+                    result = None
+            if result is not None:
+                tracked += 1
+
+        # First frame, or the sperm is lost: process the whole frame.
+        if result is None:
+            B = ThresholdingFrames( A[np.newaxis,:,:], radius, threshold, stain, method,
+                                    engine=engine )[0,:,:]
+            work += n1*n2
+            result = AnalyzeFrame( B, threshold1, maxheadwidth, headbodyratio, threshold2,
+                                   analysismethod, seed )
+
+        masks[k,:,:] = B
+        results.append( result )
+
+        # Predict the box of the next frame.
+        if result is not None:
+            body, head = result[0], result[2]
+            newcenter = np.mean( head, axis=0 ) if len(head) > 0 else None
+            if center is not None and newcenter is not None:
+                velocity = newcenter - center
+            center = newcenter
+            box = RegionOfInterest( body, velocity, margin, n2, n1 )
+            if window is not None:
+                seed = HeadSeed( result, window )
+        else:
+            box = None
+            center = None
+            velocity = (0,0)
+        times.append( time.time() - start )
+    ''' end of for loop on k '''
+
+    if timed:
+        return masks, results, tracked, work, times
+    return masks, results, tracked, work
+
+
+'''
+Inputs:
+    (1) body = 2-column numpy array in (y,x) pairs, the body in the current frame
+    (2) velocity = (dy,dx), displacement of the center of the head since the previous frame
+    (3) margin = integer, number of pixels added on each side
+    (4) n2, n1 = size of the frame
+Output:
+    (1) box = (y0,y1,x0,x1), rows [y0,y1) and columns [x0,x1) of the box in the next frame
+'''
+
+def RegionOfInterest( body, velocity, margin, n2, n1 ):
+    dy = int( round( velocity[0] ) )
+    dx = int( round( velocity[1] ) )
+    y0 = max( 0, int( np.min(body[:,0]) ) + dy - margin )
+    y1 = min( n2, int( np.max(body[:,0]) ) + dy + margin + 1 )
+    x0 = max( 0, int( np.min(body[:,1]) ) + dx - margin )
+    x1 = min( n1, int( np.max(body[:,1]) ) + dx + margin + 1 )
+    if y0 >= y1 or x0 >= x1:
+        return None
+    return (y0,y1,x0,x1)
+
+
+'''
+Inputs:
+    (1) A = 2D numpy array, one frame of the movie
+    (2) box = (y0,y1,x0,x1), see RegionOfInterest
+    (3) radius, threshold, method = see Thresholding
+    (4) engine = string, engine of the box means, see ThresholdingFrames
+Outputs:
+    (1) B = 2D numpy array of the same shape as A, the thresholding result inside the box
+            and 0 elsewhere
+    (2) area = integer, number of pixels thresholded
+'''
+
+def ThresholdingRegion( A, box, radius, threshold, method, engine="scipy" ):
+    n2,n1 = A.shape
+    y0,y1,x0,x1 = box
+    # The squares around a pixel reach 3*radius+1 pixels away.
+    p = 3*radius+1
+    cy0, cy1 = max( 0, y0-p ), min( n2, y1+p )
+    cx0, cx1 = max( 0, x0-p ), min( n1, x1+p )
+    nostain = np.zeros( (0,4), dtype=int )
+    C = ThresholdingFrames( A[np.newaxis,cy0:cy1,cx0:cx1], radius, threshold, nostain, method,
+                            engine=engine )[0,:,:]
+    B = np.zeros( (n2,n1) )
+    B[y0:y1,x0:x1] = C[ y0-cy0:y1-cy0, x0-cx0:x1-cx0 ]
+    return B, (cy1-cy0)*(cx1-cx0)
+
+
+'''
+Inputs:
+    (1) body = 2-column numpy array in (y,x) pairs, the body found inside the box
+    (2) box = (y0,y1,x0,x1), see RegionOfInterest
+    (3) n2, n1 = size of the frame
+Output:
+    (1) sides = (top, bottom, left, right), True for each side of the box which the body
+            reaches and which is not a side of the frame
+'''
+
+def TouchedSides( body, box, n2, n1 ):
+    y0,y1,x0,x1 = box
+    return ( y0 > 0 and int( np.min(body[:,0]) ) <= y0,
+             y1 < n2 and int( np.max(body[:,0]) ) >= y1-1,
+             x0 > 0 and int( np.min(body[:,1]) ) <= x0,
+             x1 < n1 and int( np.max(body[:,1]) ) >= x1-1 )
+
+
+'''
+Inputs:
+    (1) box = (y0,y1,x0,x1), see RegionOfInterest
+    (2) sides = output of TouchedSides
+    (3) grow = (gy,gx), number of pixels added on each touched side along y and x
+    (4) n2, n1 = size of the frame
+Output:
+    (1) box = (y0,y1,x0,x1), the box grown on the touched sides, within the frame
+'''
+
+def GrowBox( box, sides, grow, n2, n1 ):
+    y0,y1,x0,x1 = box
+    top, bottom, left, right = sides
+    gy, gx = grow
+    return ( max( 0, y0-gy ) if top else y0, min( n2, y1+gy ) if bottom else y1,
+             max( 0, x0-gx ) if left else x0, min( n1, x1+gx ) if right else x1 )
+
+
+'''
+Inputs:
+    (1) B = 2D numpy array, thresholding result which is 0 outside the box
+    (2) box = (y0,y1,x0,x1), see RegionOfInterest
+    (3) threshold1, maxheadwidth, headbodyratio, threshold2, analysismethod = see TrackingSperm
+    (4) seed = see AnalyzeFrame, in the coordinates of the whole frame
+Output:
+    (1) the output of AnalyzeFrame, in the coordinates of the whole frame
+'''
+
+def AnalyzeRegion( B, box, threshold1, maxheadwidth, headbodyratio, threshold2, analysismethod,
+                   seed=None ):
+    y0,y1,x0,x1 = box
+    # Keep one empty row and column in front of the box, so that no pixel of the sperm
+    # is at (0,0), which the analysis treats as an empty row.
+    y0 = max( 0, y0-1 )
+    x0 = max( 0, x0-1 )
+    if not np.any( B[y0:y1,x0:x1] == 1 ):
+        return None
+    if seed is not None:
+        # Move the range of the head into the box.
+        shift = (y0,x0)[ seed[0] ]
+        seed = ( seed[0], (seed[1][0]-shift, seed[1][1]-shift, seed[1][2]) )
+    result = AnalyzeFrame( B[y0:y1,x0:x1], threshold1, maxheadwidth, headbodyratio, threshold2,
+                           analysismethod, seed )
+    if result is None:
+        return None
+    body, flagellum, head, horizontality, orientation = result
+    offset = np.array( [y0,x0] )
+    return body+offset, flagellum+offset, head+offset, horizontality, orientation